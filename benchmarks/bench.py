@@ -0,0 +1,171 @@
+"""Throughput and memory benchmarks for the SC-JSON to TEI conversion.
+
+Each case converts a synthetic manuscript (see tpen2tei.synthetic) in a fresh
+process, so that the peak RSS is that of the one conversion, and records the
+lines converted per second along with the time spent in from_sc, _xmlify and
+_tei_wrap. The results are written as JSON; given the results of an earlier
+run with --compare, the script exits with an error if any case has got slower
+by more than the threshold.
+
+    python benchmarks/bench.py -o results.json
+    python benchmarks/bench.py --compare results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+from tpen2tei import parse
+from tpen2tei.synthetic import numeric_parser, synthetic_manifest
+
+__author__ = 'tla'
+
+# name: (pages, lines per page, columns, markup density, notes)
+SIZES = {
+    'small': (10, 30, 1, 0.1, 0.02),
+    'medium': (100, 30, 2, 0.1, 0.02),
+    'large': (500, 40, 2, 0.1, 0.02),
+    'dense': (100, 30, 1, 0.5, 0.2),
+}
+
+
+def run_case(name, size, repeat=3, seed=0):
+    """Convert the synthetic manuscript of the given size repeat times in this
+    process, and return the figures for the fastest run."""
+    pages, lines, columns, markup, notes = size
+    ms = synthetic_manifest(pages=pages, lines=lines, columns=columns, markup=markup,
+                            notes=notes, seed=seed)
+    timers = {'_xmlify': 0.0, '_tei_wrap': 0.0}
+    _time_calls(timers)
+    best = None
+    for _ in range(repeat):
+        for key in timers:
+            timers[key] = 0.0
+        start = time.perf_counter()
+        xmltree = parse.from_sc(ms.manifest, members=ms.members, special_chars=ms.special_chars,
+                                numeric_parser=numeric_parser)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best['from_sc']:
+            best = dict(timers, from_sc=elapsed)
+    output = etree.tostring(xmltree, encoding='utf-8')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # which gives it in bytes rather than kilobytes
+        rss //= 1024
+    return {
+        'name': name,
+        'pages': pages,
+        'lines': pages * lines,
+        'columns': columns,
+        'markup': markup,
+        'notes': notes,
+        'repeat': repeat,
+        'seconds': {k: round(v, 6) for k, v in best.items()},
+        'lines_per_second': round(pages * lines / best['from_sc'], 1),
+        'output_bytes': len(output),
+        'peak_rss_kb': rss,
+    }
+
+
+def _time_calls(timers):
+    # Replace the module functions with ones that add up the time they take;
+    # from_sc looks them up in the module globals on every call.
+    for fname in timers:
+        func = getattr(parse, fname)
+
+        def timed(*args, _func=func, _name=fname, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _func(*args, **kwargs)
+            finally:
+                timers[_name] += time.perf_counter() - start
+        setattr(parse, fname, timed)
+
+
+def _case_process(args):
+    # Silence the conversion warnings, which would only get in the way.
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    return run_case(*args)
+
+
+def run(names, repeat=3, seed=0):
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for name in names:
+        # One process per case, so that each peak RSS stands on its own.
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            results.append(pool.apply(_case_process, ((name, SIZES[name], repeat, seed),)))
+        print('%-8s %8d lines %10.1f lines/s %8d KB' % (
+            name, results[-1]['lines'], results[-1]['lines_per_second'], results[-1]['peak_rss_kb']),
+            file=sys.stderr)
+    return {'environment': _environment(), 'cases': results}
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of messages about the cases that are slower than in the
+    baseline results by more than the given fraction."""
+    previous = {c['name']: c for c in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        before = previous.get(case['name'])
+        if before is None:
+            continue
+        ratio = before['lines_per_second'] / case['lines_per_second']
+        if ratio > 1 + threshold:
+            regressions.append('%s: %.1f lines/s, down from %.1f (%.0f%% slower)' % (
+                case['name'], case['lines_per_second'], before['lines_per_second'], (ratio - 1) * 100))
+    return regressions
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'lxml': '.'.join(str(x) for x in etree.LXML_VERSION),
+        'libxml2': '.'.join(str(x) for x in etree.LIBXML_VERSION),
+        'platform': platform.platform(),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the SC-JSON to TEI conversion.')
+    parser.add_argument("sizes", nargs='*', help="The cases to run (default all: %s)" % ', '.join(SIZES))
+    parser.add_argument("-o", "--output", help="Write the results to this file rather than stdout")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Take the best of this many runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", metavar="BASELINE", help="Results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="The slowdown, as a fraction, that counts as a regression")
+    args = parser.parse_args()
+    unknown = [s for s in args.sizes if s not in SIZES]
+    if unknown:
+        parser.error('unknown case(s) %s' % ', '.join(unknown))
+
+    outcome = run(args.sizes or list(SIZES), repeat=args.repeat, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(outcome, fh, indent=2)
+    else:
+        json.dump(outcome, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as fh:
+            slower = compare(outcome, json.load(fh), args.threshold)
+        for message in slower:
+            print('REGRESSION: %s' % message, file=sys.stderr)
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,91 @@
+"""Compare the JSON backends for reading SC-JSON manifests.
+
+For each manifest, and for the incremental reader as well as each JSON backend
+that is installed, records the best time to decode the manifest and the best
+time to convert it with from_sc_stream. The results are written as JSON.
+
+    python benchmarks/json_backends.py
+    python benchmarks/json_backends.py -r 20 tests/data/Bz430.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tpen2tei.manifest import ManifestReader, load_manifest, orjson
+from tpen2tei.parse import from_sc_stream
+
+__author__ = 'tla'
+
+_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+MANIFESTS = [os.path.join(_DATA, 'Bz430.json'), os.path.join(_DATA, 'M3519.json')]
+
+
+def backends():
+    """Returns the backends to compare; None stands for the incremental reader."""
+    return [None, 'json'] + (['orjson'] if orjson is not None else [])
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def decode(path, backend):
+    if backend is None:
+        with open(path, 'rb') as fh:
+            reader = ManifestReader(fh)
+            for _ in reader.canvases():
+                pass
+    else:
+        load_manifest(path, backend)
+
+
+def convert(path, backend):
+    # The conversion warnings would only get in the way.
+    with open(path, 'rb') as fh, open(os.devnull, 'w') as null, redirect_stdout(null), redirect_stderr(null):
+        from_sc_stream(fh, page_errors='wrap', json_backend=backend)
+
+
+def run(paths, repeat=10):
+    results = []
+    for path in paths:
+        for backend in backends():
+            case = {
+                'manifest': os.path.basename(path),
+                'bytes': os.path.getsize(path),
+                'backend': backend or 'stream',
+                'decode_seconds': round(best_time(lambda: decode(path, backend), repeat), 6),
+                'convert_seconds': round(best_time(lambda: convert(path, backend), repeat), 6),
+            }
+            results.append(case)
+            print('%-12s %-8s decode %8.2f ms  convert %8.2f ms' % (
+                case['manifest'], case['backend'], case['decode_seconds'] * 1000,
+                case['convert_seconds'] * 1000), file=sys.stderr)
+    return {'repeat': repeat, 'cases': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the JSON backends for reading manifests.')
+    parser.add_argument("manifests", nargs='*', help="SC-JSON files (default: %s)" % ', '.join(
+        os.path.basename(p) for p in MANIFESTS))
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="Take the best of this many runs")
+    parser.add_argument("-o", "--output", help="Write the results to this file rather than stdout")
+    args = parser.parse_args()
+    outcome = run(args.manifests or MANIFESTS, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(outcome, fh, indent=2)
+    else:
+        json.dump(outcome, sys.stdout, indent=2)
+        print()
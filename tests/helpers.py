@@ -75,4 +75,8 @@ def postprocess(doc):
 
 
 def test_members():
-    return {'281': {'uname': 'me@example.com', 'name': 'Me M. and I', 'id': '281'}}
\ No newline at end of file
+    return {'281': {'uname': 'me@example.com', 'name': 'Me M. and I', 'id': '281'}}
+
+def armenian_glyphs():
+    from config import config
+    return glyph_struct(config()['armenian_glyphs'])
@@ -0,0 +1,192 @@
+import unittest
+
+from tpen2tei.batch import batch_stats, convert_batch, expand_inputs, resolve_hook
+from tpen2tei.cache import DiskCache
+from tpen2tei.parse import from_sc
+from config import config as config
+from lxml import etree
+import helpers
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tempfile
+
+__author__ = 'tla'
+
+
+def crash_once(st):
+    """A text filter whose first call kills the worker process, for as long as
+    the file named in TPEN2TEI_TEST_CRASH does not exist."""
+    marker = os.environ.get('TPEN2TEI_TEST_CRASH')
+    if marker is not None and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+    return helpers.tpen_filter(st)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.inputs = [self.testfiles['broken'], self.testfiles['m3519'], self.testfiles['json']]
+
+    def test_expand_inputs(self):
+        datadir = os.path.dirname(self.testfiles['json'])
+        infiles = expand_inputs([datadir, os.path.join(datadir, 'M*.json'), self.testfiles['json']])
+        self.assertEqual(sorted(set(infiles)), infiles)
+        self.assertIn(os.path.join(datadir, 'Bz430.json'), infiles)
+        self.assertNotIn(self.testfiles['xml'], infiles)
+
+    def test_resolve_hook(self):
+        self.assertIs(helpers.tpen_filter, resolve_hook('helpers:tpen_filter'))
+        self.assertIs(helpers.tpen_filter, resolve_hook('helpers.tpen_filter'))
+        with self.assertRaises(ValueError):
+            resolve_hook('tpen_filter')
+
+    def test_batch(self):
+        """Check that a batch converts the good files in parallel, and reports the
+        bad one without affecting the others."""
+        with tempfile.TemporaryDirectory() as outdir:
+            results = convert_batch(self.inputs, outdir, workers=2,
+                                    metadata={'short_error': True},
+                                    special_chars='helpers:armenian_glyphs',
+                                    numeric_parser='helpers:armenian_numbers',
+                                    text_filter='helpers:tpen_filter')
+            self.assertEqual(sorted(self.inputs), [r.infile for r in results])
+            for result in results:
+                if result.infile == self.testfiles['broken']:
+                    self.assertFalse(result.ok)
+                    self.assertIsNone(result.outfile)
+                    self.assertRegex(result.messages, 'Parsing error in the JSON')
+                    continue
+                self.assertTrue(result.ok)
+                expected = from_sc(helpers.load_JSON_file(result.infile),
+                                   special_chars=self.glyphs,
+                                   numeric_parser=helpers.armenian_numbers,
+                                   text_filter=helpers.tpen_filter)
+                with open(result.outfile, 'rb') as fh:
+                    self.assertEqual(etree.tostring(expected, encoding='utf-8', pretty_print=True,
+                                                    xml_declaration=True), fh.read())
+            self.assertEqual(['M1731.xml', 'M3519.xml'], sorted(os.listdir(outdir)))
+
+    def test_output_cache(self):
+        """Check that a second batch takes the unchanged documents from the cache."""
+        with tempfile.TemporaryDirectory() as outdir, tempfile.TemporaryDirectory() as cachedir:
+            options = dict(workers=1, output_cache=cachedir, special_chars='helpers:armenian_glyphs',
+                           text_filter='helpers:tpen_filter')
+            first = convert_batch(self.inputs[1:], outdir, **options)
+            self.assertTrue(all(r.ok for r in first))
+            # Mark the cached documents, to see that they are the ones used.
+            cache = DiskCache(cachedir)
+            entries = cache._entries()
+            self.assertEqual(2, len(entries))
+            for _, path, _ in entries:
+                with open(path, 'ab') as fh:
+                    fh.write(b'<!-- cached -->')
+            second = convert_batch(self.inputs[1:], outdir, **options)
+            self.assertEqual([r.outfile for r in first], [r.outfile for r in second])
+            for result in second:
+                with open(result.outfile, 'rb') as fh:
+                    self.assertTrue(fh.read().endswith(b'<!-- cached -->'))
+
+    def test_batch_stats(self):
+        """Check that the figures of each conversion, with the memo hits and
+        misses, come back with the results, and add up over the batch."""
+        with tempfile.TemporaryDirectory() as outdir:
+            results = convert_batch(self.inputs[1:], outdir, workers=1, memoize=True,
+                                    special_chars='helpers:armenian_glyphs', text_filter='helpers:tpen_filter')
+        self.assertTrue(all(r.ok for r in results))
+        total = batch_stats(results)
+        self.assertEqual(2, total.conversions)
+        for counter in ('pages', 'text_filter_hits', 'text_filter_misses'):
+            self.assertEqual(sum(r.stats['counts'][counter] for r in results), total.counts[counter])
+        self.assertGreater(total.counts['text_filter_misses'], 0)
+
+    def test_compressed(self):
+        """Check that compressed manifests in a directory are converted, with the
+        output named as for the uncompressed ones."""
+        with tempfile.TemporaryDirectory() as indir, tempfile.TemporaryDirectory() as outdir:
+            with open(self.testfiles['m3519'], 'rb') as fh:
+                data = fh.read()
+            for name, compress in (('M3519.json', bytes), ('gz.json.gz', gzip.compress),
+                                   ('xz.json.xz', lzma.compress)):
+                with open(os.path.join(indir, name), 'wb') as fh:
+                    fh.write(compress(data))
+            infiles = expand_inputs([indir])
+            self.assertEqual(3, len(infiles))
+            results = convert_batch(infiles, outdir, workers=1, special_chars='helpers:armenian_glyphs',
+                                    text_filter='helpers:tpen_filter')
+            self.assertEqual([os.path.join(outdir, n) for n in ('M3519.xml', 'gz.xml', 'xz.xml')],
+                             [r.outfile for r in results])
+            documents = set()
+            for result in results:
+                with open(result.outfile, 'rb') as fh:
+                    documents.add(fh.read())
+            self.assertEqual(1, len(documents))
+
+    def test_journal(self):
+        """Check that a batch with a journal skips the finished files when it is
+        run again, retries the failures, and quarantines a file that keeps failing."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inputs = []
+            for infile in self.inputs:
+                inputs.append(os.path.join(tmpdir, os.path.basename(infile)))
+                shutil.copy(infile, inputs[-1])
+            outdir = os.path.join(tmpdir, 'out')
+            journal = os.path.join(tmpdir, 'journal.jsonl')
+            options = dict(workers=1, journal=journal, retries=1, backoff=0,
+                           special_chars='helpers:armenian_glyphs', text_filter='helpers:tpen_filter')
+            first = convert_batch(inputs, outdir, **options)
+            self.assertEqual([False, True, True], [r.ok for r in first])
+            with open(journal) as fh:
+                records = [json.loads(line) for line in fh]
+            # The broken file was tried twice.
+            self.assertEqual(4, len(records))
+            self.assertEqual([inputs[0]] * 2, [r['input'] for r in records if not r['ok']])
+            self.assertRegex(records[0]['error'], 'Parsing error in the JSON')
+
+            # A crash while writing the journal leaves half a line, which is ignored.
+            with open(journal, 'a') as fh:
+                fh.write('{"input": "')
+            second = convert_batch(inputs, outdir, **options)
+            self.assertEqual([r.outfile for r in first], [r.outfile for r in second])
+            self.assertEqual('Converted in an earlier run\n', second[1].messages)
+            self.assertFalse(second[0].ok)
+            self.assertRegex(second[0].messages, 'Parsing error in the JSON')
+
+            # The broken file has now failed three times.
+            third = convert_batch(inputs, outdir, **options)
+            self.assertEqual('Quarantined after failing 3 times\n', third[0].messages)
+
+            # A file that has changed is converted again.
+            with open(first[2].infile, 'ab') as fh:
+                fh.write(b'\n')
+            fourth = convert_batch(inputs, outdir, **options)
+            self.assertEqual('Converted in an earlier run\n', fourth[1].messages)
+            self.assertTrue(fourth[2].ok)
+            self.assertNotEqual('Converted in an earlier run\n', fourth[2].messages)
+
+            # And so is one with different options.
+            fifth = convert_batch(inputs[1:], outdir, **dict(options, memoize=True))
+            self.assertNotIn('Converted in an earlier run\n', [r.messages for r in fifth])
+
+    def test_worker_crash(self):
+        """Check that the files that were being converted when a worker died are
+        tried again, and the rest of the batch goes on."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ['TPEN2TEI_TEST_CRASH'] = os.path.join(tmpdir, 'crashed')
+            self.addCleanup(os.environ.pop, 'TPEN2TEI_TEST_CRASH')
+            journal = os.path.join(tmpdir, 'journal.jsonl')
+            results = convert_batch(self.inputs[1:], os.path.join(tmpdir, 'out'), workers=2, journal=journal,
+                                    retries=2, backoff=0, special_chars='helpers:armenian_glyphs',
+                                    text_filter='test_batch:crash_once')
+            self.assertTrue(all(r.ok for r in results))
+            with open(journal) as fh:
+                records = [json.loads(line) for line in fh]
+            failures = [r for r in records if not r['ok']]
+            self.assertGreater(len(failures), 0)
+            self.assertRegex(failures[0]['error'], 'The worker failed')
@@ -0,0 +1,206 @@
+import unittest
+
+from tpen2tei.cache import DiskCache, FingerprintError, cache_key, fingerprint
+from tpen2tei import parse
+from tpen2tei.parse import Converter, from_sc
+from tpen2tei.textfilter import TextFilter
+from config import config as config
+from lxml import etree
+from contextlib import redirect_stderr
+import copy
+import functools
+import helpers
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+__author__ = 'tla'
+
+
+class Opaque:
+    """A text filter with nothing to tell one instance from another but its address."""
+
+    def __call__(self, text):
+        return text.upper()
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def convert(self, data, cache=None):
+        xmltree = from_sc(copy.deepcopy(data), special_chars=self.glyphs,
+                          numeric_parser=helpers.armenian_numbers,
+                          text_filter=helpers.tpen_filter, cache=cache)
+        return etree.tostring(xmltree, encoding='utf-8')
+
+    def test_cached_output(self):
+        """Check that a conversion from the cache is the same as one without."""
+        for name in ('json', 'm3519'):
+            data = helpers.load_JSON_file(self.testfiles[name])
+            expected = self.convert(data)
+            self.assertEqual(expected, self.convert(data, self.cache))
+            misses = self.cache.misses
+            self.assertEqual(expected, self.convert(data, self.cache))
+            self.assertEqual(misses, self.cache.misses)
+
+    def test_changed_page(self):
+        """Check that only the changed pages are converted again, and that a
+        word broken over the page boundary is still marked."""
+        data = helpers.load_JSON_file(self.testfiles['json'])
+        self.convert(data, self.cache)
+        canvases = data['sequences'][0]['canvases']
+
+        # Change a line on the second page; the first page is unaffected.
+        canvases[1]['otherContent'][0]['resources'][3]['resource']['cnt:chars'] += 'ա'
+        misses = self.cache.misses
+        result = self.convert(data, self.cache)
+        self.assertEqual(self.convert(data), result)
+        # The second page, and the XML that it makes up, are new.
+        self.assertEqual(misses + 2, self.cache.misses)
+
+        # The first page ends in the middle of a word; if it doesn't any more,
+        # the first line of the second page has to change as well.
+        lineid = canvases[1]['otherContent'][0]['resources'][0]['_tpen_line_id'].split('/')[-1]
+        firstline = '<lb xml:id="l%s" facs="#z%s" n="1"' % (lineid, lineid)
+        self.assertIn((firstline + ' break="no"/>').encode('utf-8'), result)
+        canvases[0]['otherContent'][0]['resources'][-1]['resource']['cnt:chars'] += ' '
+        misses = self.cache.misses
+        result = self.convert(data, self.cache)
+        self.assertEqual(self.convert(data), result)
+        self.assertIn((firstline + '/>').encode('utf-8'), result)
+        # Both pages, and the XML that they make up, are new.
+        self.assertEqual(misses + 4, self.cache.misses)
+
+    def test_output_cache(self):
+        """Check that a whole document comes from the cache until the manuscript
+        or the options change."""
+        with open(self.testfiles['m3519'], 'rb') as fh:
+            data = fh.read()
+        options = dict(special_chars=self.glyphs, numeric_parser=helpers.armenian_numbers,
+                       text_filter=helpers.tpen_filter)
+        expected = Converter(**options).convert_to_xml(data)
+        self.assertEqual(etree.tostring(from_sc(helpers.load_JSON_file(self.testfiles['m3519']), **options),
+                                        encoding='utf-8', pretty_print=True, xml_declaration=True), expected)
+        converter = Converter(output_cache=self.cache, **options)
+        self.assertEqual(expected, converter.convert_to_xml(data))
+        self.assertEqual((0, 1, 1), (self.cache.hits, self.cache.misses, self.cache.writes))
+        with open(self.testfiles['m3519'], 'rb') as fh:
+            self.assertEqual(expected, Converter(output_cache=self.cache, **options).convert_to_xml(fh))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+        # A change to the manuscript, its metadata, or the options is a miss.
+        self.assertNotEqual(expected, converter.convert_to_xml(data.replace(b'M3519', b'M3520')))
+        converter.convert_to_xml(data, metadata={'title': 'Another title'})
+        Converter(output_cache=self.cache, **dict(options, text_filter=lambda x: x)).convert_to_xml(data)
+        self.assertEqual((1, 4, 4), (self.cache.hits, self.cache.misses, self.cache.writes))
+
+        # A failed conversion is not stored.
+        with open(self.testfiles['broken'], 'rb') as fh, redirect_stderr(io.StringIO()):
+            self.assertIsNone(converter.convert_to_xml(fh))
+        self.assertEqual(4, self.cache.writes)
+
+    def test_output_cache_stream(self):
+        """Check that convert_to_xml reads a file handle as it goes, and that
+        input that cannot be rewound is still hashed for the cache."""
+        options = dict(special_chars=self.glyphs, text_filter=helpers.tpen_filter)
+        with open(self.testfiles['m3519'], 'rb') as fh:
+            data = fh.read()
+        expected = Converter(**options).convert_to_xml(data)
+        # Without a cache, the handle itself goes to convert_stream.
+        convert_stream = Converter.convert_stream
+        with open(self.testfiles['m3519'], 'rb') as fh, \
+                mock.patch.object(Converter, 'convert_stream', autospec=True,
+                                  side_effect=convert_stream) as patched:
+            self.assertEqual(expected, Converter(**options).convert_to_xml(fh))
+            self.assertIs(fh, patched.call_args[0][1])
+        # A handle that is part way through is rewound only to where it was.
+        with tempfile.TemporaryFile() as fh:
+            fh.write(b'junk' + data)
+            fh.seek(4)
+            self.assertEqual(expected, Converter(output_cache=self.cache, **options).convert_to_xml(fh))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        for _ in range(2):
+            readfd, writefd = os.pipe()
+            writer = threading.Thread(target=self.write_pipe, args=(writefd, data))
+            writer.start()
+            try:
+                with open(readfd, 'rb') as fh:
+                    self.assertEqual(expected, Converter(output_cache=self.cache, **options).convert_to_xml(fh))
+            finally:
+                writer.join()
+        self.assertEqual((2, 1), (self.cache.hits, self.cache.misses))
+
+    @staticmethod
+    def write_pipe(fd, data):
+        with open(fd, 'wb') as fh:
+            fh.write(data)
+
+    def test_source_digest(self):
+        """Check that the output cache is invalidated by a change to any module
+        of the package, not only the parser."""
+        package = os.path.join(self.tmpdir.name, 'tpen2tei')
+        shutil.copytree(os.path.dirname(parse.__file__), package, ignore=shutil.ignore_patterns('__pycache__'))
+        self.assertEqual(parse._source_digest(), parse._source_digest(package))
+        with open(os.path.join(package, 'zones.py'), 'a') as fh:
+            fh.write('\n# A change\n')
+        # The digest is only worked out once for each directory.
+        parse._source_digest.cache_clear()
+        self.assertNotEqual(parse._source_digest(), parse._source_digest(package))
+
+    def test_eviction(self):
+        cache = DiskCache(self.tmpdir.name, max_size=1000)
+        for i in range(5):
+            cache.put(cache_key(i), b'x' * 300)
+            # Make sure that the entries are told apart by age.
+            path = cache._path(cache_key(i))
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        self.assertLessEqual(cache.size(), 1000)
+        self.assertIsNone(cache.get(cache_key(0)))
+        self.assertEqual(b'x' * 300, cache.get(cache_key(4)))
+        self.assertGreater(cache.stats().evictions, 0)
+        cache.clear()
+        self.assertEqual(0, cache.size())
+
+    def test_fingerprint(self):
+        self.assertEqual(cache_key({'a': 1, 'b': (2, 3)}), cache_key({'b': [2, 3], 'a': 1}))
+        self.assertEqual(fingerprint(helpers.tpen_filter), fingerprint(helpers.tpen_filter))
+        self.assertNotEqual(cache_key(lambda x: x), cache_key(lambda x: x.upper()))
+        self.assertNotEqual(cache_key(helpers.tpen_filter), cache_key(helpers.armenian_numbers))
+        self.assertEqual(cache_key(functools.partial(helpers.tpen_filter)),
+                         cache_key(functools.partial(helpers.tpen_filter)))
+        self.assertEqual(cache_key(TextFilter([('replace', 'a', 'b')])), cache_key(TextFilter([('replace', 'a', 'b')])))
+        # An object known only by where it is in memory cannot be part of a key.
+        with self.assertRaises(FingerprintError):
+            cache_key(Opaque())
+        with self.assertRaises(FingerprintError):
+            cache_key(functools.partial(helpers.tpen_filter, Opaque()))
+        # A function's key changes with the source of its module, which holds its helpers.
+        self.assertIsNotNone(fingerprint(helpers.tpen_filter)['module'])
+
+    def test_unfingerprintable(self):
+        """Check that a Converter with an option that cannot be fingerprinted
+        converts without the caches, rather than using keys that never match."""
+        text_filter = Opaque()
+        with self.assertWarnsRegex(UserWarning, 'Not using the output cache'):
+            converter = Converter(text_filter=text_filter, output_cache=self.cache)
+        with self.assertWarnsRegex(UserWarning, 'Not using the page cache'):
+            Converter(text_filter=text_filter, cache=self.cache)
+        with open(self.testfiles['m3519'], 'rb') as fh:
+            data = fh.read()
+        document = converter.convert_to_xml(data)
+        self.assertIsNotNone(document)
+        self.assertEqual(0, self.cache.writes)
+        self.assertEqual(Converter(text_filter=text_filter).convert_to_xml(data), document)
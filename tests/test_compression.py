@@ -0,0 +1,109 @@
+import unittest
+
+from tpen2tei.compression import compressed_output, detect, open_input
+from tpen2tei.manifest import load_manifest
+from tpen2tei.parse import from_sc_stream
+from tpen2tei.wordtokenize import Tokenizer
+from config import config as config
+from lxml import etree
+import helpers
+import gzip
+import io
+import lzma
+import os
+import shutil
+import tempfile
+import threading
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compressed_copies(self, path):
+        """Returns the given file, and copies of it compressed with each of gzip
+        and xz, under names that do not give the compression away."""
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        copies = [path]
+        for name, compress in (('gzip', gzip.compress), ('xz', lzma.compress)):
+            copy = os.path.join(self.tmpdir, '%s-%s' % (name, os.path.basename(path)))
+            with open(copy, 'wb') as fh:
+                fh.write(compress(data))
+            copies.append(copy)
+        return copies
+
+    def test_manifest(self):
+        """Check that a compressed manifest converts as the plain one does."""
+        plain, gz, xz = self.compressed_copies(self.testfiles['m3519'])
+        for path, compression in ((plain, None), (gz, 'gzip'), (xz, 'xz')):
+            with open(path, 'rb') as fh:
+                self.assertEqual(compression, detect(fh))
+        expected = None
+        for path in (plain, gz, xz):
+            self.assertEqual(helpers.load_JSON_file(plain), load_manifest(path))
+            with open_input(path) as fh:
+                result = etree.tostring(from_sc_stream(fh, special_chars=self.glyphs,
+                                                       text_filter=helpers.tpen_filter))
+            if expected is None:
+                expected = result
+            self.assertEqual(expected, result)
+
+    def test_pipe(self):
+        """Check that input that cannot be read twice, such as a pipe, is read
+        whether or not it is compressed."""
+        plain, gz, xz = self.compressed_copies(self.testfiles['m3519'])
+        expected = helpers.load_JSON_file(plain)
+        for path in (plain, gz, xz):
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            readfd, writefd = os.pipe()
+            # Write in small pieces, so that the reader must wait for them.
+            writer = threading.Thread(target=self.write_pipe, args=(writefd, data))
+            writer.start()
+            try:
+                with open_input(readfd) as fh:
+                    self.assertEqual(expected, load_manifest(fh))
+            finally:
+                writer.join()
+
+    @staticmethod
+    def write_pipe(fd, data):
+        with open(fd, 'wb', buffering=0) as fh:
+            for start in range(0, len(data), 4096):
+                fh.write(data[start:start + 4096])
+
+    def test_tokenizer(self):
+        """Check that the tokenizer reads compressed TEI."""
+        results = [Tokenizer(milestone='410').from_file(path)
+                   for path in self.compressed_copies(self.testfiles['xmlreal'])]
+        self.assertTrue(len(results[0]['tokens']))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_output(self):
+        data = 'Ժամանակագրութիւն\n'.encode('utf-8') * 100
+        outputs = {}
+        for compression, decompress in ((None, bytes), ('gzip', gzip.decompress), ('xz', lzma.decompress)):
+            with io.BytesIO() as fh:
+                with compressed_output(fh, compression) as out:
+                    out.write(data)
+                # The handle is left open, with the whole output in it.
+                outputs[compression] = fh.getvalue()
+            self.assertEqual(data, decompress(outputs[compression]))
+        # The same output is compressed to the same bytes every time.
+        with io.BytesIO() as fh:
+            with compressed_output(fh, 'gzip') as out:
+                out.write(data)
+            self.assertEqual(outputs['gzip'], fh.getvalue())
+        with self.assertRaises(ValueError):
+            compressed_output(io.BytesIO(), 'zip')
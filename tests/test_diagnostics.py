@@ -0,0 +1,79 @@
+import unittest
+
+from tpen2tei.diagnostics import Diagnostics
+from tpen2tei.parse import Converter, from_sc
+from config import config as config
+from contextlib import redirect_stderr, redirect_stdout
+from collections import Counter
+import helpers
+import io
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+
+    def test_unknown_members(self):
+        """Check that a transcriber who is not in the members list is reported
+        once, with the number of their lines, and nothing is printed."""
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        lines = Counter()
+        for canvas in d_json['sequences'][0]['canvases']:
+            for line in canvas['otherContent'][0]['resources']:
+                if helpers.tpen_filter(line['resource']['cnt:chars']):
+                    lines['%d' % line['_tpen_creator']] += 1
+        diagnostics = Diagnostics(max_locations=3)
+        with io.StringIO() as out, redirect_stdout(out), redirect_stderr(out):
+            xmltree = from_sc(d_json, members={}, special_chars=self.glyphs, text_filter=helpers.tpen_filter,
+                              diagnostics=diagnostics)
+            self.assertEqual('', out.getvalue())
+        self.assertIsNotNone(xmltree)
+        found = [d for d in diagnostics if d.code == 'unknown-member']
+        self.assertEqual(len(lines), len(found))
+        for d in found:
+            self.assertEqual('warning', d.level)
+            agent = d.message.split()[2]
+            self.assertEqual(lines[agent], d.count)
+            self.assertEqual(min(3, lines[agent]), len(d.locations))
+            self.assertIn('line', d.locations[0])
+        self.assertEqual([], diagnostics.errors())
+
+        # Without a collector, each line is reported as before.
+        with io.StringIO() as out, redirect_stdout(out):
+            from_sc(d_json, members={}, special_chars=self.glyphs, text_filter=helpers.tpen_filter)
+            self.assertEqual(sum(lines.values()), out.getvalue().count('not in members list'))
+
+    def test_page_errors(self):
+        """Check that broken pages and parsing errors are collected as structured data."""
+        problems = []
+        converter = Converter(page_errors='skip', diagnostics=problems.append)
+        with io.StringIO() as out, redirect_stderr(out):
+            self.assertIsNotNone(converter.convert(helpers.load_JSON_file(self.testfiles['broken'])))
+            self.assertEqual('', out.getvalue())
+        self.assertEqual(1, len(problems))
+        skipped = [d for d in problems[0] if d.code == 'malformed-page']
+        self.assertGreater(len(skipped), 0)
+        self.assertTrue(skipped[0].message.startswith('Skipping page'))
+        self.assertIn('page', skipped[0].locations[0])
+        self.assertRegex(skipped[0].detail, 'Affected portion of XML')
+
+        # The problems of several conversions add up.
+        diagnostics = Diagnostics()
+        converter = Converter(diagnostics=diagnostics)
+        for _ in range(2):
+            with io.StringIO() as out, redirect_stderr(out):
+                self.assertIsNone(converter.convert(helpers.load_JSON_file(self.testfiles['broken'])))
+                self.assertEqual('', out.getvalue())
+        errors = diagnostics.errors()
+        self.assertEqual(1, len(errors))
+        self.assertEqual('xml-syntax', errors[0].code)
+        self.assertEqual(2, errors[0].count)
+        self.assertEqual(errors[0]._asdict(), diagnostics.as_list()[0])
+        with io.StringIO() as out:
+            diagnostics.report(out)
+            self.assertRegex(out.getvalue(), r'^ERROR: Parsing error in the JSON: .* \(2 times\)\n')
@@ -0,0 +1,189 @@
+import unittest
+
+from tpen2tei.cache import DiskCache
+from tpen2tei.fetch import ManifestFetcher, _output_name, _output_names
+from tpen2tei.parse import from_sc
+from config import config as config
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lxml import etree
+import asyncio
+import gzip
+import hashlib
+import helpers
+import tempfile
+import threading
+
+__author__ = 'tla'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """A stand-in for the T-PEN server, which serves the test manifests with
+    ETags, and fails the first time for a 'flaky' manifest; 'badlength' and
+    'badchunk' manifests come with a broken Content-Length or chunk size, and
+    'badgzip' ones with a body that does not decompress."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.clients.add(self.client_address)
+            attempts = server.requests.count(self.path)
+        if self.path.startswith('/flaky/') and attempts == 1:
+            return self._send(503, b'Try again', {'Retry-After': '0'})
+        if self.path.startswith('/badgzip/'):
+            # A gzip header with the rest of the stream cut off
+            return self._send(200, gzip.compress(b'{}')[:12], {'Content-Encoding': 'gzip'})
+        if self.path.startswith(('/badlength/', '/badchunk/')):
+            self.close_connection = True
+            self.send_response(200)
+            if self.path.startswith('/badlength/'):
+                self.send_header('Content-Length', 'lots')
+            else:
+                self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'zz\r\n{}\r\n0\r\n\r\n')
+            return
+        name = self.path.split('/')[-2]
+        if name not in server.manifests:
+            return self._send(404, b'Not found')
+        body = server.manifests[name]
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, b'', {'ETag': etag})
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            return self._send(200, gzip.compress(body), {'ETag': etag, 'Content-Encoding': 'gzip'})
+        self._send(200, body, {'ETag': etag})
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.manifests = {}
+        for project, name in (('4505', 'json'), ('3519', 'm3519')):
+            with open(self.testfiles[name], 'rb') as fh:
+                self.server.manifests[project] = fh.read()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def url(self, project, prefix='TPEN'):
+        return '%s/%s/manifest/%s/manifest.json' % (self.base, prefix, project)
+
+    def test_fetch_all(self):
+        """Check that many manifests come over a few pooled connections."""
+        urls = [self.url('4505'), self.url('3519')] * 10
+
+        async def fetch():
+            async with ManifestFetcher(per_host=2) as fetcher:
+                return await fetcher.fetch_all(urls)
+        results = asyncio.run(fetch())
+        self.assertEqual(urls, [r.url for r in results])
+        for result in results:
+            self.assertEqual(200, result.status)
+            self.assertEqual(self.server.manifests[result.url.split('/')[-2]], result.data)
+        self.assertEqual(20, len(self.server.requests))
+        self.assertLessEqual(len(self.server.clients), 2)
+
+    def test_conditional(self):
+        """Check that a manifest that hasn't changed is not downloaded again."""
+        cache = DiskCache(self.tmpdir.name)
+
+        async def fetch():
+            async with ManifestFetcher(cache=cache) as fetcher:
+                return await fetcher.fetch(self.url('4505'))
+        first = asyncio.run(fetch())
+        self.assertTrue(first.modified)
+        second = asyncio.run(fetch())
+        self.assertEqual(304, second.status)
+        self.assertFalse(second.modified)
+        self.assertEqual(first.data, second.data)
+        # If it changes, we get the new version.
+        self.server.manifests['4505'] = self.server.manifests['3519']
+        third = asyncio.run(fetch())
+        self.assertTrue(third.modified)
+        self.assertEqual(self.server.manifests['3519'], third.data)
+
+    def test_retries(self):
+        async def fetch(retries):
+            async with ManifestFetcher(retries=retries, backoff=0) as fetcher:
+                return await fetcher.fetch_all([self.url('4505', 'flaky'), self.url('9999')])
+        flaky, missing = asyncio.run(fetch(2))
+        self.assertEqual(200, flaky.status)
+        self.assertEqual(2, self.server.requests.count('/flaky/manifest/4505/manifest.json'))
+        # A missing manifest is not asked for again.
+        self.assertEqual(404, missing.status)
+        self.assertIsNone(missing.data)
+        self.assertEqual(1, self.server.requests.count('/TPEN/manifest/9999/manifest.json'))
+
+        self.server.requests.clear()
+        flaky, _ = asyncio.run(fetch(0))
+        self.assertEqual(503, flaky.status)
+        self.assertRegex(flaky.error, '503')
+
+    def test_bad_response(self):
+        """Check that a response that cannot be read fails only its own URL."""
+        urls = [self.url('4505', 'badlength'), self.url('4505', 'badchunk'), self.url('4505', 'badgzip'),
+                self.url('3519')]
+
+        async def convert():
+            async with ManifestFetcher(retries=1, backoff=0) as fetcher:
+                return await fetcher.convert_all(urls)
+        (badlength, tei1), (badchunk, tei2), (badgzip, tei3), (good, tei4) = asyncio.run(convert())
+        self.assertIsNone(badlength.data)
+        self.assertRegex(badlength.error, 'Bad Content-Length')
+        self.assertIsNone(badchunk.data)
+        self.assertRegex(badchunk.error, 'Bad chunk size')
+        self.assertIsNone(badgzip.data)
+        self.assertRegex(badgzip.error, 'Bad gzip body')
+        self.assertEqual([None, None, None], [tei1, tei2, tei3])
+        self.assertIsNotNone(tei4)
+        # Each of the bad ones was tried again.
+        self.assertEqual(2, self.server.requests.count('/badlength/manifest/4505/manifest.json'))
+
+    def test_convert(self):
+        """Check that the downloaded manifests are converted just as the files are."""
+        glyphs = helpers.glyph_struct(config()['armenian_glyphs'])
+
+        async def convert():
+            async with ManifestFetcher() as fetcher:
+                return await fetcher.convert_all([self.url('3519'), self.url('9999')],
+                                                 special_chars=glyphs, text_filter=helpers.tpen_filter)
+        (result, xmltree), (missing, nothing) = asyncio.run(convert())
+        expected = from_sc(helpers.load_JSON_file(self.testfiles['m3519']),
+                           special_chars=glyphs, text_filter=helpers.tpen_filter)
+        self.assertEqual(etree.tostring(expected), etree.tostring(xmltree))
+        self.assertIsNone(nothing)
+        self.assertEqual('4505.xml', _output_name('http://t-pen.org/TPEN/manifest/4505/manifest.json'))
+        # Manifests that would be given the same name are told apart.
+        urls = ['http://t-pen.org/TPEN/manifest/4505/manifest.json',
+                'http://example.org/TPEN/manifest/4505/manifest.json',
+                'http://t-pen.org/TPEN/manifest/3519/manifest.json']
+        names = _output_names(urls + urls[:1])
+        self.assertEqual(3, len(set(names.values())))
+        self.assertRegex(names[urls[0]], r'^4505-[0-9a-f]{8}\.xml$')
+        self.assertEqual('3519.xml', names[urls[2]])
@@ -0,0 +1,72 @@
+import unittest
+
+from tpen2tei.manifest import ManifestReader, load_manifest, orjson
+from config import config as config
+import helpers
+import io
+import json
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+
+    def test_canvases(self):
+        """Check that the canvases are handed out in order, even when the input
+        arrives in very small pieces."""
+        msdata = helpers.load_JSON_file(self.testfiles['broken'])
+        with open(self.testfiles['broken'], encoding='utf-8') as fh:
+            reader = ManifestReader(fh, chunk_size=7)
+            canvases = list(reader.canvases())
+        self.assertEqual(msdata['sequences'][0]['canvases'], canvases)
+        self.assertEqual(msdata['metadata'], reader.metadata)
+        self.assertEqual(1, reader.sequence_count)
+
+    def test_binary_input(self):
+        """Check that a binary file handle is read as UTF-8, including multi-byte
+        characters that are split between reads."""
+        msdata = helpers.load_JSON_file(self.testfiles['json'])
+        with open(self.testfiles['json'], mode='rb') as fh:
+            reader = ManifestReader(fh, chunk_size=3)
+            canvases = list(reader.canvases())
+        self.assertEqual(msdata['sequences'][0]['canvases'], canvases)
+
+    def test_sequences(self):
+        """Check that only the canvases of the first sequence are returned, and that
+        further sequences are counted."""
+        manifest = {'label': 'test',
+                    'sequences': [{'canvases': [{'label': 'a'}, {'label': 'b'}], 'label': 'first'},
+                                  {'canvases': [{'label': 'c'}]}],
+                    'metadata': [{'label': 'title', 'value': 'Test'}]}
+        reader = ManifestReader(io.StringIO(json.dumps(manifest)))
+        self.assertEqual([{'label': 'a'}, {'label': 'b'}], list(reader.canvases()))
+        self.assertEqual(2, reader.sequence_count)
+        self.assertEqual(manifest['metadata'], reader.metadata)
+
+    def test_bad_json(self):
+        """Check that truncated input raises a JSON error."""
+        reader = ManifestReader(io.StringIO('{"sequences": [{"canvases": [{"label": "a"}, {"lab'))
+        with self.assertRaises(json.JSONDecodeError):
+            list(reader.canvases())
+
+    def test_load_manifest(self):
+        """Check that each JSON backend decodes the manifest the same way, from a
+        file name, a text or binary file, or a buffer in memory."""
+        msdata = helpers.load_JSON_file(self.testfiles['m3519'])
+        backends = [None, 'json', 'fast', lambda data: json.loads(bytes(data))]
+        if orjson is not None:
+            backends.append('orjson')
+        for backend in backends:
+            self.assertEqual(msdata, load_manifest(self.testfiles['m3519'], backend))
+            with open(self.testfiles['m3519'], 'rb') as fh:
+                self.assertEqual(msdata, load_manifest(fh, backend))
+            with open(self.testfiles['m3519'], 'rb') as fh:
+                self.assertEqual(msdata, load_manifest(io.BytesIO(fh.read()), backend))
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh:
+            self.assertEqual(msdata, load_manifest(fh))
+        with self.assertRaises(ValueError):
+            load_manifest(self.testfiles['m3519'], 'yaml')
@@ -1,10 +1,17 @@
 import unittest
 
-from tpen2tei.parse import from_sc
+from tpen2tei.parse import Converter, GlyphRegistry, Rules, from_sc, from_sc_stream, write_sc_stream
+from tpen2tei.diagnostics import Diagnostics
+from tpen2tei.synthetic import synthetic_manifest
+from lxml import etree
 from contextlib import redirect_stderr
 from config import config as config
 import helpers
 import io
+import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 __author__ = 'tla'
 
@@ -423,4 +430,249 @@ class Test(unittest.TestCase):
         for tag in d_root.iter(self.ns('pb')):
             visited = True
             self.assertEquals('interesting', tag.get('ana'))
-        self.assertTrue(visited)
\ No newline at end of file
+        self.assertTrue(visited)
+
+    def test_stream(self):
+        """Check that reading the SC-JSON incrementally gives the same result as
+        converting the decoded manifest."""
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh:
+            streamed = from_sc_stream(fh,
+                                      special_chars=self.glyphs,
+                                      numeric_parser=helpers.armenian_numbers,
+                                      text_filter=helpers.tpen_filter)
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        d_root = from_sc(d_json,
+                         special_chars=self.glyphs,
+                         numeric_parser=helpers.armenian_numbers,
+                         text_filter=helpers.tpen_filter)
+        self.assertEqual(etree.tostring(d_root, encoding='utf-8'), etree.tostring(streamed, encoding='utf-8'))
+
+        # Decoding the manifest at once makes no difference either.
+        with open(self.testfiles['m3519'], 'rb') as fh:
+            decoded = from_sc_stream(fh,
+                                     special_chars=self.glyphs,
+                                     numeric_parser=helpers.armenian_numbers,
+                                     text_filter=helpers.tpen_filter,
+                                     json_backend='fast')
+        self.assertEqual(etree.tostring(d_root, encoding='utf-8'), etree.tostring(decoded, encoding='utf-8'))
+
+    def test_stream_writer(self):
+        """Check that the incrementally written TEI has the same facsimile and text as
+        the converted tree, and that the header declares all the glyphs."""
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh, io.BytesIO() as out:
+            self.assertTrue(write_sc_stream(fh, out,
+                                            special_chars=self.glyphs,
+                                            numeric_parser=helpers.armenian_numbers,
+                                            text_filter=helpers.tpen_filter))
+            streamed = etree.fromstring(out.getvalue())
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        d_root = from_sc(d_json,
+                         special_chars=self.glyphs,
+                         numeric_parser=helpers.armenian_numbers,
+                         text_filter=helpers.tpen_filter).getroot()
+        for part in ['facsimile', 'text']:
+            self.assertEqual(etree.tostring(d_root.find(self.ns(part))),
+                             etree.tostring(streamed.find(self.ns(part))))
+        glyphs = streamed.findall('.//%s' % self.ns('glyph'))
+        self.assertEqual(len(self.glyphs), len(glyphs))
+
+    def test_stream_writer_error(self):
+        """Check that the incremental writer reports the same parsing error."""
+        with io.StringIO() as buf, redirect_stderr(buf):
+            with open(self.testfiles['broken'], encoding='utf-8') as fh, io.BytesIO() as out:
+                self.assertIsNone(write_sc_stream(fh, out))
+            errormsg = buf.getvalue()
+        self.assertRegex(errormsg, 'Parsing error in the JSON')
+        errorlines = errormsg.splitlines()[1:]
+        self.assertEqual(len(errorlines), 55)
+        self.assertRegex(errorlines[0], 'Affected portion of XML is 493: \<pb')
+
+    def test_glyph_registry(self):
+        """Check that a shared glyph registry gives the same result as the dictionary,
+        in several threads at once."""
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        expected = etree.tostring(from_sc(d_json, special_chars=self.glyphs,
+                                          text_filter=helpers.tpen_filter), encoding='utf-8')
+        registry = GlyphRegistry(self.glyphs)
+
+        def convert(_):
+            return etree.tostring(from_sc(helpers.load_JSON_file(self.testfiles['m3519']),
+                                          special_chars=registry,
+                                          text_filter=helpers.tpen_filter), encoding='utf-8')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for result in executor.map(convert, range(8)):
+                self.assertEqual(expected, result)
+        # Copies of the glyphs are handed out, so that they can go into different documents.
+        self.assertIsNot(registry.glyph('աշխարհ'), registry.glyph('աշխարհ'))
+        unpickled = pickle.loads(pickle.dumps(registry))
+        self.assertEqual(registry.resolve('asxarh'), unpickled.resolve('asxarh'))
+
+    def test_glyph_corrections(self):
+        """Check that the table of glyph name corrections can be changed."""
+        registry = GlyphRegistry(self.glyphs, corrections={'asx': 'աշխարհ'})
+        self.assertEqual(registry.resolve('աշխարհ'), registry.resolve('asx'))
+        self.assertEqual('աշխարհ', registry.resolve('asx')[0])
+        with self.assertRaisesRegex(ValueError, 'Glyph asxarh not recognized'):
+            registry.resolve('asxarh')
+
+    def test_page_errors(self):
+        """Check that broken pages can be left out or escaped, and the rest of
+        the manuscript converted."""
+        d_json = helpers.load_JSON_file(self.testfiles['broken'])
+        with io.StringIO() as buf, redirect_stderr(buf):
+            skipped = from_sc(d_json, page_errors='skip')
+            errormsg = buf.getvalue()
+        self.assertIsNotNone(skipped)
+        self.assertRegex(errormsg, 'Skipping page 430_304r_303v, which is not well-formed')
+        # The diagnostic is only about the broken page.
+        self.assertRegex(errormsg, 'Affected portion of XML is 493: \<pb n="430_304r_303v"')
+        pages = [pb.get('n') for pb in skipped.getroot().iter(self.ns('pb'))]
+        self.assertNotIn('430_304r_303v', pages)
+        self.assertNotIn('430_294r_293v', pages)
+        self.assertIn('430_303r_302v', pages)
+        # The facsimile is all still there.
+        self.assertEqual(len(pages) + 2, len(list(skipped.getroot().iter(self.ns('surface')))))
+
+        with io.StringIO() as buf, redirect_stderr(buf):
+            wrapped = from_sc(d_json, page_errors='wrap')
+        segs = wrapped.getroot().findall('.//%s[@type="unparsed"]' % self.ns('seg'))
+        self.assertEqual(2, len(segs))
+        self.assertEqual(self.ns('pb'), segs[1].getprevious().tag)
+        self.assertEqual('430_304r_303v', segs[1].getprevious().get('n'))
+        self.assertIn('<gap', etree.tostring(segs[1], method='text', encoding='unicode'))
+
+        with self.assertRaises(ValueError):
+            from_sc(d_json, page_errors='ignore')
+
+    def test_page_errors_in_run(self):
+        """Check that the page that breaks a paragraph running over several
+        pages is the one reported, and not the pages that open or close it."""
+        for typo in ('<hi>oops', 'oops</hi>'):
+            ms = synthetic_manifest(pages=6, lines=4, markup=0, notes=0, paragraph=False)
+            canvases = ms.manifest['sequences'][0]['canvases']
+            lines = [c['otherContent'][0]['resources'] for c in canvases]
+            lines[0][0]['resource']['cnt:chars'] = '<p>' + lines[0][0]['resource']['cnt:chars']
+            lines[5][-1]['resource']['cnt:chars'] += '</p>'
+            lines[3][1]['resource']['cnt:chars'] += typo
+            diagnostics = Diagnostics()
+            skipped = from_sc(ms.manifest, members=ms.members, page_errors='skip', diagnostics=diagnostics)
+            self.assertEqual(['1r', '1v', '2r', '3r', '3v'],
+                             [pb.get('n') for pb in skipped.getroot().iter(self.ns('pb'))])
+            self.assertEqual([[{'page': '2v'}]], [d['locations'] for d in diagnostics.as_list()
+                                      if d['code'] == 'malformed-page'])
+            # The paragraph still runs from the first page to the last.
+            paragraph = skipped.getroot().find('.//%s[%s]' % (self.ns('p'), self.ns('pb')))
+            self.assertEqual(['1v', '2r', '3r', '3v'], [pb.get('n') for pb in paragraph.iter(self.ns('pb'))])
+
+            wrapped = from_sc(ms.manifest, members=ms.members, page_errors='wrap', diagnostics=Diagnostics())
+            segs = wrapped.getroot().findall('.//%s[@type="unparsed"]' % self.ns('seg'))
+            self.assertEqual(['2v'], [seg.getprevious().get('n') for seg in segs])
+
+    def test_rules(self):
+        """Check that extra rules are applied along with the built-in fixes."""
+        rules = Rules()
+        seen = []
+
+        @rules.rule(tag='abbr')
+        def expand(el):
+            el.set('type', 'suspension')
+
+        @rules.rule(attribute='instant')
+        def not_instant(el):
+            del el.attrib['instant']
+
+        # The built-in fixes have already been made by the time our rules run.
+        rules.add(lambda el: seen.append(el.get('cert')), tag='del')
+
+        d_json = helpers.load_JSON_file(self.testfiles['json'])
+        d_root = from_sc(d_json, rules=rules).getroot()
+        abbrs = list(d_root.iter(self.ns('abbr')))
+        self.assertEqual(28, len(abbrs))
+        for abbr in abbrs:
+            self.assertEqual('suspension', abbr.get('type'))
+        self.assertEqual(0, len(d_root.xpath('//*[@instant]')))
+        self.assertEqual(2, len(list(d_root.iter(self.ns('subst')))))
+        self.assertEqual([None, 'low'], seen)
+
+        with self.assertRaises(ValueError):
+            rules.add(expand)
+
+    def test_converter(self):
+        """Check that one Converter can be used by many threads at once, and that
+        it leaves the metadata it is given alone."""
+        metadata = {'title': 'A test title', 'short_error': True}
+        converter = Converter(metadata=metadata,
+                              special_chars=self.glyphs,
+                              numeric_parser=helpers.armenian_numbers,
+                              text_filter=helpers.tpen_filter)
+        inputs = [self.testfiles['json'], self.testfiles['m3519']] * 4
+        expected = {}
+        for fn in inputs[:2]:
+            expected[fn] = etree.tostring(from_sc(helpers.load_JSON_file(fn), metadata=metadata,
+                                                  special_chars=self.glyphs,
+                                                  numeric_parser=helpers.armenian_numbers,
+                                                  text_filter=helpers.tpen_filter))
+        self.assertEqual({'title': 'A test title', 'short_error': True}, metadata)
+
+        def convert(fn):
+            return etree.tostring(converter.convert(helpers.load_JSON_file(fn)))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for fn, result in zip(inputs, executor.map(convert, inputs)):
+                self.assertEqual(expected[fn], result)
+
+        # Metadata can also be given for a single conversion.
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh:
+            d_root = converter.convert_stream(fh, metadata={'title': 'Another title'}).getroot()
+        self.assertEqual('Another title', d_root.find('.//%s' % self.ns('title')).text)
+        self.assertEqual({'title': 'A test title', 'short_error': True}, metadata)
+        with self.assertRaises(ValueError):
+            Converter(page_errors='ignore')
+
+    def test_memoize(self):
+        """Check that memoized callbacks are called once for each distinct string,
+        and that the result is the same."""
+        calls = []
+
+        def numbers(val):
+            calls.append(val)
+            return helpers.armenian_numbers(val)
+        converter = Converter(numeric_parser=numbers, text_filter=helpers.tpen_filter, memoize=True)
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        result = converter.convert(d_json)
+        self.assertEqual(len(set(calls)), len(calls))
+        expected = from_sc(d_json, numeric_parser=helpers.armenian_numbers, text_filter=helpers.tpen_filter)
+        self.assertEqual(etree.tostring(expected), etree.tostring(result))
+
+        # The memo lasts as long as the Converter.
+        converter.convert(d_json)
+        self.assertEqual(len(set(calls)), len(calls))
+        stats = converter.memo_stats()
+        self.assertEqual(len(calls), stats['numeric_parser'].misses)
+        self.assertEqual(len(calls), stats['numeric_parser'].hits)
+        self.assertGreater(stats['text_filter'].hits, 0)
+        self.assertIsNone(Converter(numeric_parser=numbers).memo_stats()['numeric_parser'])
+
+    def test_page_workers(self):
+        """Check that extracting the pages in parallel gives the same document,
+        down to the words that run over from one page to the next."""
+        ms = synthetic_manifest(pages=40, lines=12, seed=4)
+        cases = [(helpers.load_JSON_file(self.testfiles[key]), None) for key in ('json', 'm3519', 'legacy')]
+        cases.append((ms.manifest, ms.members))
+        with mock.patch('tpen2tei.parse._PAGE_CHUNK', 3):
+            for d_json, members in cases:
+                for text_filter, memoize in ((helpers.tpen_filter, None), (helpers.tpen_filter, True),
+                                             (lambda t: t.replace('_', '֊'), None)):
+                    expected = etree.tostring(from_sc(d_json, members=members, special_chars=self.glyphs,
+                                                      text_filter=text_filter))
+                    result = from_sc(d_json, members=members, special_chars=self.glyphs, text_filter=text_filter,
+                                     memoize=memoize, page_workers=3)
+                    self.assertEqual(expected, etree.tostring(result))
+                    streamed = from_sc_stream(io.BytesIO(json.dumps(d_json).encode('utf-8')), members=members,
+                                              special_chars=self.glyphs, text_filter=text_filter,
+                                              page_workers=3)
+                    self.assertEqual(expected, etree.tostring(streamed))
+        # Some of the pages begin in the middle of a word.
+        pb = '{%s}pb' % self.tei_ns
+        lb = '{%s}lb' % self.tei_ns
+        page_starts = [e.getnext() for e in result.iter(pb) if e.getnext() is not None and e.getnext().tag == lb]
+        self.assertTrue(any(e.get('break') == 'no' for e in page_starts))
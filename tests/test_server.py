@@ -0,0 +1,122 @@
+import unittest
+
+from tpen2tei.parse import from_sc
+from tpen2tei.server import ConversionServer, _query_params
+from tpen2tei.wordtokenize import Tokenizer
+from config import config as config
+from http.client import HTTPConnection
+from lxml import etree
+import helpers
+import json
+import threading
+import time
+
+__author__ = 'tla'
+
+
+def slow_filter(st):
+    time.sleep(0.5)
+    return st
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+
+    def serve(self, **options):
+        server = ConversionServer(('127.0.0.1', 0), **options)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.close()
+        self.addCleanup(stop)
+        return server
+
+    def post(self, server, path, infile):
+        with open(infile, 'rb') as fh:
+            data = fh.read()
+        conn = HTTPConnection(*server.address, timeout=30)
+        try:
+            conn.request('POST', path, data, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def test_server(self):
+        """Check that the warm workers give the same TEI and tokens as the library does."""
+        server = self.serve(workers=2, hooks={'special_chars': 'helpers:armenian_glyphs',
+                                              'numeric_parser': 'helpers:armenian_numbers',
+                                              'text_filter': 'helpers:tpen_filter'})
+        expected = from_sc(helpers.load_JSON_file(self.testfiles['json']), special_chars=self.glyphs,
+                           numeric_parser=helpers.armenian_numbers, text_filter=helpers.tpen_filter)
+        for _ in range(2):
+            status, body = self.post(server, '/tei', self.testfiles['json'])
+            self.assertEqual(200, status)
+            self.assertEqual(etree.tostring(expected, encoding='utf-8', pretty_print=True, xml_declaration=True),
+                             body)
+
+        status, body = self.post(server, '/tokens?milestone=407', self.testfiles['json'])
+        self.assertEqual(200, status)
+        self.assertEqual(Tokenizer(milestone='407').from_etree(expected), json.loads(body.decode('utf-8')))
+
+        # A manuscript that cannot be converted gets its problems back.
+        status, body = self.post(server, '/tei', self.testfiles['broken'])
+        self.assertEqual(422, status)
+        problems = json.loads(body.decode('utf-8'))
+        self.assertEqual('xml-syntax', problems[0]['code'])
+
+        conn = HTTPConnection(*server.address, timeout=30)
+        conn.request('GET', '/status')
+        status = json.loads(conn.getresponse().read().decode('utf-8'))
+        conn.close()
+        self.assertEqual(4, status['requests'])
+        self.assertEqual(2, status['alive'])
+
+    def test_timeout(self):
+        """Check that a conversion that takes too long is cut off, and its worker replaced."""
+        server = self.serve(workers=1, queue_size=0, timeout=0.2, hooks={'text_filter': 'test_server:slow_filter'})
+        status, body = self.post(server, '/tei', self.testfiles['json'])
+        self.assertEqual(504, status)
+        status = server.pool.status()
+        self.assertEqual(1, status['timeouts'])
+        self.assertEqual(0, status['failed'])
+        self.assertEqual(1, status['restarts'])
+        self.assertEqual(1, status['alive'])
+
+    def test_bad_request(self):
+        """Check that a bad Content-Length, timeout or query parameter gets a 400."""
+        server = self.serve(workers=1)
+        for timeout in ('abc', '0', '-1', 'nan'):
+            status, body = self.post(server, '/tei?timeout=%s' % timeout, self.testfiles['json'])
+            self.assertEqual(400, status)
+        for length in ('abc', '-5'):
+            conn = HTTPConnection(*server.address, timeout=30)
+            try:
+                conn.putrequest('POST', '/tei')
+                conn.putheader('Content-Length', length)
+                conn.endheaders()
+                self.assertEqual(400, conn.getresponse().status)
+            finally:
+                conn.close()
+        for query in ('colour=red', 'short_error=maybe', 'first_layer=2'):
+            status, body = self.post(server, '/tei?%s' % query, self.testfiles['json'])
+            self.assertEqual(400, status)
+        self.assertIn(b'colour', self.post(server, '/tei?colour=red', self.testfiles['json'])[1])
+        self.assertEqual(0, server.pool.status()['requests'])
+
+    def test_query_params(self):
+        """Check that the metadata and Tokenizer options are sorted out of the
+        query, and the flags made booleans."""
+        timeout, metadata, tokenizer_params = _query_params(
+            'title=A+title&short_error=0&first_layer=Yes&milestone=407&timeout=5', 10)
+        self.assertEqual(5, timeout)
+        self.assertEqual({'title': 'A title', 'short_error': False}, metadata)
+        self.assertEqual({'first_layer': True, 'milestone': '407'}, tokenizer_params)
+        self.assertEqual((10, None, {}), _query_params('timeout=60', 10))
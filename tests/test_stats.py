@@ -0,0 +1,98 @@
+import unittest
+
+from tpen2tei.parse import Converter, from_sc, from_sc_stream
+from tpen2tei.stats import PHASES, ConversionStats
+from config import config as config
+from contextlib import redirect_stderr
+from lxml import etree
+import helpers
+import io
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.ns = {'t': settings['namespaces']['tei']}
+
+    def test_stats(self):
+        """Check that the phases are timed and the contents counted, without
+        changing the result."""
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        options = dict(special_chars=self.glyphs, numeric_parser=helpers.armenian_numbers,
+                       text_filter=helpers.tpen_filter)
+        expected = etree.tostring(from_sc(d_json, **options))
+        stats = ConversionStats()
+        self.assertEqual(expected, etree.tostring(from_sc(d_json, stats=stats, **options)))
+        self.assertEqual(1, stats.conversions)
+        for phase in ('extract', 'body', 'parse', 'wrap_ab', 'fixup', 'header', 'assemble'):
+            self.assertGreater(stats.times[phase], 0, phase)
+        self.assertEqual(0, stats.times['postprocess'])
+        self.assertEqual(set(PHASES), set(stats.times))
+        self.assertGreater(stats.total(), 0)
+
+        canvases = d_json['sequences'][0]['canvases']
+        xmltree = from_sc(d_json, **options)
+        counts = stats.counts
+        self.assertEqual(len(canvases), counts['pages'])
+        self.assertEqual(len(xmltree.xpath('//t:body//t:lb', namespaces=self.ns)), counts['lines'])
+        self.assertEqual(len(xmltree.xpath('//t:body//t:g', namespaces=self.ns)), counts['glyphs'])
+        self.assertEqual(len(xmltree.xpath('//t:body//t:num', namespaces=self.ns)), counts['nums'])
+        self.assertEqual(len(xmltree.xpath('//t:body//t:note[@type="transcriptional"]', namespaces=self.ns)), counts['notes'])
+        self.assertEqual(1, counts['parses'])
+
+        # The figures of several conversions add up.
+        with open(self.testfiles['m3519'], encoding='utf-8') as fh:
+            from_sc_stream(fh, stats=stats, **options)
+        self.assertEqual(2, stats.conversions)
+        self.assertEqual(2 * len(canvases), stats.counts['pages'])
+
+    def test_memo_counts(self):
+        """Check that the hits and misses of the memos in each conversion are counted."""
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        lines = [line['resource']['cnt:chars'] for canvas in d_json['sequences'][0]['canvases']
+                 for line in canvas['otherContent'][0]['resources']]
+        seen = []
+        from_sc(d_json, text_filter=helpers.tpen_filter, memoize=True, stats=seen.append)
+        counts = seen[0].counts
+        self.assertEqual(len(set(lines)), counts['text_filter_misses'])
+        self.assertEqual(len(lines) - len(set(lines)), counts['text_filter_hits'])
+        self.assertNotIn('numeric_parser_hits', counts)
+
+        # With a Converter, each conversion has its own figures.
+        converter = Converter(text_filter=helpers.tpen_filter, memoize=True, stats=seen.append)
+        converter.convert(d_json)
+        converter.convert(d_json)
+        self.assertEqual(counts, seen[1].counts)
+        self.assertEqual(0, seen[2].counts['text_filter_misses'])
+        self.assertEqual(len(lines), seen[2].counts['text_filter_hits'])
+        self.assertEqual(converter.memo_stats()['text_filter'].hits,
+                         seen[1].counts['text_filter_hits'] + seen[2].counts['text_filter_hits'])
+        # Without the memo there is nothing to count.
+        from_sc(d_json, text_filter=helpers.tpen_filter, stats=seen.append)
+        self.assertNotIn('text_filter_hits', seen[3].counts)
+
+    def test_callback(self):
+        """Check that a callback gets the figures for each conversion, even one
+        that fails."""
+        seen = []
+        converter = Converter(special_chars=self.glyphs, stats=seen.append)
+        converter.convert(helpers.load_JSON_file(self.testfiles['json']))
+        self.assertEqual(1, len(seen))
+        self.assertIsInstance(seen[0], ConversionStats)
+        self.assertEqual(1, seen[0].as_dict()['conversions'])
+
+        with redirect_stderr(io.StringIO()):
+            self.assertIsNone(converter.convert(helpers.load_JSON_file(self.testfiles['broken'])))
+        self.assertEqual(2, len(seen))
+        self.assertEqual(0, seen[1].times['fixup'])
+
+        # Stats given to convert are used instead of the converter's.
+        stats = ConversionStats()
+        converter.convert(helpers.load_JSON_file(self.testfiles['json']), stats=stats)
+        self.assertEqual(2, len(seen))
+        self.assertEqual(1, stats.conversions)
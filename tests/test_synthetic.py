@@ -0,0 +1,32 @@
+import unittest
+
+from tpen2tei.parse import from_sc
+from tpen2tei.synthetic import numeric_parser, synthetic_manifest
+
+__author__ = 'tla'
+
+NS = {'t': 'http://www.tei-c.org/ns/1.0'}
+
+
+class Test(unittest.TestCase):
+
+    def test_synthetic_manifest(self):
+        """Check that a synthetic manuscript converts, with everything in it
+        that was asked for."""
+        ms = synthetic_manifest(pages=6, lines=20, columns=2, markup=0.3, notes=0.2, members=2)
+        self.assertEqual(ms, synthetic_manifest(pages=6, lines=20, columns=2, markup=0.3, notes=0.2,
+                                                members=2))
+        xmltree = from_sc(ms.manifest, members=ms.members, special_chars=ms.special_chars,
+                          numeric_parser=numeric_parser)
+        self.assertEqual(6, len(xmltree.xpath('//t:body//t:pb', namespaces=NS)))
+        self.assertEqual(120, len(xmltree.xpath('//t:body//t:lb', namespaces=NS)))
+        self.assertEqual(12, len(xmltree.xpath('//t:body//t:cb', namespaces=NS)))
+        self.assertEqual(1, len(xmltree.xpath('//t:body/t:p', namespaces=NS)))
+        self.assertEqual(2, len(xmltree.xpath('//t:editionStmt/t:respStmt', namespaces=NS)))
+        for tag in ('g', 'num', 'del', 'abbr', 'note'):
+            self.assertTrue(xmltree.xpath('//t:body//t:%s' % tag, namespaces=NS), tag)
+        for g in xmltree.xpath('//t:body//t:g', namespaces=NS):
+            self.assertTrue(g.get('ref').startswith('#'))
+        for num in xmltree.xpath('//t:body//t:num', namespaces=NS):
+            self.assertGreater(int(num.get('value')), 0)
+        self.assertNotEqual(ms, synthetic_manifest(pages=6, lines=20, columns=2, seed=1))
@@ -0,0 +1,97 @@
+import unittest
+
+from tpen2tei.parse import from_sc
+from tpen2tei.textfilter import TextFilter, _compile
+from config import config as config
+from lxml import etree
+import helpers
+import random
+import re
+from unittest import mock
+
+__author__ = 'tla'
+
+# The same replacements as helpers.tpen_filter
+TPEN_RULES = [('chars', {'_': '֊', '“': '"', '”': '"', ',': '.', '։': ':'}),
+              ('replace', '<p/>', '</p><p>')]
+
+
+def one_by_one(rules, text):
+    """Carry out the rules as a chain of replace and sub calls."""
+    for rule in rules:
+        if rule[0] == 'chars':
+            for old, new in rule[1].items():
+                text = text.replace(old, new)
+        elif rule[0] == 'replace':
+            text = text.replace(rule[1], rule[2])
+        else:
+            text = re.sub(rule[1], rule[2], text)
+    return text
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+
+    def test_tpen_rules(self):
+        """Check that the rules do what tpen_filter does, with a single translate and sub."""
+        text_filter = TextFilter(TPEN_RULES)
+        self.assertEqual(1, len(_compile(text_filter.rules)[0]))
+        for key in ('json', 'm3519', 'legacy'):
+            d_json = helpers.load_JSON_file(self.testfiles[key])
+            lines = [line['resource']['cnt:chars'] for canvas in d_json['sequences'][0]['canvases']
+                     for line in canvas['otherContent'][0]['resources']]
+            self.assertEqual([helpers.tpen_filter(t) for t in lines], [text_filter(t) for t in lines])
+            self.assertEqual([helpers.tpen_filter(t) for t in lines], TextFilter(TPEN_RULES).lines(lines))
+
+    def test_from_sc(self):
+        """Check that from_sc takes the rules in place of a function."""
+        d_json = helpers.load_JSON_file(self.testfiles['m3519'])
+        expected = etree.tostring(from_sc(d_json, special_chars=self.glyphs, text_filter=helpers.tpen_filter))
+        for text_filter in (TPEN_RULES, TextFilter(TPEN_RULES, whole_page=False)):
+            for memoize in (None, True):
+                xmltree = from_sc(d_json, special_chars=self.glyphs, text_filter=text_filter, memoize=memoize)
+                self.assertEqual(expected, etree.tostring(xmltree))
+
+    def test_order(self):
+        """Check that any rules give the same result as when they are done one by one,
+        however they are compiled."""
+        for minimum in (1, 3, None):
+            if minimum is None:
+                self.check_order(random.Random(3))
+                continue
+            with mock.patch('tpen2tei.textfilter._TRANSLATE_MIN', minimum), \
+                    mock.patch('tpen2tei.textfilter._ALTERNATION_MIN', minimum):
+                self.check_order(random.Random(minimum))
+
+    def check_order(self, rng):
+        alphabet = 'abc_\n'
+        for _ in range(300):
+            rules = []
+            for _ in range(rng.randint(1, 8)):
+                kind = rng.random()
+                old = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+                new = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 2)))
+                if kind < 0.3:
+                    rules.append(('chars', {old[0]: new}))
+                elif kind < 0.9:
+                    rules.append(('replace', old, new))
+                else:
+                    rules.append(('sub', re.escape(old) + '+', new))
+            text_filter = TextFilter(rules, whole_page=False)
+            paged = TextFilter(rules)
+            lines = [''.join(rng.choice('abc_') for _ in range(rng.randint(0, 12))) for _ in range(4)]
+            for text in lines + ['\n'.join(lines)]:
+                self.assertEqual(one_by_one(rules, text), text_filter(text), (rules, text))
+            self.assertEqual([one_by_one(rules, t) for t in lines], paged.lines(lines), (rules, lines))
+
+    def test_bad_rules(self):
+        with self.assertRaises(ValueError):
+            TextFilter([('replace', '', 'x')])
+        with self.assertRaises(ValueError):
+            TextFilter([('chars', {'ab': 'x'})])
+        with self.assertRaises(ValueError):
+            TextFilter([('translate', 'a', 'b')])
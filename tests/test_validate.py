@@ -0,0 +1,100 @@
+import unittest
+
+from tpen2tei.batch import convert_batch
+from tpen2tei.parse import from_sc
+from tpen2tei.validate import load_schema, validate, validate_files
+from config import config as config
+from lxml import etree
+import helpers
+import os
+import tempfile
+
+__author__ = 'tla'
+
+# A schema that allows anything at all, except an add element without a place.
+ADD_PLACE = """<grammar xmlns="http://relaxng.org/ns/structure/1.0">
+  <start><ref name="any"/></start>
+  <define name="any">
+    <element>
+      <anyName><except><name ns="http://www.tei-c.org/ns/1.0">add</name></except></anyName>
+      <zeroOrMore><attribute><anyName/></attribute></zeroOrMore>
+      <ref name="content"/>
+    </element>
+  </define>
+  <define name="add">
+    <element name="add" ns="http://www.tei-c.org/ns/1.0">
+      <attribute name="place"/>
+      <ref name="content"/>
+    </element>
+  </define>
+  <define name="content">
+    <mixed><zeroOrMore><choice><ref name="any"/><ref name="add"/></choice></zeroOrMore></mixed>
+  </define>
+</grammar>
+"""
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.schema = os.path.join(self.tmpdir.name, 'add_place.rng')
+        with open(self.schema, 'w') as fh:
+            fh.write(ADD_PLACE)
+
+    def test_validate(self):
+        """Check that validation errors are located by page and line, and that the
+        schema is compiled only once."""
+        self.assertIs(load_schema(self.schema), load_schema(self.schema))
+        xmltree = from_sc(helpers.load_JSON_file(self.testfiles['json']), special_chars=self.glyphs,
+                          text_filter=helpers.tpen_filter)
+        diagnostics = validate(xmltree, self.schema)
+        errors = diagnostics.errors()
+        self.assertGreater(len(errors), 0)
+        self.assertEqual({'schema-invalid'}, {d.code for d in errors})
+
+        # Each error about an add is on the page and line of an add that has no place.
+        document = etree.tostring(xmltree, encoding='utf-8', pretty_print=True, xml_declaration=True)
+        reparsed = etree.fromstring(document)
+        adds = reparsed.xpath('//t:add[not(@place)]', namespaces={'t': 'http://www.tei-c.org/ns/1.0'})
+        located = [loc for d in errors if d.message.startswith('Element add') for loc in d.locations]
+        self.assertGreater(len(located), 0)
+        for location in located:
+            add = [a for a in adds if a.sourceline == location['xml_line']]
+            self.assertEqual(1, len(add))
+            self.assertEqual(add[0].xpath('preceding::*[local-name()="pb"][1]/@n')[0], location['page'])
+            self.assertEqual(add[0].xpath('preceding::*[local-name()="lb"][1]/@n')[0], location['n'])
+        self.assertEqual(len(diagnostics), len(validate(document, load_schema(self.schema))))
+
+        # A document in which every add has a place is valid.
+        for add in xmltree.getroot().iter('{http://www.tei-c.org/ns/1.0}add'):
+            add.set('place', 'inline')
+        self.assertEqual([], validate(xmltree, self.schema).errors())
+
+    def test_validate_batch(self):
+        """Check that a batch validates its outputs in the workers, and that files
+        can be validated in parallel."""
+        outdir = os.path.join(self.tmpdir.name, 'out')
+        results = convert_batch([self.testfiles['json'], self.testfiles['m3519']], outdir, workers=2,
+                                special_chars='helpers:armenian_glyphs', text_filter='helpers:tpen_filter',
+                                schema=self.schema)
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertRegex(result.messages, 'ERROR: Element add')
+        validated = validate_files([r.outfile for r in results], self.schema, workers=2)
+        self.assertEqual([r.outfile for r in results], [v.path for v in validated])
+        for v in validated:
+            self.assertFalse(v.valid)
+            self.assertIn('page', v.diagnostics[0].locations[0])
+
+        # A file that cannot be read is reported, and the rest still validated.
+        missing = os.path.join(self.tmpdir.name, 'missing.xml')
+        for workers in (1, 2):
+            validated = validate_files([missing, results[0].outfile], self.schema, workers=workers)
+            self.assertEqual([False, False], [v.valid for v in validated])
+            self.assertEqual('unreadable', validated[0].diagnostics[0].code)
+            self.assertEqual('schema-invalid', validated[1].diagnostics[0].code)
@@ -0,0 +1,72 @@
+import unittest
+
+from tpen2tei.parse import from_sc
+from tpen2tei.watch import Watcher
+from config import config as config
+from lxml import etree
+import helpers
+import os
+import shutil
+import tempfile
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_watch(self):
+        """Check that only manifests whose content has changed are converted, once
+        they have settled."""
+        manifest = os.path.join(self.tmpdir.name, 'M1731.json')
+        outfile = os.path.join(self.tmpdir.name, 'M1731.xml')
+        shutil.copy(self.testfiles['json'], manifest)
+        watcher = Watcher(self.tmpdir.name, debounce=0, special_chars=self.glyphs,
+                          numeric_parser=helpers.armenian_numbers, text_filter=helpers.tpen_filter)
+        results = watcher.poll()
+        self.assertEqual([manifest], [r.infile for r in results])
+        self.assertTrue(results[0].ok)
+        self.assertEqual(outfile, results[0].outfile)
+        expected = from_sc(helpers.load_JSON_file(self.testfiles['json']), special_chars=self.glyphs,
+                           numeric_parser=helpers.armenian_numbers, text_filter=helpers.tpen_filter)
+        with open(outfile, 'rb') as fh:
+            self.assertEqual(etree.tostring(expected, encoding='utf-8', pretty_print=True, xml_declaration=True),
+                             fh.read())
+        self.assertEqual([], watcher.poll())
+
+        # Saving the same content again does not count as a change.
+        st = os.stat(manifest)
+        os.utime(manifest, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual([], watcher.poll())
+
+        # A change waits for the debounce period.
+        with open(manifest, 'ab') as fh:
+            fh.write(b'\n')
+        watcher.debounce = 60
+        self.assertEqual([], watcher.poll())
+        watcher.debounce = 0
+        results = watcher.poll()
+        self.assertEqual(1, len(results))
+        self.assertTrue(results[0].ok)
+        self.assertEqual([], [f for f in os.listdir(self.tmpdir.name) if f.endswith('.tmp')])
+
+    def test_start(self):
+        """Check that a Watcher leaves alone the outputs that are up to date when it
+        starts, and reports a manifest that fails only once."""
+        shutil.copy(self.testfiles['broken'], self.tmpdir.name)
+        manifest = os.path.join(self.tmpdir.name, os.path.basename(self.testfiles['broken']))
+        shutil.copy(self.testfiles['json'], self.tmpdir.name)
+        with open(os.path.join(self.tmpdir.name, 'M1731.xml'), 'w') as fh:
+            fh.write('<TEI/>')
+        watcher = Watcher(self.tmpdir.name, debounce=0)
+        results = watcher.poll()
+        self.assertEqual([manifest], [r.infile for r in results])
+        self.assertFalse(results[0].ok)
+        self.assertRegex(results[0].messages, 'Parsing error in the JSON')
+        self.assertEqual([], watcher.poll())
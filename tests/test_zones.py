@@ -0,0 +1,73 @@
+import unittest
+
+from tpen2tei.parse import from_sc
+from tpen2tei.synthetic import synthetic_manifest
+from tpen2tei.zones import FacsimileIndex, SurfaceIndex, _distance
+from config import config as config
+import helpers
+import io
+import random
+
+__author__ = 'tla'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        settings = config()
+        self.testfiles = settings['testfiles']
+        self.glyphs = helpers.glyph_struct(settings['armenian_glyphs'])
+
+    def check_surface(self, surface, rng):
+        """Compare the lookups of the index with a scan over all the zones."""
+        for _ in range(200):
+            x, y = rng.randint(-20, surface.width + 20), rng.randint(-20, surface.height + 20)
+            self.assertEqual([z for z in surface.zones if z.ulx <= x <= z.lrx and z.uly <= y <= z.lry],
+                             surface.point(x, y))
+            nearest = min(range(len(surface.zones)), key=lambda i: (_distance(surface.zones[i], x, y), i))
+            self.assertEqual(surface.zones[nearest], surface.nearest(x, y))
+            ulx, uly = rng.randint(0, surface.width), rng.randint(0, surface.height)
+            lrx, lry = ulx + rng.randint(0, 300), uly + rng.randint(0, 300)
+            self.assertEqual([z for z in surface.zones if z.ulx <= lrx and ulx <= z.lrx
+                              and z.uly <= lry and uly <= z.lry], surface.rectangle(ulx, uly, lrx, lry))
+
+    def test_zone_index(self):
+        """Check that the converter's zone index gives the same answers as a linear
+        scan, and is the same as the one made from the TEI."""
+        indexes = []
+        xmltree = from_sc(helpers.load_JSON_file(self.testfiles['m3519']), special_chars=self.glyphs,
+                          text_filter=helpers.tpen_filter, zone_index=indexes.append)
+        self.assertEqual(1, len(indexes))
+        index = indexes[0]
+        self.assertEqual(len(xmltree.xpath('//t:surface', namespaces={'t': 'http://www.tei-c.org/ns/1.0'})),
+                         len(index))
+        self.assertEqual(FacsimileIndex.from_tei(xmltree).as_dict(), index.as_dict())
+        rng = random.Random(1)
+        for surface in index:
+            self.check_surface(surface, rng)
+
+        # A line is found by a point in it, and its id is that of its lb.
+        surface = next(iter(index))
+        zone = surface.zones[3]
+        self.assertIn(zone, surface.point((zone.ulx + zone.lrx) // 2, (zone.uly + zone.lry) // 2))
+        self.assertEqual(1, len(xmltree.xpath('//t:lb[@xml:id="l%s"]' % zone.id,
+                                              namespaces={'t': 'http://www.tei-c.org/ns/1.0'})))
+
+        # The sidecar gives back the same index.
+        with io.StringIO() as fh:
+            index.dump(fh)
+            fh.seek(0)
+            loaded = FacsimileIndex.load(fh)
+        self.assertEqual(index.as_dict(), loaded.as_dict())
+        self.assertEqual(surface.zones[:5], loaded[surface.graphic].rectangle(0, 0, surface.width, zone.lry))
+
+    def test_columns(self):
+        """Check the lookups on pages of many lines in several columns."""
+        indexes = []
+        ms = synthetic_manifest(pages=2, lines=200, columns=3)
+        from_sc(ms.manifest, members=ms.members, special_chars=ms.special_chars, zone_index=indexes.append)
+        rng = random.Random(2)
+        for surface in indexes[0]:
+            self.assertEqual(200, len(surface.zones))
+            self.check_surface(surface, rng)
+        self.assertIsNone(SurfaceIndex('empty', 100, 100, []).nearest(1, 1))
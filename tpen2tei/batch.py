@@ -0,0 +1,406 @@
+import argparse
+import glob
+import importlib
+import io
+import os
+import sys
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from functools import lru_cache
+from tpen2tei.diagnostics import Diagnostics
+from tpen2tei.stats import ConversionStats
+from tpen2tei.manifest import JSON_BACKENDS
+from tpen2tei.cache import DiskCache, cache_key
+from tpen2tei.compression import SUFFIXES, open_input, strip_suffix
+from tpen2tei.journal import Journal, file_digest
+from tpen2tei.parse import _MEMO_SIZE, Converter, GlyphRegistry, _memoized
+from tpen2tei.validate import load_schema, validate
+
+__author__ = 'tla'
+
+# The outcome of converting one file; stats is the as_dict() of its
+# ConversionStats, or None if it was not converted in this run.
+BatchResult = namedtuple('BatchResult', ['infile', 'outfile', 'ok', 'messages', 'stats'], defaults=(None,))
+
+
+def convert_batch(inputs, outdir, workers=None, metadata=None, members=None, special_chars=None,
+                  numeric_parser=None, text_filter=None, postprocess=None, page_errors=None, rules=None,
+                  memoize=None, json_backend=None, output_cache=None, schema=None, journal=None, retries=0,
+                  backoff=1.0, quarantine=3):
+    """Convert many SC-JSON files to TEI XML files in outdir, using a pool of
+    worker processes. The inputs may be file names, glob patterns, or
+    directories (whose .json files are converted); each input file is written
+    to outdir under the same name with the extension .xml.
+
+    The members, special_chars, numeric_parser, text_filter, postprocess, and
+    rules options are as for from_sc, except that they must be given as importable
+    dotted paths (e.g. 'mypackage.hooks:tpen_filter') so that each worker can
+    load them. A path to members or special_chars may name either the dictionary
+    itself or a function that returns it. The metadata dictionary is copied to
+    each conversion. With the page_errors option, also as for from_sc, a typo on
+    one page does not cost the whole manuscript. With the memoize option, each
+    worker remembers the results of numeric_parser and text_filter for all the
+    files that it converts. The json_backend option is as for from_sc_stream.
+    If output_cache is the name of a directory, the converted documents are
+    kept there, and a file that has not changed since it was last converted
+    with the same options is simply copied from it; the workers can all share
+    the one directory. If schema is the local path to a RelaxNG schema, such as
+    tei_all.rng, each converted document is validated against it; each worker
+    compiles the schema only once, and the validation errors, with their pages
+    and lines, are in the messages of the results.
+
+    A file whose conversion fails is tried again up to retries more times, after
+    waiting backoff seconds, then twice that, and so on; this is also what
+    happens to the files that were being converted when a worker died, e.g. for
+    want of memory. If journal is the name of a file, the outcome of every
+    conversion is recorded in it (see tpen2tei.journal.Journal), and when the
+    batch is run again with the same journal, the files that were converted
+    with the same content and options are not converted again, and their
+    results say so. A file that has failed quarantine times with the same
+    content and options is not tried again until it changes.
+
+    If workers is 1 the conversions are done in this process; if it is None
+    the pool has as many workers as there are CPUs. Returns a list of
+    BatchResult tuples, in the order of the sorted input files, whether or not
+    each conversion succeeded. Any errors or warnings that a conversion produces
+    are in the messages of its result, and its figures, such as the hits and
+    misses of the memos with the memoize option, are in its stats;
+    batch_stats adds them up for the whole batch."""
+    infiles = expand_inputs(inputs)
+    hooks = {'members': members, 'special_chars': special_chars, 'numeric_parser': numeric_parser,
+             'text_filter': text_filter, 'postprocess': postprocess, 'rules': rules}
+    # Check the hooks here, so that a typo fails once rather than in every worker.
+    for path in hooks.values():
+        if path is not None:
+            resolve_hook(path)
+    if schema is not None:
+        load_schema(schema)
+    os.makedirs(outdir, exist_ok=True)
+    if journal is not None:
+        journal = Journal(journal)
+    try:
+        return _run_batch(infiles, outdir, metadata, hooks, page_errors, memoize, json_backend, output_cache,
+                          schema, workers, journal, retries, backoff, quarantine)
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _run_batch(infiles, outdir, metadata, hooks, page_errors, memoize, json_backend, output_cache, schema,
+               workers, journal, retries, backoff, quarantine):
+    options = cache_key('batch', metadata, hooks, page_errors, memoize, json_backend, schema)
+    results = {}
+    jobs = []
+    digests = {}
+    outfiles = set()
+    for infile in infiles:
+        name = strip_suffix(os.path.basename(infile))
+        outfile = os.path.join(outdir, os.path.splitext(name)[0] + '.xml')
+        # Two inputs with the same name would overwrite each other's output.
+        job = (infile, None if outfile in outfiles else outfile, metadata, hooks, page_errors, memoize,
+               json_backend, output_cache, schema)
+        outfiles.add(outfile)
+        if journal is not None and outfile == job[1]:
+            digests[infile] = file_digest(infile)
+            done, failures = journal.lookup(infile, digests[infile], options)
+            if done == outfile:
+                results[infile] = BatchResult(infile, outfile, True, 'Converted in an earlier run\n')
+                continue
+            if failures >= quarantine:
+                results[infile] = BatchResult(infile, None, False,
+                                              'Quarantined after failing %d times\n' % failures)
+                continue
+        jobs.append(job)
+    attempt = 0
+    while jobs:
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        failed = []
+        for job, result in _run_jobs(jobs, workers):
+            results[job[0]] = result
+            if job[1] is None:
+                continue
+            if journal is not None:
+                journal.record(job[0], digests[job[0]], options, result)
+                if journal.lookup(job[0], digests[job[0]], options)[1] >= quarantine:
+                    continue
+            if not result.ok:
+                failed.append(job)
+        attempt += 1
+        jobs = failed if attempt <= retries else []
+    return [results[infile] for infile in infiles]
+
+
+def _run_jobs(jobs, workers):
+    """Yield each job with its result as it is finished. Only as many jobs as
+    there are workers are handed to the pool at a time, so that if a worker
+    dies, only the jobs that were under way fail; the rest are done by a new
+    pool."""
+    if workers == 1:
+        for job in jobs:
+            yield job, _convert_job(job)
+        return
+    workers = workers or os.cpu_count() or 1
+    waiting = deque(jobs)
+    while waiting:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            broken = False
+            while waiting or running:
+                while waiting and not broken and len(running) < workers:
+                    job = waiting.popleft()
+                    running[executor.submit(_convert_job, job)] = job
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                        result = BatchResult(job[0], None, False, 'The worker failed: %s: %s\n' % (
+                            e.__class__.__name__, e))
+                    yield job, result
+
+
+def expand_inputs(inputs):
+    """Returns the sorted list of files named by the given file names, glob
+    patterns, and directories. A directory gives its SC-JSON files, whether
+    or not they are compressed."""
+    infiles = set()
+    for spec in inputs:
+        if os.path.isdir(spec):
+            for pattern in ('*.json',) + tuple('*.json' + suffix for suffix in SUFFIXES):
+                infiles.update(f for f in glob.glob(os.path.join(spec, pattern)) if os.path.isfile(f))
+        elif os.path.isfile(spec):
+            infiles.add(spec)
+        else:
+            infiles.update(f for f in glob.glob(spec) if os.path.isfile(f))
+    return sorted(infiles)
+
+
+@lru_cache(maxsize=None)
+def resolve_hook(path):
+    """Returns the object named by a dotted path, which is either of the form
+    'package.module:name' or 'package.module.name'. Each process only needs to
+    import it once."""
+    if ':' in path:
+        modname, attr = path.split(':', 1)
+    else:
+        modname, _, attr = path.rpartition('.')
+    if not modname or not attr:
+        raise ValueError("Hook %s is not of the form 'package.module:name'" % path)
+    obj = importlib.import_module(modname)
+    for part in attr.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+@lru_cache(maxsize=None)
+def _resolve_table(path):
+    # A table may be given either as the dictionary, or as a function that makes it.
+    table = resolve_hook(path)
+    if callable(table):
+        table = table()
+    return table
+
+
+@lru_cache(maxsize=None)
+def _resolve_registry(path):
+    # Each worker only needs to work out the glyphs once, for all its files.
+    return GlyphRegistry(_resolve_table(path))
+
+
+def resolve_options(hooks, memoize=None):
+    """Returns the options for from_sc from a dictionary of the dotted paths to
+    them, such as convert_batch takes. The glyph registry and members table for
+    each path are made only once, and so are the memos of numeric_parser and
+    text_filter with the memoize option."""
+    options = {}
+    for key, path in hooks.items():
+        if path is None:
+            continue
+        if key == 'special_chars':
+            options[key] = _resolve_registry(path)
+        elif key == 'members':
+            options[key] = _resolve_table(path)
+        elif memoize and key in ('numeric_parser', 'text_filter'):
+            options[key] = _resolve_memoized(path, memoize)
+        else:
+            options[key] = resolve_hook(path)
+    return options
+
+
+@lru_cache(maxsize=None)
+def _resolve_memoized(path, memoize):
+    # The same memo serves all the files that the worker converts.
+    return _memoized(resolve_hook(path), _MEMO_SIZE if memoize is True else memoize)
+
+
+def _convert_job(job):
+    """Convert a single file in a worker, catching whatever goes wrong so that
+    the rest of the batch is not affected."""
+    infile, outfile, metadata, hooks, page_errors, memoize, json_backend, output_cache, schema = job
+    if outfile is None:
+        return BatchResult(infile, None, False, 'Another input has the same name as this one')
+    messages = io.StringIO()
+    diagnostics = Diagnostics()
+    stats = ConversionStats()
+    ok = False
+    try:
+        with redirect_stdout(messages), redirect_stderr(messages):
+            options = resolve_options(hooks, memoize)
+            converter = Converter(metadata=metadata, page_errors=page_errors, json_backend=json_backend,
+                                  diagnostics=diagnostics, stats=stats,
+                                  output_cache=None if output_cache is None else DiskCache(output_cache),
+                                  **options)
+            with open_input(infile) as jfile:
+                document = converter.convert_to_xml(jfile)
+        if document is not None:
+            _write_atomic(outfile, document)
+            ok = True
+            if schema is not None:
+                validate(document, load_schema(schema), diagnostics)
+    except Exception as e:
+        messages.write("%s: %s\n" % (e.__class__.__name__, e))
+    # Each kind of problem is reported once, however often it happened.
+    diagnostics.report(messages)
+    # A ConversionStats does not go between processes, but its contents do.
+    return BatchResult(infile, outfile if ok else None, ok, messages.getvalue(), stats.as_dict())
+
+
+def batch_stats(results):
+    """Returns a ConversionStats with the figures of all the conversions in the
+    given batch results put together."""
+    total = ConversionStats()
+    for result in results:
+        if result.stats is not None:
+            total.add(ConversionStats.from_dict(result.stats))
+    return total
+
+
+def _write_atomic(outfile, data):
+    # Write to a temporary file first, so that a failed or interrupted run never
+    # leaves half an output file behind.
+    tmpfile = '%s.%d.tmp' % (outfile, os.getpid())
+    try:
+        with open(tmpfile, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert many SC-JSON files to TEI XML in parallel.')
+    parser.add_argument(
+        "-o", "--outdir",
+        required=True,
+        help="Directory to write the TEI XML files to",
+    )
+    parser.add_argument(
+        "-j", "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "-t", "--title",
+        default="A text generated by tpen2tei",
+        help="Title that should be passed to the texts",
+    )
+    parser.add_argument(
+        "--short-error",
+        action="store_true",
+        help="Reduce the amount of error output on XML parsing failures"
+    )
+    parser.add_argument(
+        "--memoize",
+        action="store_true",
+        help="Remember the results of the numeric parser and text filter across files",
+    )
+    parser.add_argument(
+        "--page-errors",
+        choices=['skip', 'wrap'],
+        help="Skip, or keep with the markup escaped, any page that is not well-formed, instead of failing"
+    )
+    parser.add_argument(
+        "--output-cache",
+        metavar="DIR",
+        help="Directory in which to keep converted documents, so that unchanged files are not converted again",
+    )
+    parser.add_argument(
+        "--schema",
+        metavar="RNG",
+        help="Local path to a RelaxNG schema, e.g. tei_all.rng, against which to validate each output",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="FILE",
+        help="Record each conversion in this file, and skip the files that it says are done",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="Number of times to try a failed conversion again",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1.0,
+        help="Seconds to wait before the first retry, doubled for each one after",
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=int,
+        default=3,
+        help="Number of failures, over all runs with the journal, after which a file is no longer tried",
+    )
+    parser.add_argument(
+        "--json-backend",
+        choices=JSON_BACKENDS,
+        help="Decode each manifest at once with this JSON library, rather than page by page"
+    )
+    for hook in ['members', 'special-chars', 'numeric-parser', 'text-filter', 'postprocess', 'rules']:
+        parser.add_argument(
+            "--%s" % hook,
+            metavar="MODULE:NAME",
+            help="Dotted path to the %s option for from_sc" % hook.replace('-', '_'),
+        )
+    parser.add_argument(
+        "inputs",
+        nargs='+',
+        help="SC-JSON files, glob patterns, or directories containing T-PEN transcriptions",
+    )
+    args = parser.parse_args()
+    results = convert_batch(args.inputs, args.outdir, workers=args.workers,
+                            metadata={'title': args.title, 'short_error': args.short_error},
+                            members=args.members, special_chars=args.special_chars,
+                            numeric_parser=args.numeric_parser, text_filter=args.text_filter,
+                            postprocess=args.postprocess, page_errors=args.page_errors,
+                            rules=args.rules, memoize=args.memoize, json_backend=args.json_backend,
+                            output_cache=args.output_cache, schema=args.schema, journal=args.journal,
+                            retries=args.retries, backoff=args.backoff, quarantine=args.quarantine)
+    failures = 0
+    for result in results:
+        if result.ok:
+            print("%s -> %s" % (result.infile, result.outfile), file=sys.stderr)
+        else:
+            failures += 1
+            print("%s: FAILED" % result.infile, file=sys.stderr)
+        if result.messages:
+            print(result.messages.rstrip('\n'), file=sys.stderr)
+    print("%d of %d files converted" % (len(results) - failures, len(results)), file=sys.stderr)
+    if args.memoize:
+        counts = batch_stats(results).counts
+        for hook in ('numeric_parser', 'text_filter'):
+            if hook + '_hits' in counts:
+                print("%s memo: %d hits, %d misses" % (hook, counts[hook + '_hits'], counts[hook + '_misses']),
+                      file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,236 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import types
+from collections import namedtuple
+
+__author__ = 'tla'
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'writes', 'evictions', 'size'])
+
+# A memory address in a repr, which differs from one process to the next
+_ADDRESS = re.compile(r'\b0x[0-9a-fA-F]+')
+
+
+class FingerprintError(TypeError):
+    """Raised by fingerprint for a value that it cannot identify in the same
+    way from one run to the next, so that it cannot be part of a cache key."""
+
+
+class DiskCache:
+    """A size-bounded on-disk store of byte strings, keyed by the hex digests
+    that cache_key returns. Entries are written atomically, so that several
+    processes can share one cache directory, and the least recently used
+    entries are removed once the cache grows beyond max_size bytes.
+
+    The counters of hits, misses, writes and evictions are for this instance
+    only; stats() returns them as a CacheStats tuple. An instance can be used
+    by several threads at once."""
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the data stored under the given key, or None if there is none."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        # The modification time is what eviction goes by, so mark the entry as used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store the given bytes under the given key, evicting older entries if
+        the cache has grown too large."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmpfile, path)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        with self._lock:
+            self.writes += 1
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += len(data)
+            full = self._size > self.max_size
+        if full:
+            # Make some room, so that we don't have to scan the directory on every write.
+            self.evict(self.max_size * 9 // 10)
+
+    def evict(self, max_size=None):
+        """Remove the least recently used entries until the cache holds no more
+        than max_size bytes (by default, the size it was created with)."""
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._entries())
+        total = sum(e[2] for e in entries)
+        evicted = 0
+        for _, path, size in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.evictions += evicted
+            self._size = total
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        self.evict(0)
+
+    def size(self):
+        """Returns the number of bytes held in the cache."""
+        return sum(e[2] for e in self._entries())
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.writes, self.evictions, self.size())
+
+    def _path(self, key):
+        # Spread the entries over subdirectories, so that none of them gets too big.
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for fn in filenames:
+                if fn.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        return entries
+
+
+def cache_key(*parts):
+    """Returns a hex digest that identifies the given values, which may be
+    anything that fingerprint understands."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(_canonical(fingerprint(part)).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def fingerprint(obj):
+    """Returns a JSON-serializable value that stands for the given object, for
+    use in a cache key. Dictionaries are taken independently of their order.
+    Functions are identified by their name and a digest of their code, along
+    with their default arguments, the values of any variables that they close
+    over, and a digest of the source file of their module; this is how the
+    conversion options such as text_filter are told apart from one run to the
+    next. A change to a function in another module that the function calls is
+    not seen, so the cache should be cleared when such helpers change.
+
+    Any other object is identified by its repr, which must then not depend on
+    where it is in memory; if it does, FingerprintError is raised."""
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if isinstance(obj, dict):
+        return {'dict': sorted(([fingerprint(k), fingerprint(v)] for k, v in obj.items()), key=_canonical)}
+    if isinstance(obj, (list, tuple)):
+        return [fingerprint(x) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return {'set': sorted((fingerprint(x) for x in obj), key=_canonical)}
+    if hasattr(obj, '__wrapped__') and hasattr(obj, 'cache_info'):
+        # A memoized function does the same as the function itself.
+        return fingerprint(obj.__wrapped__)
+    if isinstance(obj, types.FunctionType):
+        closure = [_cell_value(c, obj) for c in obj.__closure__ or ()]
+        return {'function': '%s.%s' % (obj.__module__, obj.__qualname__),
+                'code': _code_digest(obj.__code__),
+                'module': _module_digest(obj.__module__),
+                'defaults': fingerprint(obj.__defaults__),
+                'kwdefaults': fingerprint(obj.__kwdefaults__),
+                'closure': fingerprint(closure)}
+    if isinstance(obj, types.MethodType):
+        return {'method': fingerprint(obj.__func__), 'self': fingerprint(obj.__self__)}
+    if isinstance(obj, functools.partial):
+        return {'partial': fingerprint(obj.func), 'args': fingerprint(obj.args),
+                'keywords': fingerprint(obj.keywords)}
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        # A builtin or a class, which is identified well enough by its name.
+        return {'callable': '%s.%s' % (getattr(obj, '__module__', None), obj.__qualname__)}
+    text = repr(obj)
+    if _ADDRESS.search(text):
+        raise FingerprintError('%s cannot be identified from one run to the next; give it a __repr__ '
+                               'that says what it does' % text)
+    return {'repr': text}
+
+
+def _cell_value(cell, func):
+    try:
+        value = cell.cell_contents
+    except ValueError:  # The variable has not been assigned yet.
+        return None
+    # A nested function that calls itself closes over itself.
+    return '<self>' if value is func else value
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def _module_digest(name):
+    """Returns a digest of the source file of the named module, or None if it
+    has none, as for code typed in at the interpreter."""
+    path = getattr(sys.modules.get(name), '__file__', None)
+    if path is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    return _file_digest(path, mtime)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, mtime):
+    with open(path, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def _code_digest(code):
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(_code_digest(const).encode('ascii'))
+        else:
+            digest.update(repr(const).encode('utf-8'))
+    digest.update(repr(code.co_names).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,99 @@
+import gzip
+import lzma
+import os
+from contextlib import nullcontext
+
+__author__ = 'tla'
+
+# The compressions that open_input recognizes and compressed_output writes,
+# with the magic bytes at the start of a file compressed with each.
+COMPRESSIONS = ('gzip', 'xz')
+_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'))
+# The file name suffixes that compressed files are usually given
+SUFFIXES = ('.gz', '.xz')
+
+
+def detect(fh):
+    """Returns the compression of what is to be read from the open binary file
+    handle fh, going by its first few bytes rather than its name, or None if it
+    is not compressed. The handle must have a peek method, as a BufferedReader
+    does; nothing is read from it, so this works as well on a pipe."""
+    head = fh.peek(max(len(magic) for magic, _ in _MAGIC))
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def strip_suffix(path):
+    """Returns the file name without any suffix that says it is compressed,
+    e.g. 'M1731.json' for 'M1731.json.gz'."""
+    base, ext = os.path.splitext(path)
+    return base if ext in SUFFIXES else path
+
+
+def open_input(source):
+    """Open the named file, or file descriptor, for reading in binary mode. If
+    it is compressed with gzip or xz, what is read is the decompressed data,
+    which is decompressed as it is read, so there is no need for a decompressed
+    copy on disk. The file is only opened once, so it may be a pipe."""
+    fh = open(source, 'rb')
+    try:
+        compression = detect(fh)
+    except BaseException:
+        fh.close()
+        raise
+    if compression == 'gzip':
+        return _GzipReader(fh)
+    if compression == 'xz':
+        return _XzReader(fh)
+    return fh
+
+
+def is_compressed(fh):
+    """Whether the open file handle decompresses what it reads, so that its
+    file descriptor does not give the data that it returns."""
+    return isinstance(fh, (gzip.GzipFile, lzma.LZMAFile))
+
+
+def compressed_output(fh, compression=None):
+    """Returns a context manager for a binary file handle that writes to the
+    open binary file handle fh, compressing what is written with the given
+    compression, if any. The compression is finished when the context is left,
+    but fh is not closed. Gzip output does not record a time, so the same
+    document is always compressed to the same bytes."""
+    if compression is None:
+        return nullcontext(fh)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fh, mode='wb', mtime=0)
+    if compression == 'xz':
+        return lzma.LZMAFile(fh, 'wb')
+    raise ValueError('Unknown compression %s; use one of %s' % (compression, ', '.join(COMPRESSIONS)))
+
+
+class _GzipReader(gzip.GzipFile):
+    """A GzipFile that reads from an open file handle, and closes it too."""
+
+    def __init__(self, fh):
+        super().__init__(fileobj=fh, mode='rb')
+        self._source = fh
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._source.close()
+
+
+class _XzReader(lzma.LZMAFile):
+    """An LZMAFile that reads from an open file handle, and closes it too."""
+
+    def __init__(self, fh):
+        super().__init__(fh, 'rb')
+        self._source = fh
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._source.close()
@@ -0,0 +1,113 @@
+import sys
+import threading
+from collections import namedtuple
+
+__author__ = 'tla'
+
+# One kind of problem that was found in a conversion: how many times it was
+# seen, and where (up to a limit); detail is what there was to say about the
+# first of them, such as the XML around a parsing error.
+Diagnostic = namedtuple('Diagnostic', ['level', 'code', 'message', 'count', 'locations', 'detail'])
+
+
+class Diagnostics:
+    """A collection of the warnings and errors from conversions, which can be
+    passed as the diagnostics option of from_sc or a Converter instead of
+    having them printed as they happen. Repeats of the same problem, such as
+    every line by a transcriber who is not in the members list, are counted
+    rather than kept separately, along with the first max_locations places
+    where they were seen.
+
+    The codes of the problems that tpen2tei reports are:
+
+      sequences       the manifest has more than one sequence
+      unknown-member  a line's transcriber is not in the members list
+      malformed-page  a page was skipped or escaped, with the page_errors option
+      unblocked-text  some text was not in any block, and was wrapped in an ab
+      numeric-parse   the numeric_parser could not give a number a value
+      xml-syntax      the transcription is not well-formed (an error)
+      unknown-glyph   a glyph is not in special_chars (an error)
+      schema-invalid  the document does not match the schema, with validate
+      unreadable      a file given to validate_files could not be read (an error)
+
+    A Diagnostics can collect the problems of several conversions, in several
+    threads at once."""
+
+    def __init__(self, max_locations=10):
+        self.max_locations = max_locations
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def warning(self, code, message, location=None, detail=None):
+        self.add('warning', code, message, location, detail)
+
+    def error(self, code, message, location=None, detail=None):
+        self.add('error', code, message, location, detail)
+
+    def add(self, level, code, message, location=None, detail=None):
+        """Record a problem. The location, if there is one, should be a dictionary
+        with whatever is known of e.g. the 'page' and 'line'."""
+        key = (level, code, message)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [0, [], detail]
+            entry[0] += 1
+            if location is not None and len(entry[1]) < self.max_locations:
+                entry[1].append(location)
+
+    def update(self, other):
+        """Add the problems collected by another Diagnostics to these ones."""
+        for diagnostic in other:
+            key = diagnostic[:3]
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = [0, [], diagnostic.detail]
+                entry[0] += diagnostic.count
+                entry[1].extend(diagnostic.locations[:self.max_locations - len(entry[1])])
+        return self
+
+    def __iter__(self):
+        """Iterate over the problems as Diagnostic tuples, in the order in which
+        they were first seen."""
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._entries.items()]
+        for (level, code, message), (count, locations, detail) in items:
+            yield Diagnostic(level, code, message, count, list(locations), detail)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def errors(self):
+        return [d for d in self if d.level == 'error']
+
+    def warnings(self):
+        return [d for d in self if d.level == 'warning']
+
+    def as_list(self):
+        """Returns the problems as a list of dictionaries, e.g. for JSON output."""
+        return [d._asdict() for d in self]
+
+    def report(self, file=None):
+        """Print each problem once, with the number of times it was seen, to the
+        given file (by default stderr)."""
+        if file is None:
+            file = sys.stderr
+        for d in self:
+            line = '%s: %s' % (d.level.upper(), d.message)
+            if d.count > 1:
+                line += ' (%d times)' % d.count
+            print(line, file=file)
+            if d.detail:
+                print(d.detail, file=file)
+
+
+def deliver(diagnostics, target):
+    """Pass the problems of a finished conversion to the target that was given
+    as the diagnostics option: add them to it if it is a Diagnostics, and
+    otherwise call it with them."""
+    if isinstance(target, Diagnostics):
+        target.update(diagnostics)
+    else:
+        target(diagnostics)
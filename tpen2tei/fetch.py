@@ -0,0 +1,390 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import ssl
+import sys
+import zlib
+from collections import Counter, namedtuple
+from functools import partial
+from urllib.parse import urljoin, urlsplit
+from lxml import etree
+from tpen2tei.batch import _write_atomic
+from tpen2tei.cache import DiskCache, cache_key
+from tpen2tei.parse import from_sc_stream
+
+__author__ = 'tla'
+
+FetchResult = namedtuple('FetchResult', ['url', 'status', 'data', 'modified', 'error'])
+
+# The responses that are worth asking for again after a while
+_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+_REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+_MAX_REDIRECTS = 5
+
+
+class _ProtocolError(Exception):
+    pass
+
+
+class _BadResponse(_ProtocolError):
+    """A response that the server got wrong, rather than one that was cut off."""
+
+
+# The ways in which a request can fail that might go better another time
+_CONNECTION_ERRORS = (OSError, EOFError, asyncio.LimitOverrunError, _ProtocolError)
+
+
+class ManifestFetcher:
+    """Download SC-JSON manifests from a T-PEN server (or anywhere else), many at
+    a time. Requests to the same host share a small pool of keep-alive
+    connections; no more than concurrency requests are made at once, and no more
+    than per_host to any one server. A request that fails for a reason that
+    might go away, such as a dropped connection or a 503 response, is tried
+    again up to retries times, waiting a little longer each time.
+
+    If a cache (a tpen2tei.cache.DiskCache) is given, each manifest is kept in
+    it along with its ETag and Last-Modified headers, and asked for again only
+    on the condition that it has changed; if it hasn't, the copy in the cache is
+    used. The same cache can be passed to from_sc, so that the pages that have
+    not changed are not converted again either.
+
+    The fetcher should be used as an asynchronous context manager, or closed
+    when it is no longer needed."""
+
+    def __init__(self, cache=None, concurrency=8, per_host=4, retries=3, backoff=0.5, timeout=60,
+                 ssl_context=None):
+        self.cache = cache
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._limit = asyncio.Semaphore(concurrency)
+        self._host_limits = {}
+        self._pools = {}  # The idle connections for each (scheme, host, port)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Close all the idle connections."""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for _, writer in pool:
+                writer.close()
+        for pool in pools.values():
+            for _, writer in pool:
+                try:
+                    await writer.wait_closed()
+                except _CONNECTION_ERRORS:
+                    pass
+
+    async def fetch(self, url):
+        """Download the manifest at the given URL, and return a FetchResult. Its
+        data is the manifest as bytes, or None if it could not be fetched, in
+        which case the error says why; modified is False if the manifest came
+        from the cache."""
+        key = cache_key('manifest', url)
+        validators, cached = self._cached(key)
+        headers = {}
+        if cached is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+        attempt = 0
+        while True:
+            status = None
+            delay = self.backoff * 2 ** attempt
+            try:
+                async with self._limit:
+                    status, rheaders, body = await asyncio.wait_for(self._get(url, headers), self.timeout)
+            except asyncio.TimeoutError:
+                error = 'Timed out after %s seconds' % self.timeout
+            except _CONNECTION_ERRORS as e:
+                error = '%s: %s' % (e.__class__.__name__, e)
+            else:
+                if status == 304 and cached is not None:
+                    return FetchResult(url, status, cached, False, None)
+                if status == 200:
+                    self._store(key, rheaders, body)
+                    return FetchResult(url, status, body, True, None)
+                error = 'HTTP status %d' % status
+                if status not in _RETRY_STATUSES:
+                    return FetchResult(url, status, None, False, error)
+                # The server may tell us how long to wait.
+                if re.match(r'^\d+$', rheaders.get('retry-after', '')):
+                    delay = max(delay, min(int(rheaders['retry-after']), 60))
+            attempt += 1
+            if attempt > self.retries:
+                return FetchResult(url, status, None, False, error)
+            await asyncio.sleep(delay)
+
+    async def fetch_all(self, urls):
+        """Download all the given manifests at once; returns a list of FetchResults
+        in the same order as the URLs."""
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    async def convert(self, url, **options):
+        """Download the given manifest and convert it to TEI. The options are as
+        for from_sc. Returns the FetchResult along with the TEI document, which
+        is None if either step failed. The conversion is done in a separate
+        thread, so that the downloads can carry on meanwhile."""
+        result = await self.fetch(url)
+        if result.data is None:
+            return result, None
+        loop = asyncio.get_running_loop()
+        return result, await loop.run_in_executor(None, partial(_convert, result.data, options))
+
+    async def convert_all(self, urls, **options):
+        """Download and convert all the given manifests; returns a list of
+        (FetchResult, TEI document) pairs in the same order as the URLs."""
+        return await asyncio.gather(*(self.convert(url, **options) for url in urls))
+
+    def _cached(self, key):
+        # Returns the validators and the content of a manifest that we have
+        # downloaded before, or an empty dictionary and None.
+        if self.cache is None:
+            return {}, None
+        data = self.cache.get(key)
+        if data is None:
+            return {}, None
+        meta, _, body = data.partition(b'\n')
+        return json.loads(meta.decode('utf-8')), body
+
+    def _store(self, key, headers, body):
+        if self.cache is None:
+            return
+        validators = {k: headers[k] for k in ('etag', 'last-modified') if k in headers}
+        if validators:
+            self.cache.put(key, json.dumps(validators).encode('utf-8') + b'\n' + body)
+
+    async def _get(self, url, headers):
+        """Make a GET request, following any redirects. Returns the status, the
+        response headers, and the body."""
+        for _ in range(_MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise _ProtocolError('Cannot fetch %s' % url)
+            status, rheaders, body = await self._request(parts, headers)
+            if status in _REDIRECT_STATUSES and 'location' in rheaders:
+                url = urljoin(url, rheaders['location'])
+                continue
+            return status, rheaders, body
+        raise _ProtocolError('Too many redirects')
+
+    async def _request(self, parts, headers):
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        host = (parts.scheme, parts.hostname, port)
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        async with self._host_limits[host]:
+            pool = self._pools.setdefault(host, [])
+            conn = pool.pop() if pool else None
+            reused = conn is not None
+            if conn is None:
+                conn = await self._connect(host)
+            try:
+                status, rheaders, body, keep = await _exchange(conn, parts, headers)
+            except _CONNECTION_ERRORS as e:
+                conn[1].close()
+                if not reused or isinstance(e, _BadResponse):
+                    raise
+                # The server has probably closed a connection that was idle, so
+                # try once more on a new one.
+                conn = await self._connect(host)
+                try:
+                    status, rheaders, body, keep = await _exchange(conn, parts, headers)
+                except BaseException:
+                    conn[1].close()
+                    raise
+            except BaseException:
+                conn[1].close()
+                raise
+            if keep:
+                self._pools.setdefault(host, []).append(conn)
+            else:
+                conn[1].close()
+        return status, rheaders, body
+
+    async def _connect(self, host):
+        scheme, hostname, port = host
+        context = None
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+        return await asyncio.open_connection(hostname, port, ssl=context)
+
+
+async def _exchange(conn, parts, headers):
+    """Send a GET request on the given connection and read the response. Returns
+    the status, headers and body, and whether the connection can be used again."""
+    reader, writer = conn
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    hostheader = parts.hostname if parts.port is None else '%s:%d' % (parts.hostname, parts.port)
+    lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % hostheader, 'User-Agent: tpen2tei',
+             'Accept: application/json', 'Accept-Encoding: gzip', 'Connection: keep-alive']
+    lines.extend('%s: %s' % item for item in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+    statusline = await reader.readline()
+    if not statusline:
+        raise _ProtocolError('Connection closed by server')
+    try:
+        version, status = statusline.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+    except ValueError:
+        raise _BadResponse('Bad status line %r' % statusline) from None
+    rheaders = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line:
+            raise _ProtocolError('Connection closed in the response headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        rheaders[name.strip().lower()] = value.strip()
+
+    keep = version == 'HTTP/1.1' and rheaders.get('connection', '').lower() != 'close'
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif 'chunked' in rheaders.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = _size((await reader.readline()).split(b';')[0].strip() or b'0', 16, 'chunk size')
+            if size == 0:
+                # Skip any trailers.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in rheaders:
+        body = await reader.readexactly(_size(rheaders['content-length'], 10, 'Content-Length'))
+    else:
+        # The end of the body is the end of the connection.
+        body = await reader.read()
+        keep = False
+    if rheaders.get('content-encoding', '').lower() == 'gzip':
+        try:
+            body = gzip.decompress(body)
+        except (OSError, EOFError, zlib.error) as e:
+            # BadGzipFile is an OSError; EOFError is a body cut short.
+            raise _BadResponse('Bad gzip body: %s' % e) from None
+    return status, rheaders, body, keep
+
+
+def _size(text, base, what):
+    """Returns the size in a chunk size line or Content-Length header, which a
+    bad response may have got wrong."""
+    try:
+        size = int(text, base)
+    except ValueError:
+        size = -1
+    if size < 0:
+        raise _BadResponse('Bad %s %r' % (what, text))
+    return size
+
+
+def _convert(data, options):
+    options = dict(options)
+    options['metadata'] = dict(options.get('metadata') or {})
+    return from_sc_stream(io.BytesIO(data), **options)
+
+
+def _output_name(url):
+    """Returns a file name for the TEI version of the manifest at the given URL:
+    the T-PEN project number if there is one, otherwise the last part of the path."""
+    project = re.search(r'/manifest/(\d+)(?:/|$)', urlsplit(url).path)
+    if project is not None:
+        return project.group(1) + '.xml'
+    name = os.path.basename(urlsplit(url).path.rstrip('/')) or urlsplit(url).hostname
+    return re.sub(r'[^\w.-]', '_', os.path.splitext(name)[0]) + '.xml'
+
+
+def _output_names(urls):
+    """Returns a dictionary of the output file name for each of the given URLs.
+    Where different URLs would get the same name from _output_name, as the same
+    project at two servers would, each of them has a short hash of its URL
+    added to the name, so that one file is not written over another."""
+    urls = list(dict.fromkeys(urls))
+    names = {url: _output_name(url) for url in urls}
+    counts = Counter(names.values())
+    for url, name in names.items():
+        if counts[name] > 1:
+            base, ext = os.path.splitext(name)
+            names[url] = '%s-%s%s' % (base, hashlib.sha256(url.encode('utf-8')).hexdigest()[:8], ext)
+    return names
+
+
+async def _fetch_to_dir(urls, outdir, fetcher_options, options):
+    names = _output_names(urls)
+    async with ManifestFetcher(**fetcher_options) as fetcher:
+        results = await fetcher.convert_all(urls, **options)
+    failures = 0
+    for result, xmltree in results:
+        if xmltree is None:
+            failures += 1
+            print("%s: FAILED%s" % (result.url, ' (%s)' % result.error if result.error else ''),
+                  file=sys.stderr)
+            continue
+        outfile = os.path.join(outdir, names[result.url])
+        _write_atomic(outfile, etree.tostring(xmltree, encoding='utf-8', pretty_print=True,
+                                              xml_declaration=True))
+        print("%s -> %s%s" % (result.url, outfile, '' if result.modified else ' (unchanged)'),
+              file=sys.stderr)
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download T-PEN manifests and convert them to TEI XML.')
+    parser.add_argument(
+        "-o", "--outdir",
+        required=True,
+        help="Directory to write the TEI XML files to",
+    )
+    parser.add_argument(
+        "-j", "--concurrency",
+        type=int,
+        default=8,
+        help="Number of downloads to make at once",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Directory in which to keep the manifests and converted pages between runs"
+    )
+    parser.add_argument(
+        "-t", "--title",
+        default="A text generated by tpen2tei",
+        help="Title that should be passed to the texts",
+    )
+    parser.add_argument(
+        "--short-error",
+        action="store_true",
+        help="Reduce the amount of error output on XML parsing failures"
+    )
+    parser.add_argument(
+        "urls",
+        nargs='+',
+        help="URLs of T-PEN manifests, e.g. http://t-pen.org/TPEN/manifest/4505/manifest.json",
+    )
+    args = parser.parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    cache = DiskCache(args.cache) if args.cache else None
+    failures = asyncio.run(_fetch_to_dir(
+        args.urls, args.outdir, {'cache': cache, 'concurrency': args.concurrency},
+        {'metadata': {'title': args.title, 'short_error': args.short_error}, 'cache': cache}))
+    print("%d of %d manifests converted" % (len(args.urls) - failures, len(args.urls)), file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+__author__ = 'tla'
+
+
+class Journal:
+    """An append-only record of the outcome of each conversion in a batch, kept
+    in a file of JSON lines, so that a batch that is stopped or crashes can be
+    run again without redoing the work that was finished. Each line records the
+    input file, the digest of its content, the key of the conversion options,
+    whether the conversion succeeded, and the output file or the error.
+
+    Each record is flushed to disk as soon as it is written; a line that was
+    cut short by a crash is ignored when the journal is read again. Only the
+    process that runs the batch writes to the journal."""
+
+    def __init__(self, path):
+        self.path = path
+        self._state = {}
+        self._lock = threading.Lock()
+        complete = True
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fh:
+                for line in fh:
+                    complete = line.endswith('\n')
+                    try:
+                        self._replay(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        self._fh = open(path, 'a', encoding='utf-8')
+        if not complete:
+            # Finish the line that was cut short, so that the next one is whole.
+            self._fh.write('\n')
+
+    def lookup(self, infile, digest, options):
+        """Returns the output file of the last successful conversion of this
+        content of infile with these options, if its output is still there, and
+        the number of times that it has failed since then."""
+        output, failures = self._state.get((infile, digest, options), (None, 0))
+        if output is not None and not os.path.exists(output):
+            output = None
+        return output, failures
+
+    def record(self, infile, digest, options, result):
+        """Add the outcome of a conversion, as a BatchResult, to the journal."""
+        entry = {'input': infile, 'digest': digest, 'options': options, 'ok': result.ok,
+                 'output': result.outfile, 'error': None if result.ok else result.messages,
+                 'time': round(time.time(), 3)}
+        with self._lock:
+            self._fh.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._replay(entry)
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _replay(self, entry):
+        key = (entry['input'], entry['digest'], entry['options'])
+        output, failures = self._state.get(key, (None, 0))
+        if entry['ok']:
+            self._state[key] = (entry['output'], 0)
+        else:
+            self._state[key] = (output, failures + 1)
+
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of the content of the given file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
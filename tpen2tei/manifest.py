@@ -0,0 +1,209 @@
+import codecs
+import json
+import mmap
+import os
+from tpen2tei.compression import is_compressed, open_input
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__author__ = 'tla'
+
+# The names of the JSON decoders that load_manifest knows about. 'fast' is
+# orjson if it is installed, and the standard library otherwise.
+JSON_BACKENDS = ('json', 'orjson', 'fast')
+
+
+def load_manifest(source, backend=None):
+    """Decode a whole SC-JSON manifest from the given file name or open file
+    handle. Where the input is a file on disk it is read through mmap, so that
+    it is not first copied into a Python string; a file name may also be that
+    of a gzip or xz file, which is decompressed as it is read.
+
+    The backend is the name of a JSON decoder in JSON_BACKENDS, the standard
+    library's by default, or a function that takes a str or a bytes-like object
+    and returns the decoded data."""
+    loads = json_backend(backend)
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open_input(source) as fh:
+            return _load(fh, loads)
+    return _load(source, loads)
+
+
+def json_backend(backend=None):
+    """Returns the decoding function for the given backend, as for
+    load_manifest. Asking for orjson when it is not installed is an ImportError."""
+    if callable(backend):
+        return backend
+    if backend is None or backend == 'json' or (backend == 'fast' and orjson is None):
+        return _json_loads
+    if backend in ('orjson', 'fast'):
+        if orjson is None:
+            raise ImportError('The orjson JSON backend is not installed')
+        return orjson.loads
+    raise ValueError('Unknown JSON backend %s; use one of %s' % (backend, ', '.join(JSON_BACKENDS)))
+
+
+def _json_loads(data):
+    if not isinstance(data, (str, bytes)):
+        # Decode straight from the buffer, rather than copying it to bytes first.
+        data = str(data, 'utf-8-sig')
+    return json.loads(data)
+
+
+def _load(fh, loads):
+    try:
+        # The map is of the whole file, so the handle must not have been read from.
+        mappable = fh.tell() == 0 and not is_compressed(fh)
+    except (AttributeError, OSError):
+        mappable = False
+    if mappable:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):  # Not a file, or an empty one
+            mm = None
+        if mm is not None:
+            with mm, memoryview(mm) as view:
+                return loads(view)
+    return loads(fh.read())
+
+
+class ManifestReader:
+    """Read a SharedCanvas JSON manifest incrementally from an open file handle.
+    Only the canvases of the first sequence are of interest to us, and these are
+    handed out one at a time by canvases(), so that no more than one page of the
+    manifest needs to be held in memory at once. Everything else at the top level
+    of the manifest is decoded as it goes by; the 'metadata' list is kept, and the
+    number of sequences is counted.
+
+    The file handle may be opened in text or in binary mode; binary input is
+    assumed to be UTF-8."""
+
+    def __init__(self, fh, chunk_size=65536):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.metadata = None
+        self.sequence_count = 0
+        self._decoder = json.JSONDecoder()
+        self._bytedecoder = None
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def canvases(self):
+        """Generator over the canvases of the first sequence in the manifest. Once
+        it is exhausted, the rest of the manifest has been read as well."""
+        self._expect('{')
+        for key in self._members():
+            if key == 'sequences':
+                yield from self._sequences()
+            elif key == 'metadata':
+                self.metadata = self._value()
+            else:
+                self._value()
+        self._skip_ws()
+        if self._pos < len(self._buf):
+            self._fail('Extra data')
+
+    def _sequences(self):
+        self._expect('[')
+        for _ in self._elements():
+            self.sequence_count += 1
+            if self.sequence_count > 1:
+                # We don't convert any further sequences, so just read past them.
+                self._value()
+                continue
+            self._expect('{')
+            for key in self._members():
+                if key == 'canvases':
+                    self._expect('[')
+                    for _ in self._elements():
+                        yield self._value()
+                else:
+                    self._value()
+
+    def _members(self):
+        """Iterate over the keys of the object whose opening brace has just been
+        read. The caller must consume each key's value before asking for the next."""
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                self._fail('Expecting property name enclosed in double quotes')
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._peek() == ',':
+                self._pos += 1
+            else:
+                self._expect('}')
+                return
+
+    def _elements(self):
+        """Iterate over the array whose opening bracket has just been read. The
+        caller must consume each element before asking for the next."""
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self._peek() == ',':
+                self._pos += 1
+            else:
+                self._expect(']')
+                return
+
+    def _value(self):
+        """Decode the complete JSON value that starts at the current position."""
+        self._skip_ws()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number or literal that runs up to the end of the buffer
+                # might continue in the next chunk.
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Read at least as much again as we are holding, so that a large value
+            # is not decoded over and over.
+            self._fill(max(self.chunk_size, len(self._buf) - self._pos))
+
+    def _peek(self):
+        self._skip_ws()
+        if self._pos >= len(self._buf):
+            self._fail('Unexpected end of data')
+        return self._buf[self._pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            self._fail("Expecting '%s'" % char)
+        self._pos += 1
+
+    def _skip_ws(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\n\r':
+                self._pos += 1
+            if self._pos < len(self._buf) or self._eof:
+                return
+            self._fill(self.chunk_size)
+
+    def _fill(self, size):
+        chunk = self.fh.read(size)
+        if not chunk:
+            self._eof = True
+        if isinstance(chunk, bytes):
+            if self._bytedecoder is None:
+                self._bytedecoder = codecs.getincrementaldecoder('utf-8-sig')()
+            chunk = self._bytedecoder.decode(chunk, final=self._eof)
+        # Drop what has already been consumed before adding the new data.
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+
+    def _fail(self, msg):
+        raise json.JSONDecodeError(msg, self._buf, self._pos)
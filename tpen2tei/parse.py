@@ -1,14 +1,77 @@
 import argparse
+import contextlib
+import copy
+import hashlib
+import io
+import itertools
 import json
 import os
+import pickle
 import re
+import shutil
 import sys
-from io import BytesIO
+import tempfile
+import threading
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from lxml import etree
 from warnings import warn
+from xml.sax.saxutils import escape
+from tpen2tei.cache import DiskCache, FingerprintError, cache_key
+from tpen2tei.compression import COMPRESSIONS, compressed_output, open_input
+from tpen2tei.diagnostics import Diagnostics, deliver
+from tpen2tei.manifest import JSON_BACKENDS, ManifestReader, load_manifest
+from tpen2tei.manifest import json_backend as _json_decoder
+from tpen2tei.stats import ConversionStats, report, timed
+from tpen2tei.textfilter import TextFilter
+from tpen2tei.zones import FacsimileIndex
 
 __author__ = 'tla'
 
+TEI_NS = 'http://www.tei-c.org/ns/1.0'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+_NS = {'t': TEI_NS}
+_NSMAP = {None: TEI_NS}
+
+# The geometry of a transcribed line, and so of its zone on the page image. Being
+# a tuple, it is stored in the page cache as a plain JSON list.
+_Zone = namedtuple('_Zone', ['id', 'x', 'y', 'w', 'h'])
+
+_PAGE_NUMBER = re.compile(r'^[^\d]+(\d+\w)')
+_LINE_ID = re.compile(r'^.*line/(\d+)$')
+_XYWH = re.compile(r'^.*#xywh=(.*)')
+
+
+class _Immediate:
+    """Reports each problem as soon as it is found, in the way that tpen2tei
+    always has, for when no Diagnostics are being collected."""
+
+    def add(self, level, code, message, location=None, detail=None):
+        if code in ('sequences', 'numeric-parse'):
+            warn(message, UserWarning)
+        elif code == 'unknown-member':
+            print("WARNING: %s" % message)
+        elif code == 'unknown-glyph':
+            safeerrmsg("In g element %s, line %s / %s, page %s:\n%s\n" % (
+                detail, location['line'], location['n'], location['page'], message))
+        elif level == 'error':
+            safeerrmsg(message if detail is None else "%s\n%s" % (message, detail))
+        else:
+            print("WARNING: %s" % (message if detail is None else "%s\n%s" % (message, detail)),
+                  file=sys.stderr)
+
+    def warning(self, code, message, location=None, detail=None):
+        self.add('warning', code, message, location, detail)
+
+    def error(self, code, message, location=None, detail=None):
+        self.add('error', code, message, location, detail)
+
+
+_IMMEDIATE = _Immediate()
+
 
 def from_sc(jsondata,
             metadata=None,
@@ -16,7 +79,15 @@ def from_sc(jsondata,
             special_chars=None,
             numeric_parser=None,
             text_filter=None,
-            postprocess=None):
+            postprocess=None,
+            cache=None,
+            page_errors=None,
+            rules=None,
+            memoize=None,
+            stats=None,
+            diagnostics=None,
+            zone_index=None,
+            page_workers=None):
     """Extract the textual transcription from a JSON file, probably exported
     from T-PEN according to a Shared Canvas specification. It has a series of
     sequences (should be 1 sequence), and each sequence has a set of canvases,
@@ -33,7 +104,9 @@ def from_sc(jsondata,
     The optional special_chars parameter is a dictionary of glyphs that have
     been referenced in the transcription. The dictionary key is the normalized
     character form of the given glyph; the value is a tuple of the glyph's
-    xml:id and the Unicode-like description of the glyph.
+    xml:id and the Unicode-like description of the glyph. It may also be a
+    GlyphRegistry, which is worth making once if the same glyphs are used for
+    many manuscripts.
 
     The optional numeric_parser parameter is a function that takes a string and
     is expected to return a numeric value. It will be passed the text content of
@@ -42,259 +115,1475 @@ def from_sc(jsondata,
     The optional text_filter parameter is a function that takes a string and is
     expected to return a string. It will be passed the text content of each line
     of transcription in the canvas, and its return value will be stored as the
-    content of that line.
+    content of that line. It may instead be a tpen2tei.textfilter.TextFilter,
+    or a list of the rules to make one from, such as
+      [('chars', {'_': '֊', ',': '.'}), ('replace', '<p/>', '</p><p>')]
+    which does the same replacements in fewer passes over the text.
 
     The optional postprocess parameter is a function that takes an etree Element
     object, which is the otherwise final parsed TEI document, and modifies it.
+
+    The optional rules parameter is a Rules object with rewrites for the
+    elements of the text, which are carried out in the same walk over the text
+    as the fixes for glyphs, numbers, and the like. This is cheaper than
+    making the same changes in postprocess.
+
+    The optional cache parameter is a tpen2tei.cache.DiskCache, in which the
+    conversion of each page is kept. When the same manuscript is converted again
+    with the same options, only the pages whose content has changed need to be
+    converted anew; the rest are taken from the cache. Warnings about the text
+    of a page are not repeated when it comes from the cache.
+
+    Normally, if the markup of any page is not well-formed, the error is
+    reported and no document is returned. If the optional page_errors
+    parameter is 'skip', each broken page is reported and left out of the text
+    instead; if it is 'wrap', its transcribed text is kept with the markup
+    escaped, in a <seg type="unparsed"> element. Either way the rest of the
+    manuscript is converted as usual.
+
+    If the optional memoize parameter is True, or the number of results to
+    keep, the results of numeric_parser and text_filter are remembered, so
+    that each of them is called only once for each distinct string. The
+    number of calls that were answered from the memo, and of those that were
+    not, are then among the stats.
+
+    The optional stats parameter is for finding out where the time goes. If it
+    is a tpen2tei.stats.ConversionStats, the time taken by each phase of the
+    conversion and the numbers of pages, lines, glyphs and so on are added to
+    it; if it is any other callable, it is called with a ConversionStats for
+    the conversion once it is done, whether or not it succeeded.
+
+    Warnings and errors are normally printed as they are found. If the optional
+    diagnostics parameter is given, they are collected instead, with repeats of
+    the same problem counted rather than reported each time: if it is a
+    tpen2tei.diagnostics.Diagnostics, they are added to it, and if it is any
+    other callable, it is called with a Diagnostics for the conversion once it
+    is done.
+
+    If the optional zone_index parameter is given, it is called with a
+    tpen2tei.zones.FacsimileIndex of the zones of every surface once the
+    document has been converted, for finding the lines at a given place on a
+    page image.
+
+    If the optional page_workers parameter is a number greater than one, the
+    canvases are extracted in chunks by that many worker processes, which is
+    worthwhile for manuscripts of many pages. The result is the same as
+    without it. The text_filter must then be a TextFilter, or a function that
+    can be pickled, such as one defined at the top level of a module;
+    otherwise, as when a page cache is given, the canvases are extracted one
+    by one as usual.
+
+    The metadata dictionary that is passed in is not changed. To convert many
+    manuscripts with the same options, it is better to make a Converter.
     """
-    if len(jsondata['sequences']) > 1:
-        warn("Your data has more than one sequence. Check to see what's going on.", UserWarning)
-    # Merge the JSON-supplied metadata into the user-supplied. If a user has
-    # supplied a key, don't override it.
-    if 'metadata' in jsondata:
-        if metadata is None:
-            metadata = {}
-        for item in jsondata['metadata']:
+    return Converter(metadata=metadata, members=members, special_chars=special_chars,
+                     numeric_parser=numeric_parser, text_filter=text_filter, postprocess=postprocess,
+                     cache=cache, page_errors=page_errors, rules=rules, memoize=memoize,
+                     stats=stats, diagnostics=diagnostics, zone_index=zone_index,
+                     page_workers=page_workers).convert(jsondata)
+
+
+def from_sc_stream(scfh,
+                   metadata=None,
+                   members=None,
+                   special_chars=None,
+                   numeric_parser=None,
+                   text_filter=None,
+                   postprocess=None,
+                   cache=None,
+                   page_errors=None,
+                   rules=None,
+                   memoize=None,
+                   stats=None,
+                   json_backend=None,
+                   diagnostics=None,
+                   zone_index=None,
+                   page_workers=None):
+    """Like from_sc, but read the SC-JSON incrementally from the open file handle
+    scfh instead of taking an already-decoded manifest. The canvases are decoded
+    and converted one at a time, so that the memory needed for reading the input
+    depends on the size of the largest page, and not on the size of the whole
+    manuscript.
+
+    If the optional json_backend parameter is given, the manifest is instead
+    decoded all at once with that backend (see tpen2tei.manifest.load_manifest),
+    reading it through mmap if scfh is a file. With 'orjson' or 'fast' this is
+    much quicker, at the cost of holding the whole manifest in memory.
+
+    The remaining parameters are as for from_sc."""
+    return Converter(metadata=metadata, members=members, special_chars=special_chars,
+                     numeric_parser=numeric_parser, text_filter=text_filter, postprocess=postprocess,
+                     cache=cache, page_errors=page_errors, rules=rules,
+                     memoize=memoize, stats=stats, json_backend=json_backend,
+                     diagnostics=diagnostics, zone_index=zone_index,
+                     page_workers=page_workers).convert_stream(scfh)
+
+
+class Converter:
+    """A conversion from SC-JSON to TEI XML with a given set of options, which
+    can be used for any number of manuscripts. The options are as for from_sc.
+    They are taken in once, when the Converter is made: the metadata and members
+    dictionaries are copied, the special characters are made into a
+    GlyphRegistry, and the options are checked. Nothing about a Converter
+    changes when it is used, so one Converter can be shared by many threads.
+
+    The metadata for the header comes first from any metadata passed to the
+    convert method, then from the Converter's metadata, then from the manuscript
+    itself, and finally from the defaults.
+
+    With the memoize option, the results of numeric_parser and text_filter are
+    remembered for as long as the Converter is used, which is worthwhile when
+    the same numbers and lines turn up in manuscript after manuscript;
+    memo_stats() says how well this is working overall, and the stats of each
+    conversion count its own hits and misses.
+
+    The figures for each conversion go to the stats option, and the problems
+    found to the diagnostics option, if they are given, unless others are
+    passed to the convert method. The json_backend option
+    is used by convert_stream, as for from_sc_stream, and the zone_index option
+    is called with the zone index of each document that is converted.
+
+    The output_cache option is a tpen2tei.cache.DiskCache, in which
+    convert_to_xml keeps the finished documents. It is keyed on the SC-JSON
+    input and on everything about the conversion, down to the code of the
+    functions that are passed as options and of tpen2tei itself, so that a
+    manuscript that has not changed is not converted again. If an option
+    cannot be told apart from one run to the next (see
+    tpen2tei.cache.fingerprint), a warning is given and the caches that it
+    would be part of the key of are not used."""
+
+    def __init__(self,
+                 metadata=None,
+                 members=None,
+                 special_chars=None,
+                 numeric_parser=None,
+                 text_filter=None,
+                 postprocess=None,
+                 cache=None,
+                 page_errors=None,
+                 rules=None,
+                 memoize=None,
+                 stats=None,
+                 json_backend=None,
+                 diagnostics=None,
+                 output_cache=None,
+                 zone_index=None,
+                 page_workers=None):
+        if page_errors not in (None, 'skip', 'wrap'):
+            raise ValueError("page_errors must be 'skip' or 'wrap', not %s" % page_errors)
+        self._metadata = dict(metadata or {})
+        self._members = None if members is None else dict(members)
+        self._registry = _glyph_registry(special_chars)
+        if isinstance(text_filter, (list, tuple)):
+            text_filter = TextFilter(text_filter)
+        if memoize:
+            maxsize = _MEMO_SIZE if memoize is True else memoize
+            numeric_parser = _memoized(numeric_parser, maxsize)
+            text_filter = _memoized(text_filter, maxsize)
+        self._numeric_parser = numeric_parser
+        self._text_filter = text_filter
+        self._postprocess = postprocess
+        self._cache = cache
+        self._page_errors = page_errors
+        self._rules = rules
+        self._stats = stats
+        self._diagnostics = diagnostics
+        self._output_cache = output_cache
+        self._zone_index = zone_index
+        self._page_workers = page_workers
+        self._options_key = None
+        if cache is not None:
+            try:
+                _page_options(None, text_filter)
+            except FingerprintError as e:
+                warn('Not using the page cache: %s' % e)
+                self._cache = None
+        if output_cache is not None:
+            try:
+                self._options_key = self._fingerprint()
+            except FingerprintError as e:
+                warn('Not using the output cache: %s' % e)
+                self._output_cache = None
+        # Check the backend now, rather than when the first manuscript is read.
+        self._json_loads = None if json_backend is None else _json_decoder(json_backend)
+
+    def convert(self, jsondata, metadata=None, stats=None, diagnostics=None):
+        """Convert the given SC-JSON data, as from_sc does. Any metadata, stats
+        or diagnostics given here are used for this manuscript only."""
+        with _reporting(self._stats if stats is None else stats,
+                        self._diagnostics if diagnostics is None else diagnostics,
+                        self._memos()) as (run, problems):
+            return self._convert(jsondata, metadata, run, problems)
+
+    def _convert(self, jsondata, metadata, run, problems):
+        if len(jsondata['sequences']) > 1:
+            problems.warning('sequences', "Your data has more than one sequence. Check to see what's going on.")
+        with timed(run, 'extract'):
+            units, facsimile, seen_members = _extract_canvases(jsondata['sequences'][0]['canvases'],
+                                                               self._members, self._text_filter, self._cache,
+                                                               problems, self._page_workers)
+        return self._finish(units, facsimile, seen_members, jsondata.get('metadata'), metadata, run, problems)
+
+    def convert_stream(self, scfh, metadata=None, stats=None, diagnostics=None):
+        """Convert the SC-JSON that is read from the open file handle scfh, as
+        from_sc_stream does. Any metadata, stats or diagnostics given here are
+        used for this manuscript only."""
+        with _reporting(self._stats if stats is None else stats,
+                        self._diagnostics if diagnostics is None else diagnostics,
+                        self._memos()) as (run, problems):
+            if self._json_loads is not None:
+                with timed(run, 'decode'):
+                    jsondata = load_manifest(scfh, self._json_loads)
+                return self._convert(jsondata, metadata, run, problems)
+            reader = ManifestReader(scfh)
+            with timed(run, 'extract'):
+                units, facsimile, seen_members = _extract_canvases(reader.canvases(), self._members,
+                                                                   self._text_filter, self._cache, problems,
+                                                                   self._page_workers)
+            if reader.sequence_count > 1:
+                problems.warning('sequences',
+                                 "Your data has more than one sequence. Check to see what's going on.")
+            return self._finish(units, facsimile, seen_members, reader.metadata, metadata, run, problems)
+
+    def convert_to_xml(self, source, metadata=None, stats=None, diagnostics=None):
+        """Convert the SC-JSON in source, which is either bytes or a binary file
+        handle, as convert_stream does, and return the TEI document serialized as
+        UTF-8, just as the command line writes it; or None if the conversion fails.
+
+        With the output_cache option, a document that has been converted before
+        with the same options is returned from the cache, which costs no more
+        than hashing the input and reading the file; nothing goes to stats,
+        diagnostics or zone_index then, as there was no conversion.
+
+        A file handle is read as convert_stream reads it, so that the input need
+        not be held in memory. For the output cache it is read through once
+        more to hash it first; if it cannot be rewound, as for a pipe, it is
+        copied to a temporary file as it is hashed."""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        if self._output_cache is None:
+            return self._serialize(self.convert_stream(source, metadata, stats, diagnostics))
+        with contextlib.ExitStack() as stack:
+            source, digest = _hash_input(source, stack)
+            key = cache_key('document', self._options_key, metadata, digest)
+            document = self._output_cache.get(key)
+            if document is not None:
+                return document
+            document = self._serialize(self.convert_stream(source, metadata, stats, diagnostics))
+        if document is not None:
+            self._output_cache.put(key, document)
+        return document
+
+    @staticmethod
+    def _serialize(xmltree):
+        if xmltree is None:
+            return None
+        return etree.tostring(xmltree, encoding='utf-8', pretty_print=True, xml_declaration=True)
+
+    def _fingerprint(self):
+        """Returns the part of the output cache key that stands for the options."""
+        registry = self._registry
+        return cache_key('options', _CACHE_VERSION, _source_digest(), self._metadata, self._members,
+                         None if registry is None else (registry.special_chars, registry.corrections),
+                         self._numeric_parser, self._text_filter, self._postprocess, self._page_errors,
+                         None if self._rules is None else self._rules.handlers())
+
+    def _memos(self):
+        return {'numeric_parser': self._numeric_parser, 'text_filter': self._text_filter}
+
+    def memo_stats(self):
+        """Returns the hits, misses, and size of the memo for each of
+        numeric_parser and text_filter, or None for those that are not memoized."""
+        return {name: _memo_info(func) for name, func in self._memos().items()}
+
+    def _finish(self, units, facsimile, seen_members, jsonmeta, metadata, run, problems):
+        metadata = _merge_metadata(jsonmeta, dict(self._metadata, **(metadata or {})))
+        if run is not None:
+            run.count('pages', len(facsimile))
+            run.count('lines', sum(len(surface['zones']) for surface in facsimile))
+            run.count('notes', len(units[-1]))
+        if self._page_errors is not None:
+            with timed(run, 'isolate'):
+                units = _isolate_faults(units, self._page_errors, run, problems)
+        with timed(run, 'body'):
+            xmlparts, glyphs_fixed = _body_parts(units, self._registry, self._numeric_parser,
+                                                 self._cache, self._rules, run, problems)
+        tei_doc = _xmlify(xmlparts, facsimile, metadata, members=seen_members, registry=self._registry,
+                          numeric_parser=self._numeric_parser, postprocess=self._postprocess,
+                          glyphs_fixed=glyphs_fixed, rules=self._rules, stats=run, diagnostics=problems)
+        if tei_doc is not None and self._zone_index is not None:
+            self._zone_index(FacsimileIndex.from_facsimile(facsimile))
+        return tei_doc
+
+
+@contextmanager
+def _reporting(stats, diagnostics, memos=None):
+    """Context manager for a single conversion, which gives the ConversionStats
+    to record it in (or None) and the place to report its problems, and hands
+    them on to the stats and diagnostics options when it is over. The hits and
+    misses in the conversion of any memoized functions in the memos dictionary,
+    by name, are counted in the stats."""
+    run = None if stats is None else ConversionStats()
+    problems = _IMMEDIATE if diagnostics is None else Diagnostics()
+    before = {} if run is None else {name: _memo_info(func) for name, func in (memos or {}).items()}
+    try:
+        yield run, problems
+    finally:
+        if run is not None:
+            for name, start in before.items():
+                if start is not None:
+                    end = _memo_info(memos[name])
+                    run.count(name + '_hits', end.hits - start.hits)
+                    run.count(name + '_misses', end.misses - start.misses)
+            report(run, stats)
+        if diagnostics is not None:
+            deliver(problems, diagnostics)
+
+
+def write_sc_stream(scfh,
+                    outfh,
+                    metadata=None,
+                    members=None,
+                    special_chars=None,
+                    numeric_parser=None,
+                    text_filter=None,
+                    diagnostics=None):
+    """Like from_sc_stream, but write the TEI document to the binary file handle
+    outfh as the conversion goes along, instead of returning it as a tree. The
+    header is written as soon as the first canvas has been read, and the
+    facsimile surfaces page by page; the text body is corrected page by page
+    and held in a temporary file until the end, since it comes last in the
+    document. Memory use thus does not depend on the size of the manuscript.
+
+    Since the header has to be written before the text is read, it declares
+    every transcriber in members and every glyph in special_chars, and not only
+    the ones that are used. There are no postprocess or rules options, as the
+    document never exists as a tree. XML parsing errors are always reported in the short form.
+    The diagnostics option is as for from_sc.
+
+    Returns True if the document was written completely; otherwise the error
+    is reported, and None is returned."""
+    if isinstance(text_filter, (list, tuple)):
+        text_filter = TextFilter(text_filter)
+    with _reporting(None, diagnostics) as (_, problems):
+        return _write_stream(scfh, outfh, metadata, members, special_chars, numeric_parser, text_filter,
+                             problems)
+
+
+def _write_stream(scfh, outfh, metadata, members, special_chars, numeric_parser, text_filter, problems):
+    reader = ManifestReader(scfh)
+    canvases = reader.canvases()
+    # Reading the first canvas means that we have passed the manifest metadata,
+    # at least in T-PEN output.
+    first = next(canvases, None)
+    if first is not None:
+        canvases = itertools.chain([first], canvases)
+    metadata = _set_defaults(_merge_metadata(reader.metadata, metadata))
+    registry = _glyph_registry(special_chars)
+
+    outfh.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+    outfh.write(etree.tostring(_schema_pi(metadata), encoding='utf-8'))
+    outfh.write(('<TEI xmlns="%s">' % TEI_NS).encode('utf-8'))
+    outfh.write(_serialize(_tei_header(metadata, members,
+                                       registry.glyphs(registry) if registry is not None else [])))
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as spool:
+        body = _StreamBody(spool, registry, numeric_parser, problems)
+        notes = []
+        seen_members = {}
+        surfaces = 0
+        for surface, pageparts in _extract_pages(canvases, members, text_filter, seen_members, notes,
+                                                 diagnostics=problems):
+            outfh.write(b'<facsimile>' if not surfaces else b'')
+            outfh.write(_serialize(_make_surface(surface)))
+            surfaces += 1
+            if not body.feed(pageparts):
+                return None
+        outfh.write(b'</facsimile>' if surfaces else b'<facsimile/>')
+        if reader.sequence_count > 1:
+            problems.warning('sequences', "Your data has more than one sequence. Check to see what's going on.")
+        if not body.close(_note_parts(notes, seen_members)):
+            return None
+        if body.wrap_ab:
+            problems.warning('unblocked-text', "unblocked text detected. Wrapping in anonymous block")
+        if spool.tell():
+            outfh.write(b'<text><body><ab>' if body.wrap_ab else b'<text><body>')
+            spool.seek(0)
+            shutil.copyfileobj(spool, outfh)
+            outfh.write(b'</ab></body></text>' if body.wrap_ab else b'</body></text>')
+        else:
+            outfh.write(b'<text><body/></text>')
+    outfh.write(b'</TEI>')
+    return True
+
+
+# The number of results of numeric_parser and text_filter to remember, by default
+_MEMO_SIZE = 4096
+
+
+def _memoized(func, maxsize):
+    """Returns the given callback, wrapped so as to remember its most recent
+    results."""
+    if func is None or hasattr(func, 'cache_info'):
+        return func
+    return lru_cache(maxsize=maxsize)(func)
+
+
+def _memo_info(func):
+    if func is None or not hasattr(func, 'cache_info'):
+        return None
+    return func.cache_info()
+
+
+# The size of the blocks in which input is hashed for the output cache
+_HASH_BLOCK = 1 << 20
+
+
+def _hash_input(fh, stack):
+    """Returns a handle from which the whole input of the binary file handle fh
+    can be read from the start, and the SHA-256 hex digest of that input. A
+    handle that cannot be rewound is copied to a temporary file, which is
+    closed along with the given ExitStack."""
+    digest = hashlib.sha256()
+    try:
+        start = fh.tell() if fh.seekable() else None
+    except OSError:
+        start = None
+    if start is not None:
+        for block in iter(lambda: fh.read(_HASH_BLOCK), b''):
+            digest.update(block)
+        fh.seek(start)
+        return fh, digest.hexdigest()
+    spool = stack.enter_context(tempfile.TemporaryFile())
+    for block in iter(lambda: fh.read(_HASH_BLOCK), b''):
+        digest.update(block)
+        spool.write(block)
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _source_digest(package=os.path.dirname(os.path.abspath(__file__))):
+    """Returns a digest of the code in the given package directory, by default
+    this one, so that cached documents are not used once any of the code that
+    the conversion depends on has changed. All of its modules are digested,
+    since the conversion imports most of them and they may import the rest."""
+    digest = hashlib.sha256()
+    for module in sorted(name for name in os.listdir(package) if name.endswith('.py')):
+        with open(os.path.join(package, module), 'rb') as fh:
+            digest.update(module.encode('utf-8') + b'\0' + hashlib.sha256(fh.read()).digest())
+    return digest.hexdigest()
+
+
+def _merge_metadata(jsonmeta, metadata):
+    """Merge the JSON-supplied metadata into a copy of the user-supplied. If a
+    user has supplied a key, don't override it."""
+    metadata = dict(metadata or {})
+    if jsonmeta is not None:
+        for item in jsonmeta:
             if item['label'] not in metadata and len(item['value']) > 0 and not item['value'].isspace():
                 metadata[item['label']] = item['value']
+    return metadata
 
-    pages = jsondata['sequences'][0]['canvases']
+
+def _extract_canvases(pages, members, text_filter, cache=None, diagnostics=_IMMEDIATE, workers=None):
+    """Go through the given canvases in order, and return the transcribed text
+    as a list of (not yet parsed) XML string fragments for each page, with the
+    transcriber notes as the last of them; the facsimile information for each page;
+    and the project members who were seen to have transcribed lines. Each canvas
+    is only looked at once, so this works just as well on a generator. Lines by
+    transcribers who are not in members are reported to diagnostics. With more
+    than one worker, the canvases are extracted in parallel."""
     facsimile = []
     notes = []
-    columns = {}
-    xmlstring = ''
-    nblines = set()  # Keep track of the line IDs that occur mid-word
-    breaking = False
+    units = []
     seen_members = {}
-    for page in pages:
-        # Get the page image label and derive the page number on a best-effort basis
-        fn = os.path.splitext(page['label'])[0]
-        pn = re.sub('^[^\d]+(\d+\w)', '\\1', fn)
-        pn = pn.lstrip('0')
-        # Pull out the necessary facsimile information
-        surface = {'graphic': fn, 'width': page['width'], 'height': page['height'], 'zones': []}
-        thetext = []
-        # Keep track of the minimum X value on the page, to track column shifts.
-        # Since it is possible for X values to be negative, we initialize to None instead of -1.
-        xval = None
-        # Find the annotation list.
-        linelist = None
-        for content in page['otherContent']:
-            if content['@type'] == 'sc:AnnotationList':
-                linelist = content
-                break
-        # Did we find a list of annotations for this page?
-        if linelist is None:
-            continue
-        # Apparently we did, so add this page to the facsimiles and parse its lines.
+    for surface, pageparts in _extract_pages(pages, members, text_filter, seen_members, notes, cache,
+                                             diagnostics, workers):
         facsimile.append(surface)
-        for line in linelist['resources']:
-            if line['resource']['@type'] == 'cnt:ContentAsText':
-                transcription = line['resource']['cnt:chars']
-                if text_filter is not None:
-                    transcription = text_filter(transcription)
-                if len(transcription) == 0:
-                    continue
-                # Get the line ID, for later attachment of notes.
-                lineidfound = re.match('^.*line/(\d+)$', line['_tpen_line_id'])
-                agent = "%d" % line.get('_tpen_creator')
-                if lineidfound is None:
-                    raise ValueError('Could not find a line ID on line %s' % json.dumps(line))
-                lineid = lineidfound.group(1)
-                # Note whether the previous line break element needs a 'break' attribute
-                # (never the first line)
-                if breaking:
-                    nblines.add(lineid)
-                # Note whether the next line break element needs a 'break' attribute
-                # (never the last line)
-                breaking = not transcription.endswith(' ')
-                if line['motivation'] == 'oad:transcribing':
-                    # This is a transcription of a manuscript line.
-                    # Get the geometry of the line and save it as a zone.
-                    coords = re.match('^.*#xywh=(.*)', line['on'])
-                    if coords is None:
-                        raise ValueError('Could not find the coordinates for line %s' % line['@id'])
-                    points = coords.group(1).split(',') # x, y, width, height
-                    zone = {'id': lineid, 'points': points}
-                    surface['zones'].append(zone)
-                    # See if a new text column needs to be started.
-                    if xval is None:
-                        # Initialise the minimum xval for the page if necessary
-                        xval = int(points[0]) - 1
-                    if xval < int(points[0]):
-                        thetext.append([])
-                        xval = int(points[0])
-                    # See who is responsible for this transcription line.
-                    if members is not None:
-                        if agent in members:
-                            seen_members[agent] = members.get(agent)
-                        else:
-                            print("WARNING: T-PEN user %s not in members list" % agent)
-                    # Add the line to the running text
-                    thetext[-1].append((lineid, transcription, agent))
-
-                if '_tpen_note' in line:
-                    # This 'transcription' is actually a transcriber's note.
-                    if line['_tpen_note'] != "":
-                        notes.append((lineid, line['_tpen_note'], agent))
-        # Spit out the text
-        if len(thetext):
-            xmlstring += '<pb n="%s"/>\n' % pn
-            for cn, col in enumerate(thetext):
-                if len(thetext) > 1:
-                    xmlstring += '<cb n="%d"/>\n' % (cn + 1)
-                for ln, line in enumerate(col):
-                    attrstring = 'xml:id="l%s" facs="#z%s" n="%d"' % (line[0], line[0], ln + 1)
-                    if line[2] in seen_members:
-                        attrstring += ' resp="#u%s"' % line[2]
-                    if line[0] in nblines:
-                        attrstring += ' break="no"'
-                    xmlstring += '<lb %s/>%s\n' % (attrstring, line[1])
-            # Keep track of the number of columns.
-            if len(thetext) in columns:
-                columns[len(thetext)].append(pn)
-            else:
-                columns[len(thetext)] = [pn]
+        units.append(pageparts)
     # and then add the notes.
+    units.append(_note_parts(notes, seen_members))
+    return units, facsimile, seen_members
+
+
+def _extract_pages(pages, members, text_filter, seen_members, notes, cache=None, diagnostics=_IMMEDIATE,
+                   workers=None):
+    """Generator that goes through the given canvases in order, and yields the
+    facsimile information and the list of XML string fragments for each page
+    that has a list of annotations. The transcribers seen are added to the
+    seen_members dictionary, and any transcriber notes to the notes list, as
+    we go. If a cache is given, the pages that have been extracted before with
+    the same options are taken from it; otherwise, given more than one worker,
+    the pages are extracted in parallel by _extract_parallel."""
+    breaking = False
+    options = None
+    parallel = None
+    if cache is not None:
+        # Only the IDs of the members make a difference to the page.
+        options = _page_options(None if members is None else sorted(members), text_filter)
+    elif workers is not None and workers > 1:
+        parallel = _extract_parallel(pages, members, text_filter, workers)
+    for page in (pages if parallel is None else parallel):
+        if parallel is not None:
+            record = page
+            if record is not None and breaking:
+                _break_first_line(record)
+        elif cache is None:
+            record = _extract_page(page, members, text_filter, breaking)
+        else:
+            record = _cached_page(cache, options, page, members, text_filter, breaking)
+        if record is None:
+            continue
+        if record['breaking'] is not None:
+            breaking = record['breaking']
+        for agent, lineid in record['strangers']:
+            diagnostics.warning('unknown-member', "T-PEN user %s not in members list" % agent,
+                                {'page': record['surface']['graphic'], 'line': lineid})
+        for agent in record['agents']:
+            seen_members[agent] = members.get(agent)
+        notes.extend(tuple(n) for n in record['notes'])
+        yield record['surface'], record['parts']
+
+
+def _extract_page(page, members, text_filter, breaking):
+    """Extract the transcription of a single canvas. The breaking flag says
+    whether the line before this page ended in the middle of a word. Returns
+    None if the page has no list of annotations; otherwise a dictionary with the
+    facsimile information for the page, the list of XML string fragments for its
+    text, its transcriber notes, the IDs of the transcribers in members who
+    worked on it (and of those not in members, with the ID of each of their lines),
+    the ID of its first line, and whether its last line ended in the middle of a
+    word (or None for both, if it has no lines)."""
+    # Get the page image label and derive the page number on a best-effort basis
+    fn = os.path.splitext(page['label'])[0]
+    pn = _PAGE_NUMBER.sub('\\1', fn)
+    pn = pn.lstrip('0')
+    # Pull out the necessary facsimile information. The zones are _Zone tuples,
+    # which are also the geometry of the lines of text.
+    surface = {'graphic': fn, 'width': page['width'], 'height': page['height'], 'zones': []}
+    zones = surface['zones']
+    lines = []  # The text and transcriber of each zone
+    notes = []
+    agents = []  # The transcribers in members, in the order that we see them
+    strangers = []  # The transcribers not in members, with each line they wrote
+    page_breaking = None
+    first = None
+    nblines = set()  # Keep track of the line IDs that occur mid-word
+    # Find the annotation list.
+    linelist = None
+    for content in page['otherContent']:
+        if content['@type'] == 'sc:AnnotationList':
+            linelist = content
+            break
+    # Did we find a list of annotations for this page?
+    if linelist is None:
+        return None
+    # Apparently we did, so parse its lines.
+    resources = [line for line in linelist['resources'] if line['resource']['@type'] == 'cnt:ContentAsText']
+    transcriptions = [line['resource']['cnt:chars'] for line in resources]
+    if isinstance(text_filter, TextFilter):
+        transcriptions = text_filter.lines(transcriptions)
+    elif text_filter is not None:
+        transcriptions = [text_filter(t) for t in transcriptions]
+    for line, transcription in zip(resources, transcriptions):
+        if len(transcription) == 0:
+            continue
+        # Get the line ID, for later attachment of notes.
+        lineidfound = _LINE_ID.match(line['_tpen_line_id'])
+        agent = "%d" % line.get('_tpen_creator')
+        if lineidfound is None:
+            raise ValueError('Could not find a line ID on line %s' % json.dumps(line))
+        lineid = lineidfound.group(1)
+        if first is None:
+            first = lineid
+        # Note whether the previous line break element needs a 'break' attribute
+        # (never the first line)
+        if breaking:
+            nblines.add(lineid)
+        # Note whether the next line break element needs a 'break' attribute
+        # (never the last line)
+        breaking = not transcription.endswith(' ')
+        if line['motivation'] == 'oad:transcribing':
+            # This is a transcription of a manuscript line.
+            # Get the geometry of the line and save it as a zone.
+            coords = _XYWH.match(line['on'])
+            if coords is None:
+                raise ValueError('Could not find the coordinates for line %s' % line['@id'])
+            x, y, w, h = coords.group(1).split(',')[:4]
+            zones.append(_Zone(lineid, int(x), int(y), int(w), int(h)))
+            # See who is responsible for this transcription line.
+            if members is not None:
+                if agent in members:
+                    if agent not in agents:
+                        agents.append(agent)
+                else:
+                    strangers.append((agent, lineid))
+            lines.append((transcription, agent))
+
+        if '_tpen_note' in line:
+            # This 'transcription' is actually a transcriber's note.
+            if line['_tpen_note'] != "":
+                notes.append((lineid, line['_tpen_note'], agent))
+        # Keep track of whether the last line ended mid-word.
+        page_breaking = breaking
+    # Spit out the text
+    xmlparts = []
+    if len(lines):
+        xmlparts.append('<pb n="%s"/>\n' % pn)
+        # Map the first line of each column to the column number.
+        columns = {start: cn + 1 for cn, start in enumerate(_column_starts(array('l', [z.x for z in zones])))}
+        ln = 0
+        for i, (zone, (transcription, agent)) in enumerate(zip(zones, lines)):
+            if i in columns:
+                if len(columns) > 1:
+                    xmlparts.append('<cb n="%d"/>\n' % columns[i])
+                ln = 0
+            ln += 1
+            attrstring = 'xml:id="l%s" facs="#z%s" n="%d"' % (zone.id, zone.id, ln)
+            if agent in agents:
+                attrstring += ' resp="#u%s"' % agent
+            if zone.id in nblines:
+                attrstring += ' break="no"'
+            xmlparts.append('<lb %s/>%s\n' % (attrstring, transcription))
+    return {'surface': surface, 'parts': xmlparts, 'notes': notes, 'agents': agents,
+            'strangers': strangers, 'first': first, 'breaking': page_breaking}
+
+
+# The number of canvases that a worker extracts at a time
+_PAGE_CHUNK = 16
+
+
+def _extract_parallel(pages, members, text_filter, workers):
+    """Generator that extracts the given canvases in chunks, in a pool of the
+    given number of worker processes, and yields the page records in order.
+    Each page is extracted as though the line before it ended with a space, so
+    the caller must put right the first line of each page that follows a line
+    ending mid-word (see _break_first_line). Only a few chunks are read ahead
+    of the page that is yielded, so that this works as well on a generator of
+    canvases. If the options cannot be sent to the workers, the pages are
+    extracted here instead."""
+    # A memo would not be shared between the workers anyway.
+    shipped = text_filter.__wrapped__ if hasattr(text_filter, 'cache_info') else text_filter
+    try:
+        pickle.dumps((members, shipped))
+    except (pickle.PicklingError, AttributeError, TypeError):
+        for page in pages:
+            yield _extract_page(page, members, text_filter, False)
+        return
+    pages = iter(pages)
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(pages, _PAGE_CHUNK))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_extract_chunk, chunk, members, shipped))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def _extract_chunk(pages, members, text_filter):
+    return [_extract_page(page, members, text_filter, False) for page in pages]
+
+
+def _break_first_line(record):
+    """Mark the first line of an extracted page as going on with the word that
+    the page before ended with, as _extract_page does when it is told so."""
+    zones = record['surface']['zones']
+    if not zones or zones[0].id != record['first']:
+        # The first line was only a note, which has no line break.
+        return
+    parts = record['parts']
+    for i, part in enumerate(parts):
+        if part.startswith('<lb '):
+            parts[i] = part.replace('/>', ' break="no"/>', 1)
+            return
+
+
+def _column_starts(xs):
+    """Returns the indices of the lines on a page that begin a new text column,
+    given their X offsets in order. A new column is started whenever a line sits
+    further to the right than any line before it; the first line always starts
+    one."""
+    if not xs:
+        return []
+    bounds = itertools.accumulate(xs, max)
+    return [0] + [i for i, (x, bound) in enumerate(zip(xs[1:], bounds), 1) if x > bound]
+
+
+def _note_parts(notes, seen_members):
+    """Returns the XML string fragments for the transcriber notes."""
+    xmlparts = []
     for n in notes:
         attrstring = 'type="transcriptional" target="#l%s"' % n[0]
         if n[2] in seen_members:
             attrstring += ' resp="#u%s"' % n[2]
-        xmlstring += '<note %s>%s</note>\n' % (attrstring, n[1])
-    return _xmlify("<body>%s</body>" % xmlstring, facsimile, metadata, members=seen_members,
-                   special_chars=special_chars, numeric_parser=numeric_parser, postprocess=postprocess)
+        xmlparts.append('<note %s>%s</note>\n' % (attrstring, n[1]))
+    return xmlparts
+
+
+# Bump this whenever the conversion changes, so that old cache entries are not used.
+_CACHE_VERSION = 3
+
+# The fragments made by _extract_page and _note_parts, split into our own
+# markup and the transcribed text.
+_LINE_PART = re.compile(r'(<(?:pb|cb|lb) [^>]*/>)(.*)', re.S)
+_NOTE_PART = re.compile(r'(<note [^>]*>)(.*)(</note>\n)', re.S)
+
+# The tags in a series of XML fragments, apart from comments and the like, for
+# finding where the pages can be split into well-formed runs.
+_TAG = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>'
+                  r'|<(/?)[^\s/>!?]+(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>', re.S)
+# The name of the element in one of those tags
+_TAG_NAME = re.compile(r'</?([^\s/>!?]+)')
+
+
+def _page_options(members, text_filter):
+    return cache_key('page', _CACHE_VERSION, members, text_filter)
+
+
+def _cached_page(cache, options, page, members, text_filter, breaking):
+    """Returns the extracted page record for the given canvas from the cache, or
+    extracts it and stores it there. Whether the previous line ended mid-word
+    is part of the key, since it changes the first line of the page."""
+    key = cache_key(options, breaking, page)
+    data = cache.get(key)
+    if data is not None:
+        return json.loads(data.decode('utf-8'))
+    record = _extract_page(page, members, text_filter, breaking)
+    if record is not None:
+        cache.put(key, json.dumps(record, ensure_ascii=False).encode('utf-8'))
+    return record
+
+
+def _body_parts(units, registry, numeric_parser, cache=None, rules=None, stats=None, diagnostics=_IMMEDIATE):
+    """Returns the XML string fragments for the body, along with the list of
+    glyph IDs that they refer to if their shortcuts have already been fixed.
+    Without a cache this is just the extracted fragments and None.
+
+    With a cache, the pages are grouped into runs that are well-formed on their
+    own, and the fixed-up XML for each run is taken from the cache or else made
+    and stored there, so that only the runs that have changed need to be parsed
+    and fixed. If any run cannot be dealt with on its own, we fall back to doing
+    the whole body at once, so that any errors are reported just as usual."""
+    if cache is None:
+        return list(itertools.chain.from_iterable(units)), None
+    options = cache_key('run', _CACHE_VERSION, numeric_parser,
+                        None if registry is None else (registry.special_chars, registry.corrections),
+                        None if rules is None else rules.handlers())
+    xmlparts = []
+    glyphids = {}
+    for run in _runs(units):
+        text = ''.join(run)
+        key = cache_key(options, text)
+        data = cache.get(key)
+        if data is not None:
+            record = json.loads(data.decode('utf-8'))
+        else:
+            record = _fix_run(text, registry, numeric_parser, rules, stats, diagnostics)
+            if record is None:
+                return list(itertools.chain.from_iterable(units)), None
+            cache.put(key, json.dumps(record, ensure_ascii=False).encode('utf-8'))
+        xmlparts.append(record['xml'])
+        glyphids.update(dict.fromkeys(record['glyphs']))
+    return xmlparts, list(glyphids)
+
+
+def _runs(units):
+    """Generator that groups the lists of XML fragments into runs whose tags
+    are balanced, so that each run can be parsed separately."""
+    run = []
+    depth = 0
+    for unit in units:
+        run.extend(unit)
+        depth += _tag_depth(''.join(unit))
+        if depth == 0 and run:
+            yield run
+            run = []
+    if run:
+        yield run
+
+
+def _tag_depth(text):
+    """Returns the number of elements that are opened in the given XML text,
+    less the number that are closed."""
+    depth = 0
+    for m in _TAG.finditer(text):
+        closing, empty = m.groups()
+        if closing is None:  # Not an element tag
+            continue
+        if closing:
+            depth -= 1
+        elif not empty:
+            depth += 1
+    return depth
+
+
+def _isolate_faults(units, page_errors, stats=None, diagnostics=_IMMEDIATE):
+    """Find the pages whose markup is not well-formed, report each of them, and
+    return the lists of page fragments with those pages either left out (if
+    page_errors is 'skip') or with their text escaped (if it is 'wrap'). The
+    transcriber notes are dealt with one by one, in the same way.
+
+    Pages are taken together for as long as some element is still open, so
+    that for instance a paragraph that goes on over a page break is not seen
+    as an error. Each page or run of pages is parsed once; if a run is broken,
+    its pages are parsed one by one, each inside the elements left open by the
+    pages before it, to find the page that breaks it. The cost of an error thus
+    doesn't depend on the length of the manuscript. Each parse is counted in
+    stats, if it is given, and each broken page is reported to diagnostics."""
+    if page_errors not in ('skip', 'wrap'):
+        raise ValueError("page_errors must be 'skip' or 'wrap', not %s" % page_errors)
+    # The notes come last; take each of them separately.
+    units = units[:-1] + [[note] for note in units[-1]]
+    texts = [''.join(unit) for unit in units]
+    depths = [_tag_depth(text) for text in texts]
+    # The line of the body on which each unit starts
+    firstlines = list(itertools.accumulate([1] + [text.count('\n') for text in texts]))
+    result = []
+    i = 0
+    while i < len(units):
+        # Look for the end of the run of pages that starts here.
+        depth = 0
+        j = i
+        while j < len(units):
+            depth += depths[j]
+            if depth <= 0:
+                break
+            j += 1
+        if depth == 0 and j < len(units):
+            if stats is not None:
+                stats.count('parses')
+            if _parse_error(''.join(texts[i:j + 1])) is None:
+                result.extend(units[i:j + 1])
+                i = j + 1
+                continue
+        k, e = _find_fault(texts, firstlines, i, min(j + 1, len(units)), stats)
+        pn = re.match(r'<pb n="([^"]*)"', texts[k])
+        where = 'page %s' % pn.group(1) if pn else 'note'
+        diagnostics.warning('malformed-page', "%s %s, which is not well-formed: %s" % (
+            'Skipping' if page_errors == 'skip' else 'Escaping the markup of', where, e.msg),
+            {'page': pn.group(1)} if pn else None, _show_parsing_short_error(e, texts[k], firstlines[k]))
+        if k == i:
+            if page_errors == 'wrap':
+                result.append(_wrap_page(units[i]))
+            i += 1
+        elif page_errors == 'wrap':
+            # Look at the run again with the broken page made harmless.
+            units[k] = _wrap_page(units[k])
+            texts[k] = ''.join(units[k])
+            depths[k] = 0
+        else:
+            del units[k], texts[k], depths[k], firstlines[k]
+    return result
+
+
+def _find_fault(texts, firstlines, start, end, stats=None):
+    """Returns the index of the page, among those from start up to end, that
+    keeps them from being parsed together, and the error that it gives. Each
+    page is parsed inside the elements that the pages before it left open, and
+    with those that it leaves open closed at its end. A page that closes an
+    element which is open, but not innermost, shows that the page which opened
+    the innermost one never closed it; that page is then the broken one, as it
+    is if every page is fine but some element is never closed at all."""
+    stack = []  # The names of the open elements, with the page that opened each
+    for k in range(start, end):
+        after, culprit = _open_elements(texts[k], stack, k)
+        if culprit is None or culprit == k:
+            context = '<%s>' % '><'.join(name for name, _ in stack) if stack else ''
+            closing = ''.join('</%s>' % name for name, _ in reversed(after))
+            if stats is not None:
+                stats.count('parses')
+            e = _parse_error(context + texts[k] + closing, firstlines[k])
+            if e is not None:
+                return k, e
+        else:
+            break
+        stack = after
+    else:
+        if not stack:
+            culprit = start
+        else:
+            culprit = stack[-1][1]
+    if stats is not None:
+        stats.count('parses')
+    return culprit, _parse_error(texts[culprit], firstlines[culprit])
+
 
+def _open_elements(text, stack, page):
+    """Returns the stack of open elements after the given XML text, given the
+    stack before it, with those opened here marked as from the given page.
+    The second value is None, unless the text closes an element that is not
+    the innermost one open; then it is the page that opened the innermost one,
+    if the element closed is open further out, or else the given page."""
+    stack = list(stack)
+    for m in _TAG.finditer(text):
+        closing, empty = m.groups()
+        if closing is None or empty:
+            continue
+        name = _TAG_NAME.match(text, m.start()).group(1)
+        if not closing:
+            stack.append((name, page))
+        elif stack and stack[-1][0] == name:
+            stack.pop()
+        elif any(open_name == name for open_name, _ in stack):
+            return stack, stack[-1][1]
+        else:
+            return stack, page
+    return stack, None
+
+
+def _parse_error(text, firstline=1):
+    """Returns the error from parsing the given text as the content of a body
+    element, or None if it is well-formed. The line numbers of the error start
+    at firstline."""
+    try:
+        # Whitespace is allowed before the root element, and puts the lines where we want them.
+        etree.fromstring('%s<body>%s</body>' % ('\n' * (firstline - 1), text))
+    except etree.XMLSyntaxError as e:
+        return e
+    return None
+
+
+def _wrap_page(unit):
+    """Returns the fragments of a page or note whose markup is broken, with the
+    transcribed text escaped. The line breaks are kept, and the lines of a page
+    are put in a seg element to show that their markup was not parsed."""
+    xmlparts = []
+    for part in unit:
+        m = _NOTE_PART.fullmatch(part)
+        if m is not None:
+            xmlparts.append(m.group(1) + escape(m.group(2)) + m.group(3))
+        else:
+            m = _LINE_PART.fullmatch(part)
+            xmlparts.append(m.group(1) + escape(m.group(2)))
+    if xmlparts and xmlparts[0].startswith('<pb '):
+        xmlparts = [xmlparts[0], '<seg type="unparsed">'] + xmlparts[1:] + ['</seg>\n']
+    return xmlparts
+
+
+def _fix_run(text, registry, numeric_parser, rules=None, stats=None, diagnostics=_IMMEDIATE):
+    """Parse and fix the shortcuts in a run of XML, and return the fixed XML
+    along with the glyphs that it refers to, or None if this fails."""
+    if stats is not None:
+        stats.count('parses')
+    try:
+        content = etree.fromstring('<body xmlns="%s">%s</body>' % (TEI_NS, text))
+    except etree.XMLSyntaxError:
+        return None
+    glyphs_seen = set()
+    if _fix_body(content, registry, numeric_parser, glyphs_seen, rules, stats, diagnostics) is not None:
+        return None
+    xml = _escape(content.text or '') + b''.join(_serialize(el, with_tail=True) for el in content)
+    return {'xml': xml.decode('utf-8'), 'glyphs': sorted(glyphs_seen)}
+
+
+class _StreamBody:
+    """Parses the XML fragments of the text body as they are fed in, makes the
+    same corrections to them as _xmlify, and writes the result to a binary
+    file handle as soon as each piece of it is complete. Elements that are still
+    open at the end of a page (e.g. a paragraph that goes on to the next page)
+    have their start tag written, so that their content can be written out as
+    it arrives; everything written is removed from the tree. The body element
+    itself is left to the caller, who has to look at wrap_ab after close()."""
+
+    def __init__(self, out, registry, numeric_parser, diagnostics=_IMMEDIATE):
+        self.out = out
+        self.diagnostics = diagnostics
+        self.registry = registry
+        self.numeric_parser = numeric_parser
+        self.parser = etree.XMLPullParser(events=('start', 'end'))
+        self.wrap_ab = False
+        self.stack = []       # The elements that are open in the parser
+        self.opened = set()   # The open elements whose start tag we have written
+        self.closed = set()   # The elements that we wrote in pieces, but for their tail
+        self.deferred = {}    # The g elements inside each num, which must wait for it
+        self.context = {}     # The line and page before each g element
+        self.root = None
+        self.lb = None
+        self.pb = None
+        # Keep the last two fragments around for error messages.
+        self.window = []
+        self.lineno = 1
+        self.parser.feed('<body xmlns="%s">' % TEI_NS)
+        self.prefix = '<body>'
+
+    def feed(self, xmlparts, last=False):
+        """Parse the given fragments, and write out whatever is complete. Returns
+        False if there was an error, which has been reported."""
+        text = self.prefix + ''.join(xmlparts) + ('</body>' if last else '')
+        self.prefix = ''
+        self.window = self.window[-1:] + [(self.lineno, text)]
+        self.lineno += text.count('\n')
+        try:
+            for part in xmlparts:
+                self.parser.feed(part)
+            if last:
+                self.parser.feed('</body>')
+                self.parser.close()
+            for event, el in self.parser.read_events():
+                if event == 'start':
+                    self._start(el)
+                elif not self._end(el):
+                    return False
+        except etree.XMLSyntaxError as e:
+            firstline = self.window[0][0]
+            txdata = ''.join(t for _, t in self.window)
+            self.diagnostics.error('xml-syntax', "Parsing error in the JSON: %s" % e.msg,
+                                   detail=_show_parsing_short_error(e, txdata, firstline))
+            return False
+        self._flush(last)
+        return True
+
+    def close(self, xmlparts):
+        """Feed the last fragments, and finish the body."""
+        return self.feed(xmlparts, last=True)
+
+    def _start(self, el):
+        if self.root is None:
+            self.root = el
+        self.stack.append(el)
+        if el.tag == _tei('lb'):
+            self.lb = el
+        elif el.tag == _tei('pb'):
+            self.pb = el
+        elif el.tag == _tei('g') and self.registry is not None:
+            self.context[el] = (self.lb, self.pb)
 
-def _xmlify(txdata, facsimile, metadata, members=None, special_chars=None, numeric_parser=None, postprocess=None):
-    """Take the extracted XML structure of from_sc and make sure it is
-    well-formed. Also fix any shortcuts, e.g. for the glyph tags."""
+    def _end(self, el):
+        self.stack.pop()
+        if el in self.opened:
+            # Write whatever is left of it.
+            for child in list(el):
+                self._write(child)
+                el.remove(child)
+            self.out.write(('</%s>' % etree.QName(el).localname).encode('utf-8'))
+            self.opened.discard(el)
+            self.closed.add(el)
+            return True
+        if el.tag == _tei('num') and self.numeric_parser is not None:
+            _fix_num(el, self.numeric_parser, self.diagnostics)
+            for glyph in self.deferred.pop(el, []):
+                if not self._glyph(glyph):
+                    return False
+        elif el.tag == _tei('g') and self.registry is not None:
+            # The number parser has to see the glyph as it was transcribed.
+            num = None
+            if self.numeric_parser is not None:
+                for ancestor in reversed(self.stack):
+                    if ancestor.tag == _tei('num'):
+                        num = ancestor
+                        break
+            if num is not None:
+                self.deferred.setdefault(num, []).append(el)
+            elif not self._glyph(el):
+                return False
+        _fix_edit(el)
+        _fix_cert(el)
+        return True
+
+    def _glyph(self, glyph):
+        lb, pb = self.context.pop(glyph)
+        try:
+            # All the glyphs we know are already in the header.
+            _fix_glyph(glyph, self.registry, set())
+        except ValueError as e:
+            _glyph_error(glyph, lb, pb, e, self.diagnostics)
+            return False
+        return True
+
+    def _flush(self, last):
+        """Write out everything that is complete. Apart from at the very end, the
+        last child of any element might still get some more tail text."""
+        body = self.root
+        if body is None:
+            return
+        if body.text is not None and (len(body) or last):
+            self._check_ab(body.text)
+            self.out.write(_escape(body.text))
+            body.text = None
+        for el in [body] + self.stack[1:]:
+            if el is not body and el not in self.opened:
+                # Open it, if we know its text and don't need to see the whole of it.
+                if not len(el) or el.tag in (_tei('num'), _tei('g')) or not el.tag.startswith('{%s}' % TEI_NS):
+                    break
+                _fix_edit(el)
+                _fix_cert(el)
+                self.out.write(_start_tag(el))
+                el.text = None
+                self.opened.add(el)
+            children = list(el)
+            if not last:
+                children = children[:-1]
+            for child in children:
+                if el is body:
+                    self._check_ab(child.tail)
+                self._write(child)
+                el.remove(child)
+
+    def _write(self, el):
+        if el in self.closed:
+            self.closed.discard(el)
+            if el.tail is not None:
+                self.out.write(_escape(el.tail))
+        else:
+            self.out.write(_serialize(el, with_tail=True))
+
+    def _check_ab(self, text):
+        # Does the 'body' element have any direct text nodes? If so, the whole thing
+        # will need to be wrapped in an anonymous block.
+        if text is not None and not re.match(r'\s+', text):
+            self.wrap_ab = True
+
+
+def _xmlify(xmlparts, facsimile, metadata, members=None, registry=None, numeric_parser=None,
+            postprocess=None, glyphs_fixed=None, rules=None, stats=None, diagnostics=_IMMEDIATE):
+    """Take the extracted XML fragments of from_sc and make sure they are
+    well-formed. Also fix any shortcuts, e.g. for the glyph tags. The fragments
+    are parsed straight into the TEI namespace, so that the final document
+    can be put together without having to serialize and re-parse it.
+
+    If the shortcuts in the fragments have already been fixed, glyphs_fixed
+    should be the list of the names of the glyphs that they refer to.
+
+    The time taken by each step, and the numbers of glyphs and numbers that
+    are fixed, are recorded in stats if it is given. Problems are reported to
+    diagnostics."""
+    parser = etree.XMLParser()
     try:
-        content = etree.fromstring(txdata)
+        with timed(stats, 'parse'):
+            if stats is not None:
+                stats.count('parses')
+            parser.feed('<body xmlns="%s">' % TEI_NS)
+            for part in xmlparts:
+                parser.feed(part)
+            parser.feed('</body>')
+            content = parser.close()
     except etree.XMLSyntaxError as e:
-        message = "Parsing error in the JSON: %s\n" % e.msg
+        # Only now do we need the body as a single string.
+        txdata = "<body>%s</body>" % ''.join(xmlparts)
         # This is an option, not default, to reduce the amount of XML parsing error data generated.
         if metadata.get('short_error', False):
-            message += _show_parsing_short_error(e, txdata)
+            detail = _show_parsing_short_error(e, txdata)
         else:
-            message += "Full string was %s" % txdata
-        safeerrmsg(message)
+            detail = "Full string was %s" % txdata
+        diagnostics.error('xml-syntax', "Parsing error in the JSON: %s" % e.msg, detail=detail)
         return
 
     # Does the 'body' element have any direct text nodes? If so, wrap the whole thing in an
     # anonymous block, so that it becomes valid TEI.
-    wrap_ab = content.text is not None and not re.match(r'\s+', content.text)
-    for el in content:
-        if el.tail is not None and not re.match(r'\s+', el.tail):
-            wrap_ab = True
-    if wrap_ab:
-        print("WARNING: unblocked text detected. Wrapping in anonymous block", file=sys.stderr)
-        txdata = txdata.replace('<body>', '<body><ab>').replace('</body>', '</ab></body>')
-        try:
-            content = etree.fromstring(txdata)
-        except etree.XMLSyntaxError as e:
-            message = "Parsing error in block wrap: %s\n" % e.msg
-            if metadata.get('short_error', False):
-                message += _show_parsing_short_error(e, txdata)
-            else:
-                message += "Full string was %s" % txdata
-            safeerrmsg(message)
-            return
+    with timed(stats, 'wrap_ab'):
+        wrap_ab = content.text is not None and not re.match(r'\s+', content.text)
+        for el in content:
+            if el.tail is not None and not re.match(r'\s+', el.tail):
+                wrap_ab = True
+        if wrap_ab:
+            diagnostics.warning('unblocked-text', "unblocked text detected. Wrapping in anonymous block")
+            ab = etree.Element(_tei('ab'))
+            ab.text = content.text
+            content.text = None
+            ab.extend(list(content))
+            content.append(ab)
+
+    glyphs_seen = set()
+    if glyphs_fixed is not None:
+        glyphs_seen.update(glyphs_fixed)
+    else:
+        with timed(stats, 'fixup'):
+            failed = _fix_body(content, registry, numeric_parser, glyphs_seen, rules, stats, diagnostics)
+        if failed is not None:
+            glyph, e = failed
+            lb = glyph.xpath('./preceding::t:lb[1]', namespaces=_NS)[0]
+            pb = glyph.xpath('./preceding::t:pb[1]', namespaces=_NS)[0]
+            _glyph_error(glyph, lb, pb, e, diagnostics)
+            return None
+
+    return _tei_wrap(content, facsimile, metadata, members,
+                     registry.glyphs(glyphs_seen) if registry is not None else [],
+                     postprocess, stats)
 
-    # First add values to the numbers if we have a way to.
+
+def _fix_body(content, registry, numeric_parser, glyphs_seen, rules=None, stats=None, diagnostics=_IMMEDIATE):
+    """Fix the shortcuts in the parsed body content, adding the names of the
+    glyphs that are referred to into the glyphs_seen set, and apply any further
+    rules, all in one walk over the body. If a glyph cannot be found, returns
+    the first offending g element along with the error."""
+    failures = []
+    walk = _fixup_rules(registry, numeric_parser, glyphs_seen, failures, stats, diagnostics)
+    if rules is not None:
+        walk.extend(rules)
+    walk.walk(content)
+    return failures[0] if failures else None
+
+
+def _fixup_rules(registry, numeric_parser, glyphs_seen, failures, stats=None, diagnostics=_IMMEDIATE):
+    """Returns the Rules for the built-in fixes. Glyphs that cannot be found are
+    added to the failures list. The glyphs and numbers are counted in stats, if
+    it is given, and numbers that cannot be parsed are reported to diagnostics."""
+    rules = Rules()
+    # The numbers have to be parsed before the glyphs in them are changed; the
+    # walk reaches a num element before anything inside it.
     if numeric_parser is not None:
-        for num in content.xpath('//num'):
-            if 'value' in num.keys():
-                try:
-                    float(num.get('value'))
-                    continue
-                except ValueError:
-                    pass
-            # If we get here, we haven't got a valid value.
-            numtext = etree.tostring(num, method='text', with_tail=False, encoding='utf-8').decode('utf-8')
+        rules.add(lambda num: _fix_num(num, numeric_parser, diagnostics), tag='num')
+    if stats is not None:
+        rules.add(lambda num: stats.count('nums'), tag='num')
+
+    if registry is not None:
+        def fix_glyph(glyph):
+            if failures:  # There is no point going on.
+                return
+            if stats is not None:
+                stats.count('glyphs')
             try:
-                numval = numeric_parser(numtext)
-                float(numval)
-                num.set('value', numval.__str__())
-            except ValueError:
-                warn("Numeric parser could not parse data %s" % numtext)
-
-    # Now fix the glyph references.
-    glyphs_seen = {}
-    if special_chars is not None:
-        # LATER get this hard-coded list into a settings file. Or better yet, correct
-        # the transcriptions.
-        glyph_correction = {
-            'the': 'թե',
-            'thE': 'թէ',
-            'und': 'ընդ',
-            'thi': 'թի',
-            'asxarh': 'աշխարհ',
-            'pt': 'պտ',
-            'yr': 'յր',
-            'orpes': 'որպէս',
-        }
-        for glyph in content.xpath('//g'):
-            # Find the characters that we have glyph-marked. It could have been done
-            # in a couple of different ways.
-            glyphid = ''
-            gtext_explicit = False
-            # There might be an explicit 'ref' attribute, which may or may not have a non-empty value.
-            if glyph.get('ref'):
-                glyphid = glyph.get('ref')
-                if glyphid.find('#') == 0:  # The ref is meaningful and should be preserved.
-                    glyphid = glyphid[1:]
-            if glyph.text:
-                if glyphid == '':  # The glyph should be identified from the element text content.
-                    glyphid = glyph.text
-                else:
-                    gtext_explicit = True  # We have set a real ref and also text; both should be preserved.
-            if glyphid in glyph_correction:  # Check whether we need to use the hardcoded hack.
-                glyphid = glyph_correction[glyphid]
-            # Now figure out what the reference is for this glyph. Make the
-            # XML element if necessary.
-            if glyphid not in glyphs_seen:
-                try:
-                    glyphs_seen[glyphid] = _get_glyph(glyphid, special_chars)
-                except ValueError as e:
-                    lb = glyph.xpath('./preceding::lb[1]')[0]
-                    message = "In g element %s, line %s / %s, page %s:\n" % \
-                              (etree.tostring(glyph, encoding='utf-8', with_tail=False).decode('utf-8'),
-                               lb.get('{http://www.w3.org/XML/1998/namespace}id').lstrip('l'),
-                               lb.get('n'),
-                               glyph.xpath('./preceding::pb[1]')[0].get('n'))
-                    message += e.__str__() + "\n"
-                    safeerrmsg(message)
-                    return None
-            gref = '#%s' % glyphs_seen[glyphid].get('{http://www.w3.org/XML/1998/namespace}id')
-            # Finally, fix the 'g' element here so that it is canonical.
-            glyph.set('ref', gref)
-            if not gtext_explicit:
-                glyph.text = glyphid
-
-    for el in content.xpath('//corr'):
-        el.tag = 'subst'
-    # We should be using 'rend' and not 'type' for the subst and del tags.
-    for edit in content.xpath('//subst | //del'):
-        if edit.get('type'):
-            rend = edit.get('type')
-            edit.set('rend', rend)
-            edit.attrib.pop('type')
+                _fix_glyph(glyph, registry, glyphs_seen)
+            except ValueError as e:
+                failures.append((glyph, e))
+        rules.add(fix_glyph, tag='g')
+
+    for tag in ('corr', 'subst', 'del'):
+        rules.add(_fix_edit, tag=tag)
 
     # And 'certainty' attributes have to have the value 'high, 'medium', or 'low'.
-    for el in content.xpath('//*[@cert]'):
-        certval = el.get('cert')
-        if re.match('^\d+$', certval):
-            if int(certval) >= 70:
-                el.set('cert', 'high')
-            elif int(certval) >= 45:
-                el.set('cert', 'medium')
+    rules.add(_fix_cert, attribute='cert')
+    return rules
+
+
+class Rules:
+    """A set of rewrites for the elements of the text body, which are carried
+    out together in a single walk over the body once it has been parsed. Each
+    rule is a function that takes an element and changes it in place; it can
+    be registered either for an element name, or for an attribute name, in
+    which case it is called for every element that has that attribute. Names
+    are taken to be in the TEI namespace unless they are given as
+    '{namespace}name'.
+
+    An element's rules are called in the order they were added, those for its
+    element name first. If a rule renames the element, the rules for the new
+    name are called too. A rule may change the element's descendants, which
+    the walk has yet to reach, but it must not remove the element itself from
+    the tree.
+
+    The fixes that tpen2tei makes for glyphs, numbers, and so on are done with
+    rules; all of them are done for each element before any of the rules that
+    are passed to from_sc."""
+
+    def __init__(self):
+        # Each set of rules that is added with extend is kept apart, so that
+        # all of one set is done before the next.
+        self._layers = [({}, {})]
+
+    def add(self, func, tag=None, attribute=None):
+        """Register func as a rule for the element name tag, or for elements with
+        the given attribute."""
+        if (tag is None) == (attribute is None):
+            raise ValueError('A rule needs either a tag or an attribute')
+        tags, attributes = self._layers[-1]
+        if tag is not None:
+            tags.setdefault(_clark(tag), []).append(func)
+        else:
+            attributes.setdefault(_clark(attribute, None), []).append(func)
+        return func
+
+    def rule(self, tag=None, attribute=None):
+        """Decorator form of add."""
+        return lambda func: self.add(func, tag=tag, attribute=attribute)
+
+    def extend(self, other):
+        """Add the rules of another Rules object, to be done after these ones."""
+        self._layers.extend((dict(tags), dict(attributes)) for tags, attributes in other._layers)
+        self._layers.append(({}, {}))
+        return self
+
+    def handlers(self):
+        """Returns the registered rules, for telling one set of rules from another."""
+        return [(sorted(tags.items()), sorted(attributes.items())) for tags, attributes in self._layers]
+
+    def walk(self, root):
+        """Apply the rules to the given element and everything within it."""
+        layers = [(tags, list(attributes.items())) for tags, attributes in self._layers
+                  if tags or attributes]
+        for _, el in etree.iterwalk(root, events=('start',)):
+            if not isinstance(el.tag, str):  # A comment or processing instruction
+                continue
+            for tags, attributes in layers:
+                tag = el.tag
+                done = set()
+                while tag in tags and tag not in done:
+                    done.add(tag)
+                    for func in tags[tag]:
+                        func(el)
+                    tag = el.tag
+                for attribute, funcs in attributes:
+                    if el.get(attribute) is not None:
+                        for func in funcs:
+                            func(el)
+
+
+def _clark(name, namespace=TEI_NS):
+    """Returns the lxml-style name for the given element or attribute name."""
+    if name.startswith('{') or namespace is None:
+        return name
+    return '{%s}%s' % (namespace, name)
+
+
+# LATER get this hard-coded list into a settings file. Or better yet, correct
+# the transcriptions.
+GLYPH_CORRECTION = {
+    'the': 'թե',
+    'thE': 'թէ',
+    'und': 'ընդ',
+    'thi': 'թի',
+    'asxarh': 'աշխարհ',
+    'pt': 'պտ',
+    'yr': 'յր',
+    'orpes': 'որպէս',
+}
+
+
+class GlyphRegistry:
+    """The glyphs that may be referenced in transcriptions, ready to be looked
+    up. It is made from a special_chars dictionary as described for from_sc, and
+    a table of corrections from glyph names that transcribers have used to the
+    names in special_chars (by default GLYPH_CORRECTION). The reference for
+    every name is worked out once, and each thread builds the glyph elements for
+    the header only once, handing out copies of them; so the same registry can
+    be used for any number of documents, in any number of threads, and it can be
+    pickled to send to worker processes."""
+
+    def __init__(self, special_chars, corrections=None):
+        if corrections is None:
+            corrections = GLYPH_CORRECTION
+        self.special_chars = dict(special_chars)
+        self.corrections = dict(corrections)
+        # Map each name we accept to its canonical name and reference.
+        self._refs = {gname: (gname, '#%s' % ginfo[0]) for gname, ginfo in self.special_chars.items()}
+        for wrong, right in self.corrections.items():
+            if right in self.special_chars:
+                self._refs[wrong] = (right, '#%s' % self.special_chars[right][0])
             else:
-                el.set('cert', 'low')
+                self._refs.pop(wrong, None)
+        self._local = threading.local()
 
-    return _tei_wrap(content, facsimile, metadata, members,
-                     sorted(glyphs_seen.values(),
-                            key=lambda x: x.get('{http://www.w3.org/XML/1998/namespace}id')),
-                     postprocess)
+    def __reduce__(self):
+        return self.__class__, (self.special_chars, self.corrections)
+
+    def __contains__(self, gname):
+        return gname in self._refs
+
+    def __iter__(self):
+        return iter(self.special_chars)
+
+    def __len__(self):
+        return len(self.special_chars)
+
+    def resolve(self, gname):
+        """Returns the canonical name of the given glyph, after any correction, and
+        the reference to its declaration. Raises a ValueError if there is no such
+        glyph."""
+        try:
+            return self._refs[gname]
+        except KeyError:
+            raise ValueError("Glyph %s not recognized" % self.corrections.get(gname, gname)) from None
+
+    def glyph(self, gname):
+        """Returns a TEI XML 'glyph' element for the given canonical name."""
+        prebuilt = getattr(self._local, 'glyphs', None)
+        if prebuilt is None:
+            prebuilt = self._local.glyphs = {}
+        if gname not in prebuilt:
+            prebuilt[gname] = _get_glyph(gname, self.special_chars)
+        return copy.deepcopy(prebuilt[gname])
+
+    def glyphs(self, gnames):
+        """Returns the glyph elements for the given canonical names, in the order
+        of their IDs, as they belong in the header."""
+        return [self.glyph(gname) for gname in sorted(gnames, key=lambda g: (str(self.special_chars[g][0]), g))]
+
+
+def _glyph_registry(special_chars):
+    """Returns the GlyphRegistry for the special_chars option."""
+    if special_chars is None or isinstance(special_chars, GlyphRegistry):
+        return special_chars
+    return GlyphRegistry(special_chars)
+
+
+def _fix_num(num, numeric_parser, diagnostics=_IMMEDIATE):
+    """Give a 'num' element a value, if it doesn't already have a valid one."""
+    if 'value' in num.keys():
+        try:
+            float(num.get('value'))
+            return
+        except ValueError:
+            pass
+    # If we get here, we haven't got a valid value.
+    numtext = etree.tostring(num, method='text', with_tail=False, encoding='utf-8').decode('utf-8')
+    try:
+        numval = numeric_parser(numtext)
+        float(numval)
+        num.set('value', numval.__str__())
+    except ValueError:
+        diagnostics.warning('numeric-parse', "Numeric parser could not parse data %s" % numtext)
+
+
+def _fix_glyph(glyph, registry, glyphs_seen):
+    """Make the given 'g' element canonical, and add the name of the glyph it
+    refers to to the glyphs_seen set. Raises a ValueError if the glyph is not in
+    the registry."""
+    # Find the characters that we have glyph-marked. It could have been done
+    # in a couple of different ways.
+    glyphid = ''
+    gtext_explicit = False
+    # There might be an explicit 'ref' attribute, which may or may not have a non-empty value.
+    if glyph.get('ref'):
+        glyphid = glyph.get('ref')
+        if glyphid.find('#') == 0:  # The ref is meaningful and should be preserved.
+            glyphid = glyphid[1:]
+    if glyph.text:
+        if glyphid == '':  # The glyph should be identified from the element text content.
+            glyphid = glyph.text
+        else:
+            gtext_explicit = True  # We have set a real ref and also text; both should be preserved.
+    # Now figure out what the reference is for this glyph, correcting its name
+    # if necessary.
+    glyphid, gref = registry.resolve(glyphid)
+    glyphs_seen.add(glyphid)
+    # Finally, fix the 'g' element here so that it is canonical.
+    glyph.set('ref', gref)
+    if not gtext_explicit:
+        glyph.text = glyphid
+
+
+def _glyph_error(glyph, lb, pb, e, diagnostics):
+    """Report a glyph that could not be resolved, given the line and page where
+    it occurs."""
+    diagnostics.error('unknown-glyph', e.__str__(),
+                      {'page': pb.get('n'), 'line': lb.get(XML_ID).lstrip('l'), 'n': lb.get('n')},
+                      _fragment(glyph))
+
+
+def _fix_edit(el):
+    """Turn the erroneous 'corr' elements into 'subst'. We should also be using
+    'rend' and not 'type' for the subst and del tags."""
+    if el.tag == _tei('corr'):
+        el.tag = _tei('subst')
+    if el.tag in (_tei('subst'), _tei('del')) and el.get('type'):
+        rend = el.get('type')
+        el.set('rend', rend)
+        el.attrib.pop('type')
+
+
+def _fix_cert(el):
+    """Turn a numeric 'cert' attribute into 'high', 'medium', or 'low'."""
+    certval = el.get('cert')
+    if certval is not None and re.match('^\d+$', certval):
+        if int(certval) >= 70:
+            el.set('cert', 'high')
+        elif int(certval) >= 45:
+            el.set('cert', 'medium')
+        else:
+            el.set('cert', 'low')
 
 
 def _get_glyph(gname, special_chars):
@@ -303,47 +1592,86 @@ def _get_glyph(gname, special_chars):
     if gname not in special_chars:
         raise ValueError("Glyph %s not recognized" % gname)
 
-    glyph_el = etree.Element('glyph')
-    glyph_el.set('{http://www.w3.org/XML/1998/namespace}id', '%s' % special_chars[gname][0])
-    etree.SubElement(glyph_el, 'glyphName').text = special_chars[gname][1]
-    etree.SubElement(glyph_el, 'mapping').text = gname
+    glyph_el = etree.Element(_tei('glyph'), nsmap=_NSMAP)
+    glyph_el.set(XML_ID, '%s' % special_chars[gname][0])
+    etree.SubElement(glyph_el, _tei('glyphName')).text = special_chars[gname][1]
+    etree.SubElement(glyph_el, _tei('mapping')).text = gname
     return glyph_el
 
 
 def _make_surface(sinfo):
     """Returns a TEI XML 'surface' element for the given surface
     information, including graphic and zone geometry."""
-    surface_el = etree.Element('surface')
+    surface_el = etree.Element(_tei('surface'), nsmap=_NSMAP)
     surface_el.set('ulx', '0')
     surface_el.set('uly', '0')
     surface_el.set('lrx', "%d" % sinfo['width'])
     surface_el.set('lry', "%d" % sinfo['height'])
-    etree.SubElement(surface_el, 'graphic').set('url', sinfo['graphic'])
-    for zone in sinfo['zones']:
-        z_el = etree.SubElement(surface_el, 'zone')
-        z_el.set('{http://www.w3.org/XML/1998/namespace}id', 'z%s' % zone['id'])
-        z_el.set('ulx', zone['points'][0])
-        z_el.set('uly', zone['points'][1])
-        z_el.set('lrx', "%d" % (int(zone['points'][0]) + int(zone['points'][2])))
-        z_el.set('lry', "%d" % (int(zone['points'][1]) + int(zone['points'][3])))
+    etree.SubElement(surface_el, _tei('graphic')).set('url', sinfo['graphic'])
+    for zoneid, x, y, w, h in sinfo['zones']:
+        z_el = etree.SubElement(surface_el, _tei('zone'))
+        z_el.set(XML_ID, 'z%s' % zoneid)
+        z_el.set('ulx', "%d" % x)
+        z_el.set('uly', "%d" % y)
+        z_el.set('lrx', "%d" % (x + w))
+        z_el.set('lry', "%d" % (y + h))
     return surface_el
 
 
-def _show_parsing_short_error(e, st):
-    # Figure out where the error is
+def _tei(tag):
+    """Returns the lxml-style name of the given TEI element."""
+    return '{%s}%s' % (TEI_NS, tag)
+
+
+def _fragment(el):
+    """Returns the given element as a string for an error message, without the
+    namespace declaration that lxml would add to it."""
+    return etree.tostring(el, encoding='utf-8', with_tail=False).decode('utf-8').replace(
+        ' xmlns="%s"' % TEI_NS, '')
+
+
+def _serialize(el, with_tail=False):
+    """Returns the given element as UTF-8 XML, to be written out inside the TEI
+    root element; that is, without its own declaration of the TEI namespace."""
+    return etree.tostring(el, encoding='utf-8', with_tail=with_tail).replace(
+        (' xmlns="%s"' % TEI_NS).encode('utf-8'), b'', 1)
+
+
+def _start_tag(el):
+    """Returns the start tag of the given element, followed by its text, as
+    UTF-8 XML."""
+    shell = etree.Element(el.tag, nsmap=_NSMAP)
+    for key, value in el.items():
+        shell.set(key, value)
+    shell.text = el.text
+    tag = _serialize(shell)
+    if tag.endswith(b'/>'):
+        return tag[:-2] + b'>'
+    return tag[:-len('</%s>' % etree.QName(el).localname)]
+
+
+def _escape(text):
+    return escape(text).encode('utf-8')
+
+
+def _show_parsing_short_error(e, st, firstline=1):
+    # Figure out where the error is. The string might be only a part of the XML
+    # that was parsed, in which case firstline says where it starts.
+    offset = firstline - 1
     txlines = st.splitlines()
     problemstart = e.position[0] - 1
     # Is it an error that spans multiple lines? If so figure out where it starts
     tagmismatch = re.search('Opening and ending tag mismatch: \w+ line (\d+)', e.msg)
     if tagmismatch is not None:
-        problemstart = int(tagmismatch.group(1)) - 1
+        problemstart = max(int(tagmismatch.group(1)) - 1, offset)
     # Look up the page where the error starts
     pagestart = problemstart
-    for i in range(problemstart, -1, -1):
-        if '<pb n=' in txlines[i]:
+    for i in range(problemstart, offset - 1, -1):
+        if '<pb n=' in txlines[i - offset]:
             pagestart = i
             break
-    diagnostic_loc = ["%d: %s" % (i + 1, txlines[i]) for i in range(pagestart, e.position[0])]
+    diagnostic_loc = ["%d: %s" % (i + 1, txlines[i - offset])
+                      for i in range(pagestart, min(e.position[0], offset + len(txlines)))]
     if e.position[0] - problemstart > 100:
         # Restrict the output to the single page of the problem
         for i in range(1, len(diagnostic_loc)):
@@ -360,9 +1688,33 @@ def safeerrmsg(message):
         print(message, file=sys.stderr)
 
 
-def _tei_wrap(content, facsimile, metadata, members, glyphs, postprocess):
+def _tei_wrap(content, facsimile, metadata, members, glyphs, postprocess, stats=None):
     """Wraps the content, and the glyphs that were found, into TEI XML format."""
-    # Set some trivial default TEI header values, if they are not already set
+    metadata = _set_defaults(metadata)
+
+    # Now make the outer TEI wrapper and the header for the content we have been passed.
+    tei = etree.Element(_tei('TEI'), nsmap=_NSMAP)
+    with timed(stats, 'header'):
+        tei.append(_tei_header(metadata, members, glyphs))
+    with timed(stats, 'assemble'):
+        # Now make the facsimile element and its content
+        facs_el = etree.SubElement(tei, _tei('facsimile'))
+        for surface in facsimile:
+            facs_el.append(_make_surface(surface))
+        # Then add the content.
+        etree.SubElement(tei, _tei('text')).append(content)
+        # Finally, set the schema. The namespace is already right, since we built the
+        # document in it.
+        tei_doc = etree.ElementTree(tei)
+        tei.addprevious(_schema_pi(metadata))
+    if postprocess is not None:
+        with timed(stats, 'postprocess'):
+            postprocess(tei_doc)
+    return tei_doc
+
+
+def _set_defaults(metadata):
+    """Set some trivial default TEI header values, if they are not already set."""
     defaults = {
         'title': 'A manuscript transcribed with T-PEN',
         'publicationStmt': 'Unpublished manuscript',
@@ -373,81 +1725,68 @@ def _tei_wrap(content, facsimile, metadata, members, glyphs, postprocess):
     for key in defaults.keys():
         if key not in metadata:
             metadata[key] = defaults[key]
+    return metadata
 
-    # Now make the outer TEI wrapper and the header for the content we have been passed.
-    tei = etree.Element('TEI')
-    file_desc = etree.SubElement(etree.SubElement(tei, 'teiHeader'), 'fileDesc')
-    title_stmt = etree.SubElement(file_desc, 'titleStmt')
-    etree.SubElement(title_stmt, 'title').text = metadata['title']
+
+def _schema_pi(metadata):
+    """Returns the processing instruction that associates the TEI schema."""
+    pi = 'href="%s" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"' % metadata['teiSchema']
+    return etree.ProcessingInstruction('xml-model', pi)
+
+
+def _tei_header(metadata, members, glyphs):
+    """Returns the teiHeader element for the given metadata, transcribers, and glyphs."""
+    tei_header = etree.Element(_tei('teiHeader'), nsmap=_NSMAP)
+    file_desc = etree.SubElement(tei_header, _tei('fileDesc'))
+    title_stmt = etree.SubElement(file_desc, _tei('titleStmt'))
+    etree.SubElement(title_stmt, _tei('title')).text = metadata['title']
     if 'author' in metadata:
-        etree.SubElement(title_stmt, 'author').text = metadata['author']
-    edition_stmt = etree.SubElement(file_desc, 'editionStmt')
-    etree.SubElement(edition_stmt, 'edition').text = 'T-Pen transcription'
+        etree.SubElement(title_stmt, _tei('author')).text = metadata['author']
+    edition_stmt = etree.SubElement(file_desc, _tei('editionStmt'))
+    etree.SubElement(edition_stmt, _tei('edition')).text = 'T-Pen transcription'
     if members is not None:
         # Add the transcribers that we have seen
         for mid, minfo in members.items():
-            resp_stmt = etree.SubElement(edition_stmt, 'respStmt')
-            resp_stmt.set('{http://www.w3.org/XML/1998/namespace}id', "u%s" % mid)
-            etree.SubElement(resp_stmt, 'resp').text = 'T-Pen transcriber'
+            resp_stmt = etree.SubElement(edition_stmt, _tei('respStmt'))
+            resp_stmt.set(XML_ID, "u%s" % mid)
+            etree.SubElement(resp_stmt, _tei('resp')).text = 'T-Pen transcriber'
             key = 'name'
             if key not in minfo:
                 key = 'uname'
-            etree.SubElement(resp_stmt, 'name').text = minfo.get(key, 'Anonymous')
-    etree.SubElement(etree.SubElement(file_desc, 'publicationStmt'), 'p').text = metadata['publicationStmt']
+            etree.SubElement(resp_stmt, _tei('name')).text = minfo.get(key, 'Anonymous')
+    etree.SubElement(etree.SubElement(file_desc, _tei('publicationStmt')), _tei('p')).text = metadata['publicationStmt']
 
     # Source and manuscript description
-    msdesc = etree.SubElement(etree.SubElement(file_desc, 'sourceDesc'), 'msDesc')
+    msdesc = etree.SubElement(etree.SubElement(file_desc, _tei('sourceDesc')), _tei('msDesc'))
     # Do we have a settlement/repository/ID defined? If so make the msIdentifier an XML ID.
     has_rich_id = 'msSettlement' in metadata or 'msRepository' in metadata or 'msIdNumber' in metadata
     if 'msIdentifier' in metadata:
-        desc_container = etree.SubElement(msdesc, 'msIdentifier')
+        desc_container = etree.SubElement(msdesc, _tei('msIdentifier'))
         if has_rich_id:
-            msdesc.set('{http://www.w3.org/XML/1998/namespace}id', metadata['msIdentifier'])
+            msdesc.set(XML_ID, metadata['msIdentifier'])
             if 'msSettlement' in metadata:
-                etree.SubElement(desc_container, 'settlement').text = metadata['msSettlement']
+                etree.SubElement(desc_container, _tei('settlement')).text = metadata['msSettlement']
             if 'msRepository' in metadata:
-                etree.SubElement(desc_container, 'repository').text = metadata['msRepository']
+                etree.SubElement(desc_container, _tei('repository')).text = metadata['msRepository']
             if 'msIdNumber' in metadata:
-                etree.SubElement(desc_container, 'idno').text = metadata['msIdNumber']
+                etree.SubElement(desc_container, _tei('idno')).text = metadata['msIdNumber']
         else:  # If not, use the text content of the identifier as the XML msIdentifier content.
             desc_container.text = metadata['msIdentifier']
     has_origin = 'date' in metadata or 'location' in metadata
     if has_origin:
-        origin = etree.SubElement(etree.SubElement(msdesc, 'history'), 'origin')
+        origin = etree.SubElement(etree.SubElement(msdesc, _tei('history')), _tei('origin'))
         if 'date' in metadata:
-            etree.SubElement(origin, 'origDate').text = metadata['date']
+            etree.SubElement(origin, _tei('origDate')).text = metadata['date']
         if 'location' in metadata:
-            etree.SubElement(origin, 'origPlace').text = metadata['location']
+            etree.SubElement(origin, _tei('origPlace')).text = metadata['location']
     if 'description' in metadata:
-        etree.SubElement(msdesc, 'p').text = metadata['description']
+        etree.SubElement(msdesc, _tei('p')).text = metadata['description']
     # TODO consider filling out msContents / msItem
 
     # Then add the glyphs we used
     if len(glyphs):
-        etree.SubElement(etree.SubElement(tei.find('teiHeader'), 'encodingDesc'), 'charDecl').extend(glyphs)
-    # Now make the facsimile element and its content
-    facs_el = etree.SubElement(tei, 'facsimile')
-    for surface in facsimile:
-        facs_el.append(_make_surface(surface))
-    # Then add the content.
-    etree.SubElement(tei, 'text').append(content)
-    # Finally, set the appropriate namespace and schema.
-    tei.set('xmlns', 'http://www.tei-c.org/ns/1.0')
-    tei_doc = etree.ElementTree(tei)
-    pi = 'href="%s" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"' % metadata['teiSchema']
-    schema = etree.ProcessingInstruction('xml-model', pi)
-    tei.addprevious(schema)
-    # Now that we've done this, serialize and re-parse the entire TEI doc
-    # so that the namespace functionality works.
-    try:
-        tei_doc = etree.parse(BytesIO(etree.tostring(tei_doc)))
-    except etree.XMLSyntaxError as e:
-        message = "Error in final parse: "
-        message += _show_parsing_short_error(e, etree.tostring(tei_doc, encoding="utf-8").decode('utf-8'))
-        safeerrmsg(message)
-    if postprocess is not None:
-        postprocess(tei_doc)
-    return tei_doc
+        etree.SubElement(etree.SubElement(tei_header, _tei('encodingDesc')), _tei('charDecl')).extend(glyphs)
+    return tei_header
 
 
 if __name__ == '__main__':
@@ -462,14 +1801,85 @@ if __name__ == '__main__':
         action="store_true",
         help="Reduce the amount of error output on XML parsing failures"
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the TEI output as it is converted, rather than building the whole document first"
+    )
+    parser.add_argument(
+        "--page-errors",
+        choices=['skip', 'wrap'],
+        help="Skip, or keep with the markup escaped, any page that is not well-formed, instead of failing"
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Directory in which to keep converted pages, so that only changed pages are converted again"
+    )
+    parser.add_argument(
+        "--output-cache",
+        metavar="DIR",
+        help="Directory in which to keep converted documents, so that an unchanged manuscript is not converted again"
+    )
+    parser.add_argument(
+        "--json-backend",
+        choices=JSON_BACKENDS,
+        help="Decode the whole manifest at once with this JSON library, rather than page by page"
+    )
+    parser.add_argument(
+        "--zone-index",
+        metavar="FILE",
+        help="Write an index of the line zones of each page to this JSON sidecar file"
+    )
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSIONS,
+        help="Compress the TEI output with gzip or xz"
+    )
+    parser.add_argument(
+        "-j", "--page-workers",
+        type=int,
+        metavar="N",
+        help="Extract the pages in parallel in this many worker processes"
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the time taken by each phase of the conversion, and what was converted, to stderr"
+    )
     parser.add_argument(
         "infile",
-        help="SC-JSON file containing a T-PEN transcription",
+        help="SC-JSON file containing a T-PEN transcription, which may be compressed with gzip or xz",
     )
     args = parser.parse_args()
-    with open(args.infile, encoding='utf-8') as jfile:
-        msdata = json.load(jfile)
+    if args.stream:
+        # write_sc_stream has none of these; say so, rather than quietly doing without them.
+        for option in ('page_errors', 'cache', 'output_cache', 'json_backend', 'zone_index', 'page_workers',
+                       'stats'):
+            if getattr(args, option):
+                parser.error('--%s cannot be used with --stream' % option.replace('_', '-'))
     default_metadata = {'title': args.title, 'short_error': args.short_error}
-    xmltree = from_sc(msdata, metadata=default_metadata)
-    if xmltree is not None:
-        sys.stdout.buffer.write(etree.tostring(xmltree, encoding='utf-8', pretty_print=True, xml_declaration=True))
+    # Collect the warnings, so that each is reported once, and none of them go
+    # to stdout along with the XML.
+    diagnostics = Diagnostics()
+    with open_input(args.infile) as jfile:
+        if args.stream:
+            with compressed_output(sys.stdout.buffer, args.compress) as out:
+                write_sc_stream(jfile, out, metadata=default_metadata, diagnostics=diagnostics)
+            diagnostics.report()
+            sys.exit()
+        converter = Converter(metadata=default_metadata,
+                              cache=DiskCache(args.cache) if args.cache else None,
+                              page_errors=args.page_errors, json_backend=args.json_backend,
+                              page_workers=args.page_workers,
+                              stats=(lambda st: print(st, file=sys.stderr)) if args.stats else None,
+                              diagnostics=diagnostics,
+                              output_cache=DiskCache(args.output_cache) if args.output_cache else None)
+        document = converter.convert_to_xml(jfile)
+    diagnostics.report()
+    if document is not None:
+        if args.zone_index:
+            with open(args.zone_index, 'w', encoding='utf-8') as fh:
+                FacsimileIndex.from_tei(document).dump(fh)
+        with compressed_output(sys.stdout.buffer, args.compress) as out:
+            out.write(document)
@@ -0,0 +1,410 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from tpen2tei.batch import resolve_hook, resolve_options
+from tpen2tei.cache import DiskCache
+from tpen2tei.diagnostics import Diagnostics
+from tpen2tei.parse import Converter
+from tpen2tei.wordtokenize import Tokenizer
+
+__author__ = 'tla'
+
+# The query parameters that are for the Tokenizer, and not metadata for the header
+_TOKENIZER_PARAMS = ('milestone', 'first_layer', 'id_xpath', 'block_xpath')
+# The query parameters that are metadata for the TEI header, as the parser uses them
+_METADATA_PARAMS = ('title', 'author', 'publicationStmt', 'teiSchema', 'msIdentifier', 'msSettlement',
+                    'msRepository', 'msIdNumber', 'date', 'location', 'description', 'short_error')
+# The query parameters that are yes or no, and how each may be given
+_FLAG_PARAMS = ('first_layer', 'short_error')
+_FLAG_VALUES = {'1': True, 'true': True, 'yes': True, '0': False, 'false': False, 'no': False}
+
+
+class ServerBusy(Exception):
+    """Raised when a request arrives while every worker is busy and the queue
+    of waiting requests is full."""
+
+
+class WorkerPool:
+    """A pool of worker processes, each of which is started once and keeps its
+    Converter, so that a request costs only the conversion itself. Each worker
+    does one request at a time; up to queue_size more requests wait for a free
+    worker, and any beyond that are refused with ServerBusy. A worker that
+    runs over the timeout of its request is killed and replaced.
+
+    The options are as for convert_batch: the hooks are dotted paths, which
+    each worker resolves for itself, so that nothing has to be pickled."""
+
+    def __init__(self, workers=None, queue_size=16, hooks=None, memoize=None, page_errors=None,
+                 json_backend=None, output_cache=None, normalisation=None, context=None):
+        self.size = workers or os.cpu_count() or 1
+        # Check the hooks here, so that a typo fails at once rather than in every worker.
+        for path in list((hooks or {}).values()) + [normalisation]:
+            if path is not None:
+                resolve_hook(path)
+        self._settings = {'hooks': dict(hooks or {}), 'memoize': memoize, 'page_errors': page_errors,
+                          'json_backend': json_backend, 'output_cache': output_cache,
+                          'normalisation': normalisation}
+        if context is None:
+            # Forking is what makes the workers start warm, where it is possible.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self._context = context
+        self._idle = queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.size + queue_size)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+        self.counts = dict.fromkeys(('requests', 'failed', 'timeouts', 'rejected', 'restarts'), 0)
+        for _ in range(self.size):
+            self._idle.put(self._start())
+
+    def run(self, job, timeout=None):
+        """Have a worker do the given job, and return its result. Raises ServerBusy
+        if the job cannot even be queued, and TimeoutError if it is not done in
+        time, including the time spent waiting for a worker."""
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise ServerBusy('All workers are busy')
+        try:
+            self._count('requests')
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                self._count('timeouts')
+                raise TimeoutError('No worker became free within %s seconds' % timeout)
+            process, conn = worker
+            try:
+                conn.send(job)
+                if not conn.poll(None if deadline is None else max(0, deadline - time.monotonic())):
+                    self._count('timeouts')
+                    raise TimeoutError('The conversion took longer than %s seconds' % timeout)
+                result = conn.recv()
+            except BaseException:
+                # The worker is either stuck or gone; either way it is of no more use.
+                self._replace(worker)
+                raise
+            self._idle.put(worker)
+            return result
+        except TimeoutError:
+            # This is an OSError too, but it has been counted already.
+            raise
+        except (EOFError, OSError):
+            self._count('failed')
+            raise
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Stop all the workers."""
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            self._workers.clear()
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            conn.close()
+
+    def status(self):
+        with self._lock:
+            return dict(self.counts, workers=self.size, idle=self._idle.qsize(),
+                        alive=sum(1 for process, _ in self._workers if process.is_alive()))
+
+    def _start(self):
+        conn, child = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child, self._settings), daemon=True)
+        process.start()
+        child.close()
+        worker = (process, conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        process, conn = worker
+        process.terminate()
+        process.join()
+        conn.close()
+        with self._lock:
+            self._workers.discard(worker)
+            if self._closed:
+                return
+            self.counts['restarts'] += 1
+        self._idle.put(self._start())
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+
+def _worker_main(conn, settings):
+    """The loop of a worker process: make the Converter once, and then do each
+    job that comes in until there are no more."""
+    options = resolve_options(settings['hooks'], settings['memoize'])
+    output_cache = settings['output_cache']
+    converter = Converter(page_errors=settings['page_errors'], json_backend=settings['json_backend'],
+                          output_cache=None if output_cache is None else DiskCache(output_cache), **options)
+    normalisation = settings['normalisation']
+    normalisation = None if normalisation is None else resolve_hook(normalisation)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        try:
+            result = _do_job(converter, normalisation, *job)
+        except Exception as e:
+            result = (500, 'text/plain; charset=utf-8', ('%s: %s\n' % (e.__class__.__name__, e)).encode('utf-8'))
+        conn.send(result)
+
+
+def _do_job(converter, normalisation, kind, data, metadata, params):
+    """Returns the HTTP status, content type, and body for a conversion to TEI
+    or to tokens. If the conversion fails, the body is the list of problems."""
+    diagnostics = Diagnostics()
+    # Anything printed by the hooks is no business of the client's.
+    with redirect_stdout(io.StringIO()):
+        if kind == 'tei':
+            result = converter.convert_to_xml(data, metadata, diagnostics=diagnostics)
+        else:
+            result = converter.convert_stream(io.BytesIO(data), metadata, diagnostics=diagnostics)
+    if result is None:
+        return 422, 'application/json', json.dumps(diagnostics.as_list(), ensure_ascii=False).encode('utf-8')
+    if kind == 'tei':
+        return 200, 'application/xml', result
+    tokenizer = Tokenizer(milestone=params.get('milestone'), first_layer=params.get('first_layer', False),
+                          normalisation=normalisation, id_xpath=params.get('id_xpath'),
+                          block_xpath=params.get('block_xpath'))
+    tokens = tokenizer.from_etree(result)
+    return 200, 'application/json', json.dumps(tokens, ensure_ascii=False).encode('utf-8')
+
+
+def _query_params(query, max_timeout):
+    """Returns the timeout, the metadata for the TEI header and the Tokenizer
+    options that are given in the query string of a request. The parameters
+    are those in _METADATA_PARAMS and _TOKENIZER_PARAMS, and timeout; those in
+    _FLAG_PARAMS are made booleans. Raises ValueError, with a message for the
+    client, for any other parameter or a bad value."""
+    params = dict(parse_qsl(query))
+    unknown = sorted(set(params) - set(_METADATA_PARAMS) - set(_TOKENIZER_PARAMS) - {'timeout'})
+    if unknown:
+        raise ValueError('Unknown parameter %s; use one of %s' % (
+            ', '.join(unknown), ', '.join(('timeout',) + _METADATA_PARAMS + _TOKENIZER_PARAMS)))
+    try:
+        timeout = float(params.pop('timeout', max_timeout))
+    except ValueError:
+        timeout = 0
+    if not timeout > 0:
+        raise ValueError('The timeout must be a positive number of seconds')
+    for name in _FLAG_PARAMS:
+        if name in params:
+            try:
+                params[name] = _FLAG_VALUES[params[name].lower()]
+            except KeyError:
+                raise ValueError('%s must be one of %s' % (name, ', '.join(_FLAG_VALUES))) from None
+    tokenizer_params = {k: params.pop(k) for k in _TOKENIZER_PARAMS if k in params}
+    return min(timeout, max_timeout), params or None, tokenizer_params
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """POST SC-JSON to /tei for the TEI document, or to /tokens for the
+    CollateX tokens of its text. The query parameters may be timeout, the
+    Tokenizer options, and the metadata for the TEI header that the parser
+    knows of; short_error and first_layer are given as 1 or 0, true or false,
+    or yes or no. Any other parameter is refused. GET /status for the state of
+    the workers."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/status':
+            return self._send(404, 'text/plain', b'Not found\n')
+        self._send(200, 'application/json', json.dumps(self.server.pool.status()).encode('utf-8'))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        kind = url.path.strip('/')
+        if kind not in ('tei', 'tokens'):
+            return self._send(404, 'text/plain', b'Not found\n')
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self._send(411, 'text/plain', b'Content-Length required\n')
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # There is no telling where the body ends, so the connection cannot be used again.
+            self.close_connection = True
+            return self._send(400, 'text/plain', b'Bad Content-Length\n')
+        if length > self.server.max_size:
+            return self._send(413, 'text/plain', b'Manifest too large\n')
+        data = self.rfile.read(length)
+        try:
+            timeout, metadata, tokenizer_params = _query_params(url.query, self.server.timeout)
+        except ValueError as e:
+            return self._send(400, 'text/plain', ('%s\n' % e).encode('utf-8'))
+        try:
+            status, ctype, body = self.server.pool.run((kind, data, metadata, tokenizer_params), timeout)
+        except ServerBusy as e:
+            return self._send(503, 'text/plain', ('%s\n' % e).encode('utf-8'), {'Retry-After': '1'})
+        except TimeoutError as e:
+            return self._send(504, 'text/plain', ('%s\n' % e).encode('utf-8'))
+        except (EOFError, OSError):
+            return self._send(500, 'text/plain', b'The worker died\n')
+        self._send(status, ctype, body)
+
+    def _send(self, status, ctype, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # There is no client address on a Unix socket.
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class ConversionServer:
+    """A long-running conversion service, which listens either on a localhost
+    HTTP port (address is a (host, port) pair) or on a Unix socket (address is
+    its path), and hands each request to a WorkerPool. Requests that take
+    longer than timeout seconds, including the wait for a worker, get a 504;
+    requests that find every worker busy and the queue full get a 503.
+
+    The remaining options are as for WorkerPool."""
+
+    def __init__(self, address=('127.0.0.1', 8080), timeout=60, max_size=256 * 1024 * 1024, verbose=False,
+                 **options):
+        # Start the workers first, so that they do not inherit the listening socket.
+        self.pool = WorkerPool(**options)
+        try:
+            if isinstance(address, str):
+                if os.path.exists(address):
+                    os.remove(address)
+                self.httpd = _UnixHTTPServer(address, _Handler)
+            else:
+                self.httpd = ThreadingHTTPServer(address, _Handler)
+        except BaseException:
+            self.pool.close()
+            raise
+        self.httpd.pool = self.pool
+        self.httpd.timeout = timeout
+        self.httpd.max_size = max_size
+        self.httpd.verbose = verbose
+        self.address = address if isinstance(address, str) else self.httpd.server_address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop serving, from another thread, and stop the workers."""
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.pool.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve SC-JSON to TEI XML conversions from warm workers.')
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("-p", "--port", type=int, default=8080, help="Localhost port to listen on")
+    where.add_argument("-s", "--socket", metavar="PATH", help="Unix socket to listen on instead")
+    parser.add_argument(
+        "-j", "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "-q", "--queue",
+        type=int,
+        default=16,
+        help="Number of requests that may wait for a worker before more are refused",
+    )
+    parser.add_argument(
+        "-t", "--timeout",
+        type=float,
+        default=60,
+        help="Longest time in seconds that a request may take",
+    )
+    parser.add_argument(
+        "--memoize",
+        action="store_true",
+        help="Remember the results of the numeric parser and text filter across requests",
+    )
+    parser.add_argument(
+        "--page-errors",
+        choices=['skip', 'wrap'],
+        help="Skip, or keep with the markup escaped, any page that is not well-formed, instead of failing"
+    )
+    parser.add_argument(
+        "--output-cache",
+        metavar="DIR",
+        help="Directory in which to keep converted documents, so that unchanged manuscripts are not converted again",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log each request to stderr")
+    for hook in ['members', 'special-chars', 'numeric-parser', 'text-filter', 'postprocess', 'rules',
+                 'normalisation']:
+        parser.add_argument(
+            "--%s" % hook,
+            metavar="MODULE:NAME",
+            help="Dotted path to the %s option for %s" % (
+                hook.replace('-', '_'), 'the Tokenizer' if hook == 'normalisation' else 'from_sc'),
+        )
+    args = parser.parse_args()
+    hooks = {'members': args.members, 'special_chars': args.special_chars,
+             'numeric_parser': args.numeric_parser, 'text_filter': args.text_filter,
+             'postprocess': args.postprocess, 'rules': args.rules}
+    server = ConversionServer(args.socket or ('127.0.0.1', args.port), timeout=args.timeout,
+                              verbose=args.verbose, workers=args.workers, queue_size=args.queue, hooks=hooks,
+                              memoize=args.memoize, page_errors=args.page_errors,
+                              output_cache=args.output_cache, normalisation=args.normalisation)
+    print("Serving on %s with %d workers" % (server.address, server.pool.size), file=sys.stderr)
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+__author__ = 'tla'
+
+# The phases of a conversion, in the order they happen
+PHASES = ('decode', 'extract', 'isolate', 'body', 'parse', 'wrap_ab', 'fixup', 'header', 'assemble',
+          'postprocess')
+
+
+class ConversionStats:
+    """The wall time spent in each phase of a conversion, in seconds, and the
+    counts of what was converted. The phases are:
+
+      decode       decoding the whole manifest, with the json_backend option
+      extract      reading the canvases (and, for a stream, decoding the JSON)
+                   and building the text of each page
+      isolate      finding the broken pages, with the page_errors option
+      body         putting together the text of the body, or fixing it run by
+                   run with a cache
+      parse        parsing the text of the body
+      wrap_ab      wrapping text that is not in any block in an ab element
+      fixup        fixing the glyphs, numbers and so on, and applying the rules
+      header       building the TEI header
+      assemble     adding the facsimile and putting the document together
+      postprocess  running the postprocess function
+
+    and the counters are pages, lines, notes, glyphs, nums, and parses (the
+    number of times that some or all of the body was parsed). With the memoize
+    option there are also text_filter_hits, text_filter_misses,
+    numeric_parser_hits and numeric_parser_misses, the calls of each that
+    were answered from its memo in the conversion and those that were not.
+    When one Converter is used by several threads at once, these take in the
+    calls made by the other conversions in the meantime.
+
+    A ConversionStats can be passed as the stats option of from_sc or of a
+    Converter, whereupon the figures of each conversion are added to it; it is
+    safe to do this from several threads at once."""
+
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(('pages', 'lines', 'notes', 'glyphs', 'nums', 'parses'), 0)
+        self.conversions = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent within it to the given phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add(self, other):
+        """Add the figures of another ConversionStats to these ones."""
+        with self._lock:
+            for name, seconds in other.times.items():
+                self.times[name] = self.times.get(name, 0.0) + seconds
+            for name, n in other.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            self.conversions += other.conversions
+        return self
+
+    def total(self):
+        """Returns the time spent in all the phases together."""
+        return sum(self.times.values())
+
+    def as_dict(self):
+        return {'conversions': self.conversions, 'times': dict(self.times), 'counts': dict(self.counts)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns the ConversionStats that as_dict gave the given dictionary for."""
+        stats = cls()
+        stats.times.update(data['times'])
+        stats.counts.update(data['counts'])
+        stats.conversions = data['conversions']
+        return stats
+
+    def __repr__(self):
+        return 'ConversionStats(%s)' % json.dumps(self.as_dict())
+
+
+def timed(stats, name):
+    """Returns a context manager that times the given phase if stats is a
+    ConversionStats, and does nothing if it is None."""
+    return _NOTHING if stats is None else stats.phase(name)
+
+
+def report(stats, target):
+    """Pass the figures of a finished conversion to the target that was given
+    as the stats option: add them to it if it is a ConversionStats, and
+    otherwise call it with them."""
+    stats.conversions = 1
+    if isinstance(target, ConversionStats):
+        target.add(stats)
+    else:
+        target(stats)
+
+
+_NOTHING = nullcontext()
@@ -0,0 +1,148 @@
+import argparse
+import json
+import random
+import sys
+from collections import namedtuple
+
+__author__ = 'tla'
+
+SyntheticManuscript = namedtuple('SyntheticManuscript', ['manifest', 'members', 'special_chars'])
+
+# Some Armenian words to make lines out of, and the glyphs and numerals that
+# can be marked up in them.
+_WORDS = ['եղբայրն', 'ներսէսի', 'կարմիր', 'վանգն', 'և', 'նա', 'յաջ', 'թագաւորն', 'հայոց', 'ի', 'թուականին',
+          'զօրաժողով', 'եղեալ', 'անցանէր', 'ընդ', 'գետն', 'մեծ', 'քաղաքն', 'եպիսկոպոս', 'տանն', 'որ',
+          'ասէ', 'ամենայն', 'երկիր', 'կոչի', 'սուրբ', 'հաւրէն', 'զհայր', 'տեսիլ']
+_GLYPHS = {
+    'աշխարհ': ('asxarh', 'ARMENIAN ASHXARH SYMBOL'),
+    'թե': ('the', 'ARMENIAN THE LIGATURE'),
+    'ընդ': ('und', 'ARMENIAN UND LIGATURE'),
+    'պտ': ('pt', 'ARMENIAN PT LIGATURE'),
+}
+_NUMERALS = ['ա՟', 'ժ՟բ՟', 'ճ՟', 'ն՟հ՟ը՟', 'ռ՟ճ՟', 'չ՟ժ՟', 'ծ՟դ՟']
+_BASE = 'http://t-pen.org/TPEN'
+
+
+def synthetic_manifest(pages=10, lines=30, columns=1, markup=0.1, notes=0.02, members=3, seed=0,
+                       project=1, paragraph=True):
+    """Returns a SyntheticManuscript: an SC-JSON manifest in the form that T-PEN
+    exports, with the given number of pages, each with the given number of
+    lines split evenly into columns, along with the members and special_chars
+    tables that go with it. About a markup fraction of the words are marked
+    up, with a mixture of <g>, <num>, <del> with a numeric cert, and <abbr>;
+    about a notes fraction of the lines have a transcriber's note. The same
+    seed always gives the same manuscript. Unless paragraph is false, the
+    whole text is in one <p>, which spans the pages."""
+    rng = random.Random(seed)
+    member_ids = [1000 + i for i in range(max(members, 1))]
+    canvases = []
+    line_id = 100000000 + project * 100000
+    for pn in range(pages):
+        canvas_id = '%s/canvas/%d' % (_BASE, project * 10000 + pn)
+        width, height = 800, 1000
+        resources = []
+        per_column = -(-lines // columns)
+        for ln in range(lines):
+            cn, row = divmod(ln, per_column)
+            line_id += 1
+            x = 40 + cn * (width // columns)
+            y = 60 + row * (height - 100) // per_column
+            resources.append({
+                '@id': '%s/line/%d' % (_BASE, line_id),
+                '_tpen_line_id': 'line/%d' % line_id,
+                '@type': 'oa:Annotation',
+                'motivation': 'oad:transcribing',
+                'resource': {'@type': 'cnt:ContentAsText', 'cnt:chars': _line_text(rng, markup)},
+                'on': '%s#xywh=%d,%d,%d,%d' % (canvas_id, x, y, width // columns - 60, 30),
+                '_tpen_note': _note_text(rng) if rng.random() < notes else '',
+                '_tpen_creator': rng.choice(member_ids),
+                'modified': '2014-11-26 11:44:20.0',
+            })
+        if paragraph and pn == 0 and resources:
+            first = resources[0]['resource']
+            first['cnt:chars'] = '<p>' + first['cnt:chars']
+        if paragraph and pn == pages - 1 and resources:
+            last = resources[-1]['resource']
+            last['cnt:chars'] = last['cnt:chars'].rstrip() + '</p>'
+        canvases.append({
+            '@id': canvas_id,
+            '@type': 'sc:Canvas',
+            'label': 'page_%03d%s.jpg' % (pn // 2 + 1, 'rv'[pn % 2]),
+            'width': width,
+            'height': height,
+            'images': [{'@type': 'oa:Annotation', 'motivation': 'sc:painting',
+                        'resource': {'@id': '%s/image/%d' % (_BASE, pn), '@type': 'dctypes:Image',
+                                     'format': 'image/jpeg'},
+                        'on': canvas_id}],
+            'otherContent': [{
+                '@id': '%s/project/%d/annotations/%d' % (_BASE, project, pn),
+                '@type': 'sc:AnnotationList',
+                'label': '%s List' % canvas_id,
+                'proj': project,
+                'on': canvas_id,
+                'resources': resources,
+            }],
+        })
+    manifest = {
+        '@context': 'http://www.shared-canvas.org/ns/context.json',
+        '@id': '%s/manifest/%d/manifest.json' % (_BASE, project),
+        '@type': 'sc:Manifest',
+        'label': 'Synthetic manuscript %d' % project,
+        'metadata': [{'label': 'title', 'value': 'Synthetic manuscript %d' % project},
+                     {'label': 'msIdentifier', 'value': 'S%d' % project},
+                     {'label': 'language', 'value': 'Armenian'}],
+        'sequences': [{'@id': '%s/manifest/%d/sequence/normal' % (_BASE, project),
+                       '@type': 'sc:Sequence',
+                       'label': 'Current Page Order',
+                       'canvases': canvases}],
+    }
+    member_table = {str(m): {'name': 'Transcriber %d' % m, 'uname': 'user%d@example.org' % m}
+                    for m in member_ids[:members]}
+    return SyntheticManuscript(manifest, member_table, dict(_GLYPHS))
+
+
+def numeric_parser(val):
+    """A simple parser for the numerals that synthetic_manifest writes, for use
+    as the numeric_parser option."""
+    return sum(ord(c) - 1328 for c in val.upper() if 1328 < ord(c) < 1367)
+
+
+def _line_text(rng, markup):
+    words = []
+    for _ in range(rng.randint(5, 9)):
+        word = rng.choice(_WORDS)
+        if rng.random() < markup:
+            kind = rng.randrange(4)
+            if kind == 0:
+                word = '<g ref="">%s</g>' % rng.choice(list(_GLYPHS))
+            elif kind == 1:
+                word = '<num value="">%s</num>' % rng.choice(_NUMERALS)
+            elif kind == 2:
+                word = '<del type="strikethrough" cert="%d">%s</del>' % (rng.randrange(100), word)
+            else:
+                word = '<abbr>%s</abbr>' % word
+        words.append(word)
+    text = ' '.join(words)
+    # Some lines end in the middle of a word.
+    return text if rng.random() < 0.2 else text + ' '
+
+
+def _note_text(rng):
+    return 'note: %s' % ' '.join(rng.choice(_WORDS) for _ in range(3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic T-PEN manifest as SC-JSON.')
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=30, help="Lines per page")
+    parser.add_argument("--columns", type=int, default=1)
+    parser.add_argument("--markup", type=float, default=0.1, help="Fraction of words with markup")
+    parser.add_argument("--notes", type=float, default=0.02, help="Fraction of lines with a note")
+    parser.add_argument("--members", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-paragraph", action="store_true", help="Leave the text outside any <p>")
+    args = parser.parse_args()
+    manuscript = synthetic_manifest(pages=args.pages, lines=args.lines, columns=args.columns,
+                                    markup=args.markup, notes=args.notes, members=args.members,
+                                    seed=args.seed, paragraph=not args.no_paragraph)
+    json.dump(manuscript.manifest, sys.stdout, ensure_ascii=False)
@@ -0,0 +1,213 @@
+import re
+
+__author__ = 'tla'
+
+# The separator that the lines of a page are joined with, when they are
+# filtered all at once
+_PAGE_SEPARATOR = '\n'
+# The numbers of single characters, and of longer strings, to be replaced in a
+# pass before a translate table, or an alternation regex, is quicker than
+# calling str.replace for each of them. str.replace is very fast, and
+# str.translate is not, on text that is not all Latin-1.
+_TRANSLATE_MIN = 24
+_ALTERNATION_MIN = 8
+
+
+class TextFilter:
+    """A text_filter for from_sc that is made of declarative rules rather than
+    code. The rules are carried out in order, each on the result of the ones
+    before, just as a chain of str.replace and re.sub calls would be; they are
+
+      ('chars', {'_': '֊', ...})        replace each of the given characters
+      ('replace', old, new)             replace each occurrence of a string
+      ('sub', pattern, repl[, flags])   replace each match of a regular expression
+
+    The rules are compiled once, when they are first used, into as few passes
+    over the text as they allow: many single characters go into one
+    str.translate table, and many longer strings into one alternation regex,
+    while a handful of each are simply replaced one after another, which is
+    quicker. Wherever an earlier rule could make or break a match for a later
+    one, the later one starts a new pass, so the result is always the same as
+    that of the rules done one by one. Each regular expression is a pass of
+    its own.
+
+    When from_sc uses a TextFilter, the lines of each page are filtered in one
+    go if none of the rules could match across the end of a line, which saves
+    a call per line; the whole_page option can be set to False to stop this."""
+
+    def __init__(self, rules=(), whole_page=True):
+        self.rules = []
+        self.whole_page = whole_page
+        self._passes = None
+        self._separable = False
+        for rule in rules:
+            kind, args = rule[0], rule[1:]
+            if kind == 'chars':
+                self.chars(*args)
+            elif kind == 'replace':
+                self.replace(*args)
+            elif kind == 'sub':
+                self.sub(*args)
+            else:
+                raise ValueError('Unknown text filter rule %s' % kind)
+
+    def chars(self, mapping):
+        """Add a rule that replaces each character in mapping with its value."""
+        for old, new in mapping.items():
+            if len(old) != 1:
+                raise ValueError('%r is not a single character' % old)
+            self.replace(old, new)
+        return self
+
+    def replace(self, old, new):
+        """Add a rule that replaces each occurrence of old with new."""
+        if not old:
+            raise ValueError('Cannot replace an empty string')
+        self.rules.append(('replace', old, new))
+        self._passes = None
+        return self
+
+    def sub(self, pattern, repl, flags=0):
+        """Add a rule that replaces each match of the regular expression pattern
+        with repl, as re.sub does."""
+        re.compile(pattern, flags)
+        self.rules.append(('sub', pattern, repl, flags))
+        self._passes = None
+        return self
+
+    def __call__(self, text):
+        return self._compiled()(text)
+
+    def lines(self, texts):
+        """Filter a list of lines, all at once if the whole_page option allows,
+        and return the list of the results."""
+        apply = self._compiled()
+        if not self.whole_page or not self._separable or any(_PAGE_SEPARATOR in t for t in texts):
+            return [apply(t) for t in texts]
+        return apply(_PAGE_SEPARATOR.join(texts)).split(_PAGE_SEPARATOR)
+
+    def __repr__(self):
+        # This is also how the cache tells one TextFilter from another.
+        return 'TextFilter(%r, whole_page=%r)' % (self.rules, self.whole_page)
+
+    def __getstate__(self):
+        # The compiled passes are closures, which cannot be pickled; they are
+        # made again when the filter is first used.
+        state = dict(self.__dict__)
+        state['_passes'] = None
+        return state
+
+    def _compiled(self):
+        """Returns the function that carries out all the passes."""
+        if self._passes is None:
+            passes, self._separable = _compile(self.rules)
+            self._passes = passes[0] if len(passes) == 1 else _chain(passes)
+        return self._passes
+
+
+def _compile(rules):
+    """Returns the passes for the given rules, each a function from string to
+    string, and whether the lines of a page can be filtered together; that is,
+    whether no rule can match, make, or remove a line separator."""
+    passes = []
+    separable = True
+    stage = None
+    for rule in rules:
+        if rule[0] == 'sub':
+            _, pattern, repl, flags = rule
+            regex = re.compile(pattern, flags)
+            passes.append(lambda text, regex=regex, repl=repl: regex.sub(repl, text))
+            separable = False
+            stage = None
+            continue
+        _, old, new = rule
+        if _PAGE_SEPARATOR in old or _PAGE_SEPARATOR in new:
+            separable = False
+        if stage is None or not stage.accepts(old, new):
+            stage = _Stage()
+            passes.append(stage)
+        stage.add(old, new)
+    return [p.compile() if isinstance(p, _Stage) else p for p in passes], separable
+
+
+class _Stage:
+    """A group of literal replacements that can be done in a single pass over
+    the text: a translate table for those of single characters, followed by an
+    alternation regex for the rest, which takes the earliest rule whenever more
+    than one matches at the same place."""
+
+    def __init__(self):
+        self.table = {}
+        self.strings = []     # (old, new) of the longer strings, in order
+        self.outputs = set()  # The characters written by the rules so far
+
+    def accepts(self, old, new):
+        """Whether the replacement of old by new, coming after the rules already
+        in this stage, can be done in the same pass."""
+        # A later rule would see what an earlier one wrote...
+        if self.outputs.intersection(old):
+            return False
+        if len(old) == 1:
+            # ...or the translation, which is done first, would change what the
+            # longer strings match.
+            if self.strings and not new:
+                return False
+            return not any(old in s or set(new).intersection(s) for s, _ in self.strings)
+        for s, replacement in self.strings:
+            # A deletion could join the text on either side into a match.
+            if not replacement:
+                return False
+            # A match for the later rule that starts before, or inside, a
+            # match for an earlier one would be taken first in one pass.
+            if s in old[1:] or any(old.endswith(s[:k]) for k in range(1, min(len(s), len(old)))):
+                return False
+        return True
+
+    def add(self, old, new):
+        if len(old) == 1:
+            # If a character is given twice, the first rule has replaced them all.
+            self.table.setdefault(ord(old), new)
+        elif old not in dict(self.strings):
+            self.strings.append((old, new))
+        self.outputs.update(new)
+
+    def compile(self):
+        """Returns a function that does the replacements of this stage."""
+        steps = []
+        pairs = []
+        translated = len(self.table) >= _TRANSLATE_MIN
+        if translated:
+            table = self.table
+            steps.append(lambda text: text.translate(table))
+        else:
+            pairs.extend((chr(c), new) for c, new in self.table.items())
+        if len(self.strings) >= _ALTERNATION_MIN:
+            replacements = dict(self.strings)
+            regex = re.compile('|'.join(re.escape(s) for s, _ in self.strings))
+            lookup = lambda m: replacements[m.group(0)]
+            steps.append(lambda text: regex.sub(lookup, text))
+        else:
+            pairs.extend(self.strings)
+        if pairs:
+            # The translation, if any, comes before the longer strings.
+            steps.insert(1 if translated else 0, _replacer(pairs))
+        if len(steps) == 1:
+            return steps[0]
+        first, second = steps
+        return lambda text: second(first(text))
+
+
+def _chain(passes):
+    def apply(text):
+        for one in passes:
+            text = one(text)
+        return text
+    return apply
+
+
+def _replacer(pairs):
+    def replace(text):
+        for old, new in pairs:
+            text = text.replace(old, new)
+        return text
+    return replace
@@ -0,0 +1,141 @@
+import argparse
+import bisect
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from lxml import etree
+from tpen2tei.diagnostics import Diagnostics
+
+__author__ = 'tla'
+
+ValidationResult = namedtuple('ValidationResult', ['path', 'valid', 'diagnostics'])
+
+_TEI = '{http://www.tei-c.org/ns/1.0}'
+_XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+
+def load_schema(path):
+    """Returns the compiled RelaxNG schema at the given local path. The schema
+    is compiled only once in each process, and again only if the file changes,
+    since the compiling of e.g. tei_all.rng takes far longer than validating a
+    document against it."""
+    path = os.path.abspath(path)
+    return _compiled_schema(path, os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=8)
+def _compiled_schema(path, mtime_ns):
+    return etree.RelaxNG(etree.parse(path))
+
+
+def validate(document, schema, diagnostics=None):
+    """Validate a TEI document against a RelaxNG schema. The document may be an
+    ElementTree, such as from_sc returns, or the serialized document, such as
+    convert_to_xml returns; the schema may be the path to a .rng file, which is
+    compiled with load_schema, or a compiled etree.RelaxNG.
+
+    Each validation error is added to the diagnostics, if given, or to a new
+    Diagnostics, which is returned; the document is valid if it has no errors.
+    The errors have the code 'schema-invalid', and their locations have the
+    page and line of the transcription as for the other diagnostics, as well as
+    the 'xml_line' and 'column' in the serialized document."""
+    if isinstance(schema, str):
+        schema = load_schema(schema)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    if not isinstance(document, (bytes, bytearray)):
+        # Read the document back, so that the line numbers are those of the file
+        # that it would be written to.
+        document = etree.tostring(document, encoding='utf-8', pretty_print=True, xml_declaration=True)
+    xmldoc = etree.fromstring(bytes(document), etree.XMLParser(huge_tree=True)).getroottree()
+    if schema.validate(xmldoc):
+        return diagnostics
+    milestones = _Milestones(xmldoc)
+    for error in schema.error_log:
+        location = milestones.locate(error.line)
+        location.update(xml_line=error.line, column=error.column)
+        diagnostics.error('schema-invalid', error.message, location)
+    return diagnostics
+
+
+def validate_files(paths, schema, workers=None):
+    """Validate many TEI XML files against the RelaxNG schema at the given path,
+    with a pool of worker processes that each compile the schema once. If
+    workers is 1 the files are validated in this process; if it is None the
+    pool has as many workers as there are CPUs. Returns a list of
+    ValidationResult tuples in the order of the paths."""
+    # Check the schema here, so that a bad one fails once rather than in every worker.
+    load_schema(schema)
+    if workers == 1:
+        return [_validate_job((path, schema)) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_schema, initargs=(schema,)) as executor:
+        return list(executor.map(_validate_job, [(path, schema) for path in paths]))
+
+
+def _validate_job(job):
+    path, schema = job
+    diagnostics = Diagnostics()
+    try:
+        with open(path, 'rb') as fh:
+            validate(fh.read(), schema, diagnostics)
+    except etree.XMLSyntaxError as e:
+        diagnostics.error('xml-syntax', str(e))
+    except OSError as e:
+        # One file that cannot be read should not stop the others.
+        diagnostics.error('unreadable', '%s: %s' % (e.__class__.__name__, e))
+    # A Diagnostics does not go between processes, but its contents do.
+    return ValidationResult(path, not diagnostics.errors(), list(diagnostics))
+
+
+class _Milestones:
+    """Finds the page and line of the transcription in which a given line of the
+    serialized document falls."""
+
+    def __init__(self, xmldoc):
+        self.lines = []
+        self.places = []
+        page = None
+        for el in xmldoc.iter(_TEI + 'pb', _TEI + 'lb'):
+            if el.tag == _TEI + 'pb':
+                page = el.get('n')
+                place = {'page': page}
+            else:
+                place = {'page': page, 'line': (el.get(_XML_ID) or '').lstrip('l') or None, 'n': el.get('n')}
+            self.lines.append(el.sourceline)
+            self.places.append(place)
+
+    def locate(self, line):
+        i = bisect.bisect_right(self.lines, line)
+        return dict(self.places[i - 1]) if i else {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate TEI XML files against a RelaxNG schema in parallel.')
+    parser.add_argument(
+        "-s", "--schema",
+        required=True,
+        help="Local path to the RelaxNG schema, e.g. tei_all.rng",
+    )
+    parser.add_argument(
+        "-j", "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument("files", nargs='+', help="TEI XML files to validate")
+    args = parser.parse_args()
+    invalid = 0
+    for result in validate_files(args.files, args.schema, workers=args.workers):
+        if result.valid:
+            print("%s: valid" % result.path, file=sys.stderr)
+            continue
+        invalid += 1
+        print("%s: INVALID" % result.path, file=sys.stderr)
+        for d in result.diagnostics:
+            where = d.locations[0] if d.locations else {}
+            print("  line %s, page %s: %s%s" % (where.get('xml_line'), where.get('page'), d.message,
+                                                 ' (%d times)' % d.count if d.count > 1 else ''), file=sys.stderr)
+    print("%d of %d files valid" % (len(args.files) - invalid, len(args.files)), file=sys.stderr)
+    sys.exit(1 if invalid else 0)
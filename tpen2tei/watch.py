@@ -0,0 +1,203 @@
+import argparse
+import fnmatch
+import hashlib
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from tpen2tei.batch import BatchResult, _write_atomic, resolve_options
+from tpen2tei.cache import DiskCache
+from tpen2tei.diagnostics import Diagnostics
+from tpen2tei.manifest import JSON_BACKENDS
+from tpen2tei.parse import Converter
+
+__author__ = 'tla'
+
+
+class Watcher:
+    """Keeps the TEI XML files in a directory up to date with the SC-JSON
+    files there, each written next to its manifest with the extension .xml.
+
+    The directory is looked at every interval seconds. A manifest is converted
+    once it has stopped changing for debounce seconds, so that a file that is
+    still being written is left alone, and only if its content is not what was
+    converted last time; a manifest that is merely touched, or saved again as
+    it was, is not converted again. When the Watcher starts, the manifests
+    whose XML is missing or older than they are are converted.
+
+    The remaining options are those of a Converter, which is made once and
+    used for every conversion; with its cache option, only the pages that have
+    changed are extracted anew. Each output is written atomically, so that a
+    reader of the XML never sees half a file."""
+
+    def __init__(self, directory, pattern='*.json', debounce=0.3, interval=0.1, **options):
+        self.directory = directory
+        self.pattern = pattern
+        self.debounce = debounce
+        self.interval = interval
+        self.converter = Converter(**options)
+        self._seen = {}       # path -> (mtime, size) when last looked at
+        self._pending = {}    # path -> when it last changed, for those waiting to be converted
+        self._digests = {}    # path -> digest of what was last converted
+        self._started = False
+
+    def poll(self):
+        """Look at the directory once, and convert whatever is due. Returns a list
+        of BatchResult tuples for the manifests that were converted."""
+        now = time.monotonic()
+        current = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and fnmatch.fnmatch(entry.name, self.pattern):
+                    st = entry.stat()
+                    current[entry.path] = (st.st_mtime_ns, st.st_size)
+        for path in list(self._seen):
+            if path not in current:
+                del self._seen[path]
+                self._pending.pop(path, None)
+                self._digests.pop(path, None)
+        for path, signature in current.items():
+            if self._seen.get(path) == signature:
+                continue
+            self._seen[path] = signature
+            if self._started or _stale(path, signature[0]):
+                # At the start, an out-of-date manifest need not wait to settle.
+                self._pending[path] = now if self._started else now - self.debounce
+        self._started = True
+        results = []
+        for path in sorted(self._pending):
+            if now - self._pending[path] >= self.debounce:
+                del self._pending[path]
+                result = self.convert(path)
+                if result is not None:
+                    results.append(result)
+        return results
+
+    def convert(self, path):
+        """Convert a single manifest if its content has changed since it was last
+        converted, and return a BatchResult; or None if it has not changed."""
+        messages = io.StringIO()
+        diagnostics = Diagnostics()
+        outfile = _output_name(path)
+        ok = False
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            digest = hashlib.sha256(data).digest()
+            if self._digests.get(path) == digest and os.path.exists(outfile):
+                return None
+            with redirect_stdout(messages), redirect_stderr(messages):
+                document = self.converter.convert_to_xml(data, diagnostics=diagnostics)
+            if document is not None:
+                _write_atomic(outfile, document)
+                ok = True
+            # A manifest that failed is not tried again until it changes.
+            self._digests[path] = digest
+        except Exception as e:
+            messages.write("%s: %s\n" % (e.__class__.__name__, e))
+        diagnostics.report(messages)
+        return BatchResult(path, outfile if ok else None, ok, messages.getvalue())
+
+    def run(self, callback=None):
+        """Watch the directory until interrupted, passing the result of each
+        conversion to the callback if one is given."""
+        while True:
+            started = time.monotonic()
+            for result in self.poll():
+                if callback is not None:
+                    callback(result)
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+
+def _output_name(path):
+    return os.path.splitext(path)[0] + '.xml'
+
+
+def _stale(path, mtime_ns):
+    try:
+        return os.stat(_output_name(path)).st_mtime_ns < mtime_ns
+    except FileNotFoundError:
+        return True
+
+
+def _print_result(result):
+    if result.ok:
+        print("%s -> %s" % (result.infile, result.outfile), file=sys.stderr)
+    else:
+        print("%s: FAILED" % result.infile, file=sys.stderr)
+    if result.messages:
+        print(result.messages.rstrip('\n'), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Watch a directory of SC-JSON files and keep a TEI XML file next to each one up to date.')
+    parser.add_argument("directory", help="Directory to watch")
+    parser.add_argument(
+        "--pattern",
+        default="*.json",
+        help="Which files in the directory are manifests (default: *.json)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.3,
+        help="Seconds that a manifest must go unchanged before it is converted",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Seconds between looks at the directory",
+    )
+    parser.add_argument(
+        "-t", "--title",
+        default="A text generated by tpen2tei",
+        help="Title that should be passed to the texts",
+    )
+    parser.add_argument(
+        "--short-error",
+        action="store_true",
+        help="Reduce the amount of error output on XML parsing failures"
+    )
+    parser.add_argument(
+        "--memoize",
+        action="store_true",
+        help="Remember the results of the numeric parser and text filter across conversions",
+    )
+    parser.add_argument(
+        "--page-errors",
+        choices=['skip', 'wrap'],
+        help="Skip, or keep with the markup escaped, any page that is not well-formed, instead of failing"
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Directory in which to keep the extracted pages, so that only changed pages are extracted again",
+    )
+    parser.add_argument(
+        "--json-backend",
+        choices=JSON_BACKENDS,
+        help="Decode each manifest at once with this JSON library, rather than page by page"
+    )
+    for hook in ['members', 'special-chars', 'numeric-parser', 'text-filter', 'postprocess', 'rules']:
+        parser.add_argument(
+            "--%s" % hook,
+            metavar="MODULE:NAME",
+            help="Dotted path to the %s option for from_sc" % hook.replace('-', '_'),
+        )
+    args = parser.parse_args()
+    hooks = {'members': args.members, 'special_chars': args.special_chars,
+             'numeric_parser': args.numeric_parser, 'text_filter': args.text_filter,
+             'postprocess': args.postprocess, 'rules': args.rules}
+    watcher = Watcher(args.directory, pattern=args.pattern, debounce=args.debounce, interval=args.interval,
+                      metadata={'title': args.title, 'short_error': args.short_error},
+                      page_errors=args.page_errors, memoize=args.memoize, json_backend=args.json_backend,
+                      cache=None if args.cache is None else DiskCache(args.cache),
+                      **resolve_options(hooks))
+    print("Watching %s" % args.directory, file=sys.stderr)
+    try:
+        watcher.run(_print_result)
+    except KeyboardInterrupt:
+        pass
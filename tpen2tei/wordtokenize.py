@@ -1,8 +1,11 @@
 # -*- encoding: utf-8 -*-
+import argparse
+import io
 import json
 from lxml import etree
 import re
 import sys
+from tpen2tei.compression import COMPRESSIONS, compressed_output, open_input
 
 __author__ = 'tla'
 
@@ -47,7 +50,9 @@ class Tokenizer:
             self.block_xpath = block_xpath
 
     def from_file(self, xmlfile, encoding='utf-8'):
-        with open(xmlfile, encoding=encoding) as fh:
+        """Tokenize the named TEI XML file, which may be compressed with gzip or
+        xz; it is then decompressed as it is parsed."""
+        with io.TextIOWrapper(open_input(xmlfile), encoding=encoding) as fh:
             return self.from_fh(fh)
 
     def from_fh(self, xml_fh):
@@ -376,18 +381,24 @@ def tokens_to_string(tokenlist, field="t"):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenize TEI XML files into JSON for CollateX.')
+    parser.add_argument("--compress", choices=COMPRESSIONS, help="Compress the JSON output with gzip or xz")
+    parser.add_argument("files", nargs='+', metavar="FILE",
+                        help="An optional milestone, then the XML files, which may be compressed with gzip or xz")
+    args = parser.parse_args()
     witness_array = []
     textms = None
     xmlfiles = None
-    if re.match('.*\.xml$', sys.argv[1]) is None:
-        textms = sys.argv[1]
-        xmlfiles = sys.argv[2:]
+    if re.match(r'.*\.xml(\.gz|\.xz)?$', args.files[0]) is None:
+        textms = args.files[0]
+        xmlfiles = args.files[1:]
     else:
-        xmlfiles = sys.argv[1:]
+        xmlfiles = args.files
     tok = Tokenizer(milestone=textms, first_layer=True)
     for fn in xmlfiles:
         result = tok.from_file(fn)
         if len(result):
             witness_array.append(result)
     result = json.dumps({'witnesses': witness_array}, ensure_ascii=False)
-    sys.stdout.buffer.write(result.encode('utf-8'))
+    with compressed_output(sys.stdout.buffer, args.compress) as out:
+        out.write(result.encode('utf-8'))
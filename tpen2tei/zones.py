@@ -0,0 +1,203 @@
+import argparse
+import json
+import math
+import sys
+from collections import namedtuple
+from lxml import etree
+
+__author__ = 'tla'
+
+# The geometry of the zone of one line of a surface; the id is that of the line,
+# whose lb has the xml:id 'l' + id and whose zone has the xml:id 'z' + id.
+Zone = namedtuple('Zone', ['id', 'ulx', 'uly', 'lrx', 'lry'])
+
+_SIDECAR_VERSION = 1
+_TEI = '{http://www.tei-c.org/ns/1.0}'
+_XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+
+class SurfaceIndex:
+    """A spatial index over the zones of one surface, for finding the lines at a
+    point, the lines within a rectangle, or the line nearest to a point without
+    looking at every zone of the page.
+
+    The zones are put into a uniform grid whose cells are the size of a typical
+    zone, so that each zone is in only one or two cells, whether the page has one
+    column or several. A point lookup looks in one cell, and the other lookups in
+    only as many cells as they must. The zones are returned in the order of the
+    lines on the page."""
+
+    def __init__(self, graphic, width, height, zones, cell=None):
+        self.graphic = graphic
+        self.width = width
+        self.height = height
+        self.zones = [Zone(*z) for z in zones]
+        if cell is None:
+            cell = (_median([z.lrx - z.ulx for z in self.zones]), _median([z.lry - z.uly for z in self.zones]))
+        self.cell = (max(1, int(cell[0])), max(1, int(cell[1])))
+        self._grid = {}
+        for i, zone in enumerate(self.zones):
+            for key in self._cells(zone.ulx, zone.uly, zone.lrx, zone.lry):
+                self._grid.setdefault(key, []).append(i)
+        if self._grid:
+            self._extent = (min(k[0] for k in self._grid), min(k[1] for k in self._grid),
+                            max(k[0] for k in self._grid), max(k[1] for k in self._grid))
+
+    @classmethod
+    def from_surface(cls, surface):
+        """Returns the index for a surface as it is extracted by the converter,
+        with its graphic, width, height, and (id, x, y, w, h) zones."""
+        return cls(surface['graphic'], surface['width'], surface['height'],
+                   [(zid, x, y, x + w, y + h) for zid, x, y, w, h in surface['zones']])
+
+    def point(self, x, y):
+        """Returns the zones that contain the given point."""
+        found = self._grid.get(self._cell(x, y), ())
+        return [self.zones[i] for i in found if _contains(self.zones[i], x, y)]
+
+    def rectangle(self, ulx, uly, lrx, lry):
+        """Returns the zones that overlap the given rectangle, such as a viewport."""
+        if not self._grid:
+            return []
+        x0, y0, x1, y1 = self._extent
+        cx0, cy0 = self._cell(ulx, uly)
+        cx1, cy1 = self._cell(lrx, lry)
+        found = set()
+        for cx in range(max(cx0, x0), min(cx1, x1) + 1):
+            for cy in range(max(cy0, y0), min(cy1, y1) + 1):
+                found.update(self._grid.get((cx, cy), ()))
+        return [self.zones[i] for i in sorted(found)
+                if self.zones[i].ulx <= lrx and ulx <= self.zones[i].lrx
+                and self.zones[i].uly <= lry and uly <= self.zones[i].lry]
+
+    def nearest(self, x, y):
+        """Returns the zone nearest to the given point, which is one that contains
+        it if there is one; or None if the surface has no zones. Of zones that are
+        equally near, the one that comes first on the page is returned."""
+        if not self._grid:
+            return None
+        cx, cy = self._cell(x, y)
+        x0, y0, x1, y1 = self._extent
+        rings = max(abs(cx - x0), abs(cx - x1), abs(cy - y0), abs(cy - y1))
+        step = min(self.cell)
+        best = None
+        for r in range(rings + 1):
+            for key in _ring(cx, cy, r):
+                for i in self._grid.get(key, ()):
+                    d = _distance(self.zones[i], x, y)
+                    if best is None or (d, i) < best:
+                        best = (d, i)
+            # Any zone not yet seen is at least this far away.
+            if best is not None and best[0] <= r * step:
+                break
+        return self.zones[best[1]]
+
+    def as_dict(self):
+        return {'graphic': self.graphic, 'width': self.width, 'height': self.height, 'cell': list(self.cell),
+                'zones': [list(z) for z in self.zones]}
+
+    def _cell(self, x, y):
+        return int(x // self.cell[0]), int(y // self.cell[1])
+
+    def _cells(self, ulx, uly, lrx, lry):
+        cx0, cy0 = self._cell(ulx, uly)
+        cx1, cy1 = self._cell(lrx, lry)
+        return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+
+class FacsimileIndex:
+    """The spatial indexes of all the surfaces of a manuscript, by the name of
+    their graphic. It can be made from the facsimile of a TEI document, or by
+    the converter with its zone_index option, and saved as a compact JSON
+    sidecar file to be loaded by whatever needs the lookups."""
+
+    def __init__(self, surfaces=()):
+        self.surfaces = {s.graphic: s for s in surfaces}
+
+    @classmethod
+    def from_facsimile(cls, facsimile):
+        """Returns the index for the surfaces that the converter has extracted."""
+        return cls(SurfaceIndex.from_surface(s) for s in facsimile)
+
+    @classmethod
+    def from_tei(cls, document):
+        """Returns the index for the surfaces of a TEI document, which may be an
+        ElementTree or element, or the serialized document."""
+        if isinstance(document, (bytes, bytearray)):
+            document = etree.fromstring(bytes(document), etree.XMLParser(huge_tree=True))
+        surfaces = []
+        for surface in document.iter(_TEI + 'surface'):
+            graphic = surface.find(_TEI + 'graphic')
+            zones = [(z.get(_XML_ID, '').lstrip('z'), int(z.get('ulx')), int(z.get('uly')), int(z.get('lrx')),
+                      int(z.get('lry'))) for z in surface.iter(_TEI + 'zone')]
+            surfaces.append(SurfaceIndex(None if graphic is None else graphic.get('url'),
+                                         int(surface.get('lrx')), int(surface.get('lry')), zones))
+        return cls(surfaces)
+
+    def __getitem__(self, graphic):
+        return self.surfaces[graphic]
+
+    def __iter__(self):
+        return iter(self.surfaces.values())
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def as_dict(self):
+        return {'version': _SIDECAR_VERSION, 'surfaces': [s.as_dict() for s in self]}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != _SIDECAR_VERSION:
+            raise ValueError('Unknown zone index version %s' % data.get('version'))
+        return cls(SurfaceIndex(s['graphic'], s['width'], s['height'], s['zones'], s['cell'])
+                   for s in data['surfaces'])
+
+    def dump(self, fh):
+        """Write the index as a JSON sidecar to the open text file handle fh."""
+        json.dump(self.as_dict(), fh, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, fh):
+        """Read an index from a JSON sidecar that was written with dump."""
+        return cls.from_dict(json.load(fh))
+
+
+def _median(values):
+    if not values:
+        return 1
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _contains(zone, x, y):
+    return zone.ulx <= x <= zone.lrx and zone.uly <= y <= zone.lry
+
+
+def _distance(zone, x, y):
+    dx = max(zone.ulx - x, 0, x - zone.lrx)
+    dy = max(zone.uly - y, 0, y - zone.lry)
+    return math.hypot(dx, dy)
+
+
+def _ring(cx, cy, r):
+    """Returns the grid cells at Chebyshev distance r from the given one."""
+    if r == 0:
+        return [(cx, cy)]
+    cells = [(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)]
+    cells.extend((cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r))
+    return cells
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the zone index sidecar for a TEI XML file.')
+    parser.add_argument("-o", "--output", help="Write the index to this file rather than stdout")
+    parser.add_argument("infile", help="TEI XML file with a facsimile")
+    args = parser.parse_args()
+    index = FacsimileIndex.from_tei(etree.parse(args.infile))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            index.dump(fh)
+    else:
+        index.dump(sys.stdout)
+        print()